@@ -0,0 +1,221 @@
+# -*- encoding: utf-8
+"""In-memory fake of a LDAPObject
+
+Implements the synchronous operations Ploum uses (search_s, search_ext_s,
+add_s, modify_s, delete_s) over a dict of entries, with a subschema
+subentry loaded from a fixture file. Searches may also be sent with
+search_ext and read with result3, honouring the Simple Paged Results
+control. Filters are evaluated with
+ploum.filters.parse_filter, values compared case-insensitively.
+"""
+
+import json
+import os
+
+import ldap
+from ldap.controls import SimplePagedResultsControl
+from ploum import filters
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+SCHEMA_FIXTURE = os.path.join(FIXTURES, 'openldap_schema.json')
+SUBSCHEMA_DN = 'cn=Subschema'
+
+
+def load_schema_fixture(path=SCHEMA_FIXTURE):
+    """Load a subschema subentry fixture
+
+    :param path: JSON file of the subschema attributes, as str values
+    :return: dict of the subschema attributes, as bytes values"""
+    with open(path, encoding='utf-8') as f:
+        data = json.load(f)
+    return dict((k, [v.encode('utf-8') for v in values])
+                for (k, values) in data.items() if isinstance(values, list))
+
+
+def _values(entry, attr):
+    return [v.decode('utf-8', 'replace').lower() if isinstance(v, bytes) else str(v).lower()
+            for v in entry.get(attr.lower(), ())]
+
+
+def _int(value):
+    try:
+        return int(value)
+    except ValueError:
+        return value
+
+
+def _matches(expr, entry):
+    """Evaluate a filter expression against lowercased entry attributes"""
+    if isinstance(expr, filters.And):
+        return all(_matches(f, entry) for f in expr.args)
+    if isinstance(expr, filters.Or):
+        return any(_matches(f, entry) for f in expr.args)
+    if isinstance(expr, filters.Not):
+        return not _matches(expr.args[0], entry)
+    values = _values(entry, expr.args[0])
+    if isinstance(expr, filters.Present):
+        return bool(values)
+    if isinstance(expr, filters.Substring):
+        (_, initial, middle, final) = expr.args
+        for v in values:
+            pos = 0
+            if initial is not None:
+                if not v.startswith(initial.lower()):
+                    continue
+                pos = len(initial)
+            for part in middle:
+                pos = v.find(part.lower(), pos)
+                if pos < 0:
+                    break
+                pos += len(part)
+            if pos >= 0 and (final is None or v[pos:].endswith(final.lower())):
+                return True
+        return False
+    wanted = str(expr.args[1]).lower()
+    if isinstance(expr, filters.GreaterOrEqual):
+        return any(_int(v) >= _int(wanted) for v in values)
+    if isinstance(expr, filters.LessOrEqual):
+        return any(_int(v) <= _int(wanted) for v in values)
+    return wanted in values
+
+
+class FakeLDAPObject(object):
+    """In-memory LDAP server and connection
+
+    :param entries: optional dict DN → attributes (lists of bytes)
+    :param schema: subschema subentry attributes, defaults to the OpenLDAP
+        core, cosine, inetorgperson and nis fixture"""
+
+    def __init__(self, entries=None, schema=None):
+        self.schema = schema if schema is not None else load_schema_fixture()
+        self.entries = {}
+        self.operations = 0
+        # paged searches in progress: cookie → remaining results
+        self.paged = {}
+        self._msgid = 0
+        self._results = {}
+        for (dn, attrs) in (entries or {}).items():
+            self._store(dn, attrs)
+
+    def _store(self, dn, attrs):
+        self.entries[dn.lower()] = (dn, attrs, dict((k.lower(), v) for (k, v) in attrs.items()))
+
+    def search_s(self, base, scope, filterstr='(objectClass=*)', attrlist=None, attrsonly=0):
+        return self.search_ext_s(base, scope, filterstr, attrlist, attrsonly)
+
+    def search_ext_s(self, base, scope, filterstr='(objectClass=*)', attrlist=None,
+                     attrsonly=0, serverctrls=None, clientctrls=None, timeout=-1,
+                     sizelimit=0):
+        self.operations += 1
+        if base == '' and scope == ldap.SCOPE_BASE:
+            return [('', {'subschemaSubentry': [SUBSCHEMA_DN.encode('utf-8')]})]
+        if base.lower() == SUBSCHEMA_DN.lower():
+            return [(SUBSCHEMA_DN, self.schema)]
+        low = base.lower()
+        if scope == ldap.SCOPE_BASE:
+            candidates = [self.entries[low]] if low in self.entries else []
+            if not candidates:
+                raise ldap.NO_SUCH_OBJECT({'desc': 'No such object', 'matched': ''})
+        else:
+            suffix = ',' + low
+            candidates = [e for (k, e) in self.entries.items()
+                          if k.endswith(suffix) and (
+                              scope == ldap.SCOPE_SUBTREE or ',' not in k[:-len(suffix)])]
+            if scope == ldap.SCOPE_SUBTREE and low in self.entries:
+                candidates.insert(0, self.entries[low])
+        expr = filters.parse_filter(filterstr or '(objectClass=*)')
+        wanted = None
+        if attrlist and '*' not in attrlist:
+            wanted = set(a.lower() for a in attrlist)
+        res = []
+        for (dn, attrs, lowered) in candidates:
+            if not _matches(expr, lowered):
+                continue
+            if wanted is not None:
+                attrs = dict((k, v) for (k, v) in attrs.items() if k.lower() in wanted)
+            res.append((dn, attrs))
+        return res
+
+    def search_ext(self, base, scope, filterstr='(objectClass=*)', attrlist=None,
+                   attrsonly=0, serverctrls=None, clientctrls=None, timeout=-1,
+                   sizelimit=0):
+        """Start a search, whose result is read with result3
+
+        A Simple Paged Results control returns the results by pages, a
+        page size of 0 abandons the paged search of the cookie."""
+        self._msgid += 1
+        paging = next((c for c in serverctrls or ()
+                       if c.controlType == SimplePagedResultsControl.controlType), None)
+        try:
+            if paging is not None and paging.cookie:
+                try:
+                    results = self.paged.pop(paging.cookie)
+                except KeyError:
+                    raise ldap.UNWILLING_TO_PERFORM({'desc': 'Unknown paged results cookie'}) from None
+                self.operations += 1
+            else:
+                results = self.search_ext_s(base, scope, filterstr, attrlist, attrsonly)
+        except ldap.LDAPError as e:
+            self._results[self._msgid] = e
+            return self._msgid
+        ctrls = []
+        if paging is not None:
+            (results, rest) = (results[:paging.size], results[paging.size:])
+            cookie = b''
+            if rest and paging.size:
+                cookie = str(self._msgid).encode('ascii')
+                self.paged[cookie] = rest
+            ctrls.append(SimplePagedResultsControl(True, size=0, cookie=cookie))
+        self._results[self._msgid] = (ldap.RES_SEARCH_RESULT, results, self._msgid, ctrls)
+        return self._msgid
+
+    def result3(self, msgid=ldap.RES_ANY, all=1, timeout=None):
+        res = self._results.pop(msgid)
+        if isinstance(res, ldap.LDAPError):
+            raise res
+        return res
+
+    def add_s(self, dn, modlist):
+        self.operations += 1
+        if dn.lower() in self.entries:
+            raise ldap.ALREADY_EXISTS({'desc': 'Already exists'})
+        self._store(dn, dict((k, list(v)) for (k, v) in modlist))
+        return (ldap.RES_ADD, [])
+
+    def modify_s(self, dn, modlist):
+        self.operations += 1
+        try:
+            attrs = dict(self.entries[dn.lower()][1])
+        except KeyError:
+            raise ldap.NO_SUCH_OBJECT({'desc': 'No such object'}) from None
+        for (op, attr, values) in modlist:
+            key = next((k for k in attrs if k.lower() == attr.lower()), attr)
+            if values is not None and not isinstance(values, list):
+                values = [values]
+            if op == ldap.MOD_ADD:
+                attrs[key] = attrs.get(key, []) + values
+            elif op == ldap.MOD_REPLACE:
+                attrs[key] = values or []
+            elif values is None:
+                attrs.pop(key, None)
+            else:
+                attrs[key] = [v for v in attrs.get(key, []) if v not in values]
+            if not attrs.get(key):
+                attrs.pop(key, None)
+        self._store(dn, attrs)
+        return (ldap.RES_MODIFY, [])
+
+    def delete_s(self, dn):
+        self.operations += 1
+        if self.entries.pop(dn.lower(), None) is None:
+            raise ldap.NO_SUCH_OBJECT({'desc': 'No such object'})
+        return (ldap.RES_DELETE, [])
+
+    def bind_s(self, who, cred, method=ldap.AUTH_SIMPLE):
+        return (ldap.RES_BIND, [])
+
+    def unbind_s(self):
+        pass
+
+
+__all__ = ['FakeLDAPObject', 'load_schema_fixture', 'SCHEMA_FIXTURE', ]
@@ -0,0 +1,371 @@
+# -*- encoding: utf-8
+"""Ploum benchmarks
+
+Run the benchmarks of the hot paths of Ploum against an in-memory fake
+connection and report the results as JSON, so that runs of several
+commits can be compared::
+
+    python -m benchmarks.run -o results.json
+    python -m benchmarks.run --sizes 1000 --only populate,search
+
+Every benchmark is timed over several repetitions (the median and the
+minimum are reported), then run once more under tracemalloc to measure
+its peak memory, also reported per entry for the sized ones. populate and
+populate_compact compare the memory of items with and without __dict__.
+"""
+
+import argparse
+import gc
+import json
+import logging
+import platform
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import ldap
+
+from ploum import codegen, ploum, plumbing, serializer
+from ploum.ldap_lib import build_properties
+from ploum.ldap_utils import build_composedtype
+
+from .fakeldap import FakeLDAPObject, load_schema_fixture
+
+logger = logging.getLogger(__name__)
+
+BASE_DN = 'ou=people,dc=example,dc=com'
+USER_CLASSES = ('inetOrgPerson', 'posixAccount', 'shadowAccount')
+BENCHMARKS = []
+SCHEMA = load_schema_fixture()
+
+
+def benchmark(name, sized=False):
+    """Register a benchmark
+
+    The decorated function takes the size of the data set if sized, and
+    returns the function to time: setup is left out of the measures.
+
+    :param name: name of the benchmark
+    :param sized: if True, the benchmark is run for each data set size"""
+    def register(f):
+        BENCHMARKS.append((name, sized, f))
+        return f
+    return register
+
+
+def make_entry(i):
+    """Attributes of a user entry, as a server would return them
+
+    :param i: number of the user
+    :return: tuple (dn, attrs)"""
+    uid = 'user{:06d}'.format(i)
+    return ('uid={},{}'.format(uid, BASE_DN), {
+        'objectClass': [b'top', b'person', b'organizationalPerson', b'inetOrgPerson',
+                        b'posixAccount', b'shadowAccount'],
+        'uid': [uid.encode()],
+        'cn': ['User {}'.format(i).encode(), uid.encode()],
+        'sn': ['Surname{}'.format(i % 1000).encode()],
+        'givenName': ['Given{}'.format(i % 500).encode()],
+        'mail': ['{}@example.com'.format(uid).encode(), '{}@mail.example.com'.format(uid).encode()],
+        'uidNumber': [str(10000 + i).encode()],
+        'gidNumber': [str(100 + i % 50).encode()],
+        'homeDirectory': ['/home/{}'.format(uid).encode()],
+        'loginShell': [b'/bin/bash'],
+        'telephoneNumber': ['+33 1 23 45 {:02d} {:02d}'.format(i % 100, i // 100 % 100).encode()],
+        'description': ['Benchmark user number {}'.format(i).encode()],
+        'shadowLastChange': [b'19000'],
+    })
+
+
+def make_entries(size):
+    return dict(make_entry(i) for i in range(size))
+
+
+def fresh_schema(compact=False):
+    """Load the schema from a new fake connection, bypassing the caches
+
+    :param compact: build classes whose instances have no __dict__
+    :return: (datadict, typedict)"""
+    ploum.load_schemas.cache_clear()
+    return ploum.load_schemas(FakeLDAPObject(schema=SCHEMA), compact=compact)
+
+
+@benchmark('load_schemas')
+def bench_load_schemas():
+    def run():
+        (datadict, typedict) = fresh_schema()
+        # classes are built lazily, build them all
+        for name in datadict:
+            datadict[name]
+    return run
+
+
+@benchmark('build_composedtype')
+def bench_build_composedtype():
+    (datadict, _) = fresh_schema()
+    build_composedtype(USER_CLASSES, datadict)
+
+    def run():
+        datadict.clear_cache()
+        build_composedtype(USER_CLASSES, datadict)
+    return run
+
+
+@benchmark('build_composedtype_cached')
+def bench_build_composedtype_cached():
+    (datadict, _) = fresh_schema()
+    ocs = make_entry(0)[1]['objectClass']
+    build_composedtype(ocs, datadict)
+
+    def run():
+        for _ in range(1000):
+            build_composedtype(ocs, datadict)
+    return run
+
+
+@benchmark('populate', sized=True)
+def bench_populate(size, compact=False):
+    (datadict, _) = fresh_schema(compact)
+    typ = build_composedtype(USER_CLASSES, datadict)
+    entries = [make_entry(i) for i in range(size)]
+
+    def run():
+        return [typ(dn, attrs) for (dn, attrs) in entries]
+    return run
+
+
+@benchmark('populate_compact', sized=True)
+def bench_populate_compact(size):
+    """Same as populate, with the classes of LDAPFactory.use_compact_classes"""
+    return bench_populate(size, compact=True)
+
+
+@benchmark('fake_search', sized=True)
+def bench_fake_search(size):
+    """Cost of the fake connection alone, to put the search benchmark in context"""
+    conn = FakeLDAPObject(make_entries(size), schema=SCHEMA)
+
+    def run():
+        return conn.search_ext_s(BASE_DN, ldap.SCOPE_SUBTREE, '(objectClass=inetOrgPerson)')
+    return run
+
+
+@benchmark('search', sized=True)
+def bench_search(size):
+    conn = FakeLDAPObject(make_entries(size), schema=SCHEMA)
+    ploum.load_schemas.cache_clear()
+    cls = ploum.LDAPFactory.get_class(USER_CLASSES, conn=conn)
+    search = cls.search_all_ldap(base_dn=BASE_DN, filterstr='(objectClass=inetOrgPerson)')
+
+    def run():
+        return search(conn)
+    return run
+
+
+@benchmark('search_view', sized=True)
+def bench_search_view(size):
+    conn = FakeLDAPObject(make_entries(size), schema=SCHEMA)
+    ploum.load_schemas.cache_clear()
+    cls = ploum.LDAPFactory.get_class(USER_CLASSES, conn=conn)
+    search = cls.search_all_ldap(base_dn=BASE_DN, filterstr='(objectClass=inetOrgPerson)',
+                                 view=True)
+
+    def run():
+        res = search(conn)
+        # a report reading two fields
+        return [(e.uid, e['mail']) for e in res]
+    return run
+
+
+@benchmark('modlist', sized=True)
+def bench_modlist(size):
+    (datadict, _) = fresh_schema()
+    typ = build_composedtype(USER_CLASSES, datadict)
+    items = [typ(dn, attrs) for (dn, attrs) in (make_entry(i) for i in range(size))]
+    for (i, item) in enumerate(items):
+        item.get_attribute('mail').value.add('alias{}@example.com'.format(i))
+        item.get_attribute('description').set_value(['Changed {}'.format(i)])
+
+    def run():
+        for item in items:
+            item._prepare_save()
+    return run
+
+
+@benchmark('modlist_add_member', sized=True)
+def bench_modlist_add_member(size):
+    """Add a member to a group of size members"""
+    (datadict, _) = fresh_schema()
+    typ = build_composedtype(('groupOfNames', ), datadict)
+    group = typ('cn=group,' + BASE_DN, {
+        'objectClass': [b'top', b'groupOfNames'], 'cn': [b'group'],
+        'member': [make_entry(i)[0].encode() for i in range(size)]})
+    member = group.get_attribute('member')
+    member += [make_entry(size)[0]]
+
+    def run():
+        return group._prepare_save()
+    return run
+
+
+@benchmark('arithmeticlist_growth', sized=True)
+def bench_arithmeticlist(size):
+    values = ['member{:07d}'.format(i) for i in range(size)]
+    key = plumbing.matching_key('caseIgnoreMatch')
+
+    def run():
+        lst = plumbing.ArithmeticList(key=key)
+        for v in values:
+            lst.append(v)
+        lst += values[:size // 2]
+        return lst
+    return run
+
+
+def _search_items(size):
+    conn = FakeLDAPObject(make_entries(size), schema=SCHEMA)
+    ploum.load_schemas.cache_clear()
+    cls = ploum.LDAPFactory.get_class(USER_CLASSES, conn=conn)
+    return cls.search_all_ldap(base_dn=BASE_DN)(conn)
+
+
+@benchmark('serialize_portable', sized=True)
+def bench_serialize_portable(size):
+    """json.dumps of a list of portable_value dicts, to compare with serialize_jsonl"""
+    items = _search_items(size)
+
+    def run():
+        return json.dumps([dict(
+            (item.get_field_index()[0][low][0], attr.portable_value())
+            for (low, attr) in item._attrs.items()) for item in items])
+    return run
+
+
+@benchmark('serialize_jsonl', sized=True)
+def bench_serialize_jsonl(size):
+    items = _search_items(size)
+
+    def run():
+        return ''.join(serializer.iter_jsonl(items))
+    return run
+
+
+@benchmark('deserialize_jsonl', sized=True)
+def bench_deserialize_jsonl(size):
+    items = _search_items(size)
+    lines = list(serializer.iter_jsonl(items))
+    cls = type(items[0])
+
+    def run():
+        return list(serializer.load_jsonl(lines, cls))
+    return run
+
+
+@benchmark('startup_dynamic')
+def bench_startup_dynamic():
+    """Schema loading and class composition a program does at startup"""
+    def run():
+        (datadict, typedict) = fresh_schema()
+        return build_properties(typedict)(build_composedtype(USER_CLASSES, datadict))
+    return run
+
+
+@benchmark('startup_static')
+def bench_startup_static():
+    """Same as startup_dynamic, from a module generated by ploum.codegen"""
+    source = codegen.Generator(SCHEMA).generate([(USER_CLASSES, 'User')])
+    code = compile(source, 'ldap_classes.py', 'exec')
+
+    def run():
+        namespace = {'__name__': 'ldap_classes'}
+        exec(code, namespace)
+        return namespace['object_classes'].get_class(USER_CLASSES)
+    return run
+
+
+def measure(make, repeat):
+    """Time the function made by make, then measure its peak memory
+
+    :param make: callable returning the function to measure
+    :param repeat: number of timed runs
+    :return: dict of the results"""
+    run = make()
+    times = []
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        res = run()
+        times.append(time.perf_counter() - start)
+        del res
+    gc.collect()
+    tracemalloc.start()
+    try:
+        res = run()
+        (_, peak) = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    del res
+    return dict(time_s=statistics.median(times), min_s=min(times), repeat=repeat,
+                peak_bytes=peak)
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(sizes=(1000, 100000), only=None, repeat=5):
+    """Run the benchmarks
+
+    :param sizes: sizes of the data sets of the sized benchmarks
+    :param only: optional names of the benchmarks to run
+    :param repeat: number of timed runs, reduced for large data sets
+    :return: list of result dicts"""
+    results = []
+    for (name, sized, make) in BENCHMARKS:
+        if only and name not in only:
+            continue
+        for size in (sizes if sized else (None, )):
+            args = () if size is None else (size, )
+            runs = max(1, repeat if not size or size <= 10000 else repeat // 5)
+            logger.info('Running %s %s', name, size or '')
+            res = dict(name=name, size=size)
+            res.update(measure(lambda: make(*args), runs))
+            if size:
+                res['peak_bytes_per_entry'] = res['peak_bytes'] // size
+            results.append(res)
+            print('{:<28} {:>8} {:>10.4f}s {:>12d}B {:>8}'.format(
+                name, size or '', res['time_s'], res['peak_bytes'],
+                '{}B/e'.format(res['peak_bytes_per_entry']) if size else ''), file=sys.stderr)
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('-o', '--output', help='write the JSON results to this file')
+    parser.add_argument('--sizes', default='1000,100000',
+                        help='comma separated data set sizes (default: %(default)s)')
+    parser.add_argument('--only', help='comma separated names of the benchmarks to run')
+    parser.add_argument('--repeat', type=int, default=5, help='timed runs (default: %(default)s)')
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.WARNING)
+    results = run_benchmarks(
+        sizes=[int(s) for s in args.sizes.split(',')],
+        only=args.only.split(',') if args.only else None, repeat=args.repeat)
+    report = dict(revision=git_revision(), python=platform.python_version(),
+                  platform=platform.platform(), results=results)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,12 @@
 """Misc Python utilities"""
 import sortedcontainers
+import collections
+import contextlib
 import functools
+import os
+import tempfile
+import threading
+import time
 
 
 def make_a_list(iterable):
@@ -120,32 +126,244 @@ def test_inherit_docs():
     assert a.blo.__doc__ == b.blo.__doc__
 
 
-_cache_answers = {}
+class _IdentityKey(object):
+    """Cache key part standing for an unhashable object, compared by identity.
 
+    Keeps a reference on the object so its id() cannot be recycled while the
+    key lives in a cache."""
+    __slots__ = ('obj', )
 
-def slacker_cacher_decorator(f):
+    def __init__(self, obj):
+        self.obj = obj
+
+    def __hash__(self):
+        return id(self.obj)
+
+    def __eq__(self, other):
+        return isinstance(other, _IdentityKey) and other.obj is self.obj
+
+
+def _make_key_part(item):
+    """Make a hashable cache key part from an argument.
+
+    Hashable items are used as is, lists and tuples are turned into tuples of
+    key parts, anything else is keyed by identity."""
+    if isinstance(item, (list, tuple)):
+        return (type(item), ) + tuple(_make_key_part(i) for i in item)
+    try:
+        hash(item)
+    except TypeError:
+        return _IdentityKey(item)
+    return item
+
+
+def _make_key(a, k):
+    key = tuple(_make_key_part(i) for i in a)
+    if k:
+        key += (_KWARGS_MARK, ) + tuple(
+            (n, _make_key_part(v)) for (n, v) in sorted(k.items()))
+    return key
+
+
+_KWARGS_MARK = object()
+_MISSING = object()
+
+
+class BoundedCache(object):
+    """A thread safe LRU cache with optional time to live.
+
+    :param maxsize: maximum number of entries kept, None for unbounded
+    :param ttl: seconds an entry stays valid, None for forever
+    :param name: name used to report statistics"""
+
+    def __init__(self, maxsize=1024, ttl=None, name=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.name = name
+        self._data = collections.OrderedDict()
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        """Get an entry from the cache, refreshing its LRU position
+
+        :param key: key of the entry
+        :param default: returned when the entry is missing or expired"""
+        with self._lock:
+            try:
+                (value, expires) = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            if expires is not None and expires < time.monotonic():
+                del self._data[key]
+                self.evictions += 1
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        """Store an entry, evicting the least recently used ones if needed"""
+        expires = None if self.ttl is None else time.monotonic() + self.ttl
+        with self._lock:
+            self._data[key] = (value, expires)
+            self._data.move_to_end(key)
+            while self.maxsize is not None and len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        """Drop an entry from the cache
+
+        :return: True if the entry was present"""
+        with self._lock:
+            return self._data.pop(key, _MISSING) is not _MISSING
+
+    def clear(self):
+        """Drop all entries, keep the statistics"""
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def stats(self):
+        """Statistics of this cache
+
+        :return: dict with hits, misses, evictions, size and maxsize"""
+        with self._lock:
+            return dict(name=self.name, hits=self.hits, misses=self.misses,
+                        evictions=self.evictions, size=len(self._data),
+                        maxsize=self.maxsize, ttl=self.ttl)
+
+
+_caches = []
+
+
+def cache_stats():
+    """Statistics of every cache built by slacker_cacher_decorator
+
+    :return: dict qualified function name → statistics dict"""
+    return dict((c.name, c.stats()) for c in _caches)
+
+
+def slacker_cacher_decorator(f=None, maxsize=1024, ttl=None):
     """A caching decorator for short-term invariant results.
 
     When applied to a function then this function will be called only once with a
-    given argument set. The cache is done using a str() serialization of a tuple
-    containing the function and its parameters.
+    given argument set, as long as the result is not evicted. The cache key is
+    made of the arguments themselves when hashable, of tuples for lists and
+    tuples, and of the identity of the object for anything else.
+
+    May be used bare or with parameters:
+    ``@slacker_cacher_decorator(maxsize=128, ttl=60)``.
 
     If you want to bypass cache, add a uncache=True parameter to the function
     arguments.
 
+    The decorated function exposes ``cache`` (the BoundedCache), ``cache_info()``,
+    ``cache_clear()`` and ``invalidate(*a, **k)``.
+
     :param f: function to decorate
+    :param maxsize: maximum number of results kept, None for unbounded
+    :param ttl: seconds a result stays valid, None for forever
 
     :return: decorated function
     """
-    global _cache_answers
+    if f is None:
+        return functools.partial(slacker_cacher_decorator, maxsize=maxsize, ttl=ttl)
+    cache = BoundedCache(maxsize, ttl,
+                         name='{}.{}'.format(f.__module__, f.__qualname__))
+    _caches.append(cache)
+
     @functools.wraps(f)
     def _(*a, **k):
-        if k.pop('uncache', None) is not None or repr([f, a, k]) not in _cache_answers:
-            _cache_answers[repr([f, a, k])] = f(*a, **k)
-        return _cache_answers[repr([f, a, k])]
+        uncache = k.pop('uncache', None) is not None
+        key = _make_key(a, k)
+        if not uncache:
+            res = cache.get(key, _MISSING)
+            if res is not _MISSING:
+                return res
+        res = f(*a, **k)
+        cache.set(key, res)
+        return res
+
+    _.cache = cache
+    _.cache_info = cache.stats
+    _.cache_clear = cache.clear
+    _.invalidate = lambda *a, **k: cache.invalidate(_make_key(a, k))
     return _
 
 
+def test_slacker_cacher_decorator():
+    calls = []
+
+    @slacker_cacher_decorator(maxsize=2)
+    def f(a, b=None):
+        calls.append(a)
+        return a
+
+    unhashable = {}
+    assert f([1, 2]) == [1, 2] and f([1, 2]) == [1, 2]
+    assert f(unhashable) is f(unhashable)
+    assert len(calls) == 2
+    f(3)
+    assert f.cache_info()['evictions'] == 1
+    assert f.invalidate(3) and not f.invalidate(3)
+    f(unhashable, uncache=True)
+    assert len(calls) == 4
+    assert f.cache_info()['hits'] == 2
+
+
+@contextlib.contextmanager
+def atomic_write(path, prefix='.tmp-', mode=None):
+    """Write a text file atomically: the block writes to a temporary file
+    of the same directory, renamed to path when the block succeeds and
+    removed otherwise.
+
+    :param path: file to write
+    :param prefix: prefix of the temporary file name
+    :param mode: optional permissions of the file, the temporary file is
+        only readable by its owner
+    :return: context manager giving the file object"""
+    (fd, tmp) = tempfile.mkstemp(prefix=prefix, dir=os.path.dirname(os.path.abspath(path)))
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            yield f
+        if mode is not None:
+            os.chmod(tmp, mode)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+def test_atomic_write():
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, 'file')
+    with atomic_write(path, mode=0o644) as f:
+        f.write('first')
+    try:
+        with atomic_write(path) as f:
+            f.write('second')
+            raise KeyboardInterrupt()
+    except KeyboardInterrupt:
+        pass
+    with open(path) as f:
+        assert f.read() == 'first'
+    assert os.listdir(directory) == ['file']
+    assert os.stat(path).st_mode & 0o777 == 0o644
+    os.unlink(path)
+    os.rmdir(directory)
+
+
 def is_scalar(thing):
     return isinstance(thing, (type(None), bytes, str)) or not hasattr(thing, '__iter__')
 
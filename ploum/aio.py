@@ -0,0 +1,213 @@
+# -*- encoding: utf-8
+"""Ploum asyncio helpers
+
+Run python-ldap message-id based operations (``search_ext``, ``add_ext``,
+``modify_ext``, ``delete_ext``) from coroutines. Results are polled when
+the event loop reports the connection socket readable, so many operations
+may be in flight on a single connection without any thread.
+"""
+
+import asyncio
+import logging
+import socket
+import weakref
+
+import ldap
+from ldap.ldapobject import LDAPError
+
+logger = logging.getLogger(__name__)
+_dispatchers = weakref.WeakKeyDictionary()
+
+
+class ResultDispatcher(object):
+    """Dispatch the results of a LDAP connection to the coroutines awaiting them
+
+    A single reader callback is registered on the connection socket for all
+    pending operations. As libldap may buffer the results of other operations
+    while reading one, every pending message id is polled on each wake-up.
+
+    :param ldap_conn: a LDAP connection
+    :param loop: event loop to register the reader in"""
+
+    def __init__(self, ldap_conn, loop):
+        self._conn = weakref.ref(ldap_conn)
+        self.loop = loop
+        self.fd = None
+        self._handle = None
+        self.waiters = {}
+
+    def _watch(self, conn):
+        """Register the reader on the current socket of the connection
+
+        A reconnection (ReconnectLDAPObject) opens a new socket, whose
+        descriptor may even reuse the number of the old one."""
+        try:
+            fd = conn.fileno()
+        except LDAPError:
+            fd = None
+        handle = getattr(conn, '_l', None)
+        if self.fd is not None and (fd != self.fd or handle is not self._handle):
+            logger.debug('Connection socket changed, watching %s instead of %s', fd, self.fd)
+            self._unwatch()
+        if self.fd is None and fd is not None:
+            self.loop.add_reader(fd, self.poll)
+            (self.fd, self._handle) = (fd, handle)
+
+    def _unwatch(self):
+        if self.fd is not None:
+            self.loop.remove_reader(self.fd)
+        (self.fd, self._handle) = (None, None)
+
+    def wait(self, msgid):
+        """Wait for the complete result of an operation
+
+        :param msgid: message id of the operation
+        :return: future of the result3() tuple"""
+        fut = self.loop.create_future()
+        conn = self._conn()
+        if conn is not None:
+            self._watch(conn)
+        self.waiters[msgid] = fut
+        # the result may already be there, buffered by libldap
+        self.loop.call_soon(self.poll)
+        return fut
+
+    def poll(self):
+        """Poll every pending operation and resolve the completed ones"""
+        conn = self._conn()
+        for (msgid, fut) in list(self.waiters.items()):
+            if conn is None:
+                fut.cancel()
+            if fut.done():
+                del self.waiters[msgid]
+                if fut.cancelled() and conn is not None:
+                    logger.debug('Abandoning cancelled operation %s', msgid)
+                    conn.abandon(msgid)
+                continue
+            try:
+                res = conn.result3(msgid, 1, 0)
+            except LDAPError as e:
+                del self.waiters[msgid]
+                fut.set_exception(e)
+                continue
+            if res[0] is not None:
+                del self.waiters[msgid]
+                fut.set_result(res)
+        if self.waiters and conn is not None:
+            self._watch(conn)
+        else:
+            self._unwatch()
+
+
+def get_dispatcher(ldap_conn, loop=None):
+    """Get the result dispatcher of a connection for the running loop
+
+    :param ldap_conn: a LDAP connection
+    :param loop: optional event loop, defaults to the running one"""
+    loop = loop or asyncio.get_running_loop()
+    disp = _dispatchers.get(ldap_conn)
+    if disp is None or disp.loop is not loop:
+        disp = _dispatchers[ldap_conn] = ResultDispatcher(ldap_conn, loop)
+    return disp
+
+
+async def wait_result(ldap_conn, msgid):
+    """Wait for the complete result of an asynchronous operation
+
+    :param ldap_conn: the LDAP connection the operation was sent on
+    :param msgid: message id of the operation
+    :return: result3() tuple (type, data, msgid, controls)"""
+    return await get_dispatcher(ldap_conn).wait(msgid)
+
+
+async def search(ldap_conn, base, scope, filterstr='(objectClass=*)',
+                 attrlist=None, serverctrls=None):
+    """Coroutine counterpart of search_ext_s
+
+    :return: list of (dn, attrs), search continuation references excluded"""
+    msgid = ldap_conn.search_ext(base, scope, filterstr,
+                                 attrlist=attrlist, serverctrls=serverctrls)
+    (_, rdata, _, _) = await wait_result(ldap_conn, msgid)
+    return [(dn, attrs) for (dn, attrs) in rdata if dn is not None]
+
+
+async def add(ldap_conn, dn, modlist):
+    """Coroutine counterpart of add_s"""
+    return await wait_result(ldap_conn, ldap_conn.add_ext(dn, modlist))
+
+
+async def modify(ldap_conn, dn, modlist):
+    """Coroutine counterpart of modify_s"""
+    return await wait_result(ldap_conn, ldap_conn.modify_ext(dn, modlist))
+
+
+async def delete(ldap_conn, dn):
+    """Coroutine counterpart of delete_s"""
+    return await wait_result(ldap_conn, ldap_conn.delete_ext(dn))
+
+
+class _TestConnection(object):
+    """Message-id API over a socket pair, results sent by respond()"""
+
+    def __init__(self):
+        self.msgid = 0
+        self.results = {}
+        self.lost = set()
+        self.reconnect()
+
+    def reconnect(self):
+        """Open a new socket, operations in progress are lost"""
+        self._l = socket.socketpair()
+        self.lost.update(m for m in range(1, self.msgid + 1) if m not in self.results)
+
+    def fileno(self):
+        return self._l[0].fileno()
+
+    def delete_ext(self, dn):
+        self.msgid += 1
+        return self.msgid
+
+    def respond(self, msgid):
+        self.results[msgid] = (ldap.RES_DELETE, [], msgid, [])
+        self._l[1].send(b'x')
+
+    def result3(self, msgid, all=1, timeout=None):
+        if msgid in self.lost:
+            raise ldap.SERVER_DOWN({'desc': "Can't contact LDAP server"})
+        if msgid not in self.results:
+            return (None, None, None, None)
+        self._l[0].recv(1)
+        return self.results.pop(msgid)
+
+
+def test_dispatcher():
+    conn = _TestConnection()
+    old_sockets = conn._l
+
+    async def run():
+        loop = asyncio.get_running_loop()
+        first = asyncio.ensure_future(delete(conn, 'uid=a,dc=example,dc=com'))
+        second = asyncio.ensure_future(delete(conn, 'uid=b,dc=example,dc=com'))
+        await asyncio.sleep(0)
+        loop.call_later(0.01, conn.respond, 2)
+        assert (await second)[2] == 2 and not first.done()
+        conn.reconnect()
+        third = asyncio.ensure_future(delete(conn, 'uid=c,dc=example,dc=com'))
+        await asyncio.sleep(0)
+        loop.call_later(0.01, conn.respond, 3)
+        # the new socket is watched, the lost operation fails instead of hanging
+        assert (await asyncio.wait_for(third, 5))[2] == 3
+        try:
+            await asyncio.wait_for(first, 5)
+        except ldap.SERVER_DOWN:
+            pass
+        else:
+            assert False, 'the operation lost by the reconnection must fail'
+        assert get_dispatcher(conn).fd is None
+    asyncio.run(run())
+    for sock in old_sockets + conn._l:
+        sock.close()
+
+
+__all__ = ['ResultDispatcher', 'get_dispatcher', 'wait_result',
+           'search', 'add', 'modify', 'delete', ]
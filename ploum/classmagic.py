@@ -1,5 +1,8 @@
 """Utilities that change class items"""
 # -*- encoding: utf-8
+from collections.abc import MutableSequence
+
+from .plumbing import ArithmeticList
 
 
 class ComposableType(type):
@@ -7,23 +10,59 @@ class ComposableType(type):
 
     Used so we can compose objectClassen easily
 
-    CT1 + CT2 = CT3 with composed entities'"""
+    CT1 + CT2 = CT3 with composed entities'
+
+    Attributes named in the per_class_attrs sequence are derived data
+    (caches) and are not copied to the composition."""
 
     def __add__(self, other):
-        newtype = type('clone_{}_{}'.format(self.__name__ , other.__name__),
-                       self.__bases__, dict(self.__dict__))
-        newtype.__doc__ = "Generated composition of {}, {}".format(
-            self.__name__,
-            other.__name__)
-        for i in self.__dict__:
-            if isinstance(self.__dict__[i], str):
+        return ComposableType.compose(
+            (self, other), 'clone_{}_{}'.format(self.__name__, other.__name__))
+
+    @staticmethod
+    def compose(classes, name):
+        """Compose several classes in a single step
+
+        Same as classes[0] + classes[1] + ..., without building the
+        intermediate classes.
+
+        :param classes: sequence of ComposableType; the first one provides
+            the attributes that are not sequences
+        :param name: name of the new class
+        :return: new class"""
+        (first, others) = (classes[0], classes[1:])
+        attrs = dict(first.__dict__)
+        # the descriptors of __dict__ and __weakref__ only apply to
+        # instances of first: type() makes new ones if needed
+        for i in tuple(getattr(first, 'per_class_attrs', ())) + ('__dict__', '__weakref__'):
+            attrs.pop(i, None)
+        for (i, val) in list(attrs.items()):
+            if isinstance(val, str) or not isinstance(val, (type(None), MutableSequence)):
                 continue
-            val = getattr(newtype, i, []) or []
-            otherval = getattr(other, i, []) or []
-            if (i in other.__dict__ and
-                    isinstance(otherval, (type(None), list)) and
-                    isinstance(val, (type(None), list))
-                ):
-                setattr(newtype, i, val + otherval)
+            merged = None
+            for c in others:
+                otherval = c.__dict__.get(i, ())
+                if otherval is not None and not isinstance(otherval, MutableSequence):
+                    continue
+                if merged is None:
+                    merged = ArithmeticList(val)
+                if otherval:
+                    merged += otherval
+            if merged is not None:
+                attrs[i] = merged
+        newtype = type(name, first.__bases__, attrs)
+        newtype.__doc__ = "Generated composition of {}".format(
+            ', '.join(c.__name__ for c in classes))
         return newtype
 
+
+def test_compose_sequences():
+    a = ComposableType('A', (object, ), {'names': ArithmeticList(), 'kind': 'a'})
+    b = ComposableType('B', (object, ), {'names': ArithmeticList(['x', 'y']), 'kind': 'b'})
+    c = ComposableType('C', (object, ), {'names': ArithmeticList(['y', 'z'])})
+    composed = ComposableType.compose((a, b, c), 'ABC')
+    assert composed.names == ['x', 'y', 'z'] and composed.kind == 'a'
+    assert type(composed.names) is ArithmeticList and a.names == []
+    item = composed()
+    item.extra = True
+    assert vars(item) == {'extra': True}
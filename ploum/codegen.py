@@ -0,0 +1,318 @@
+# -*- encoding: utf-8
+"""Ploum code generation
+
+Generate a Python module holding the classes of some objectClasses, built
+ahead of time from a schema, so that programs import them instead of
+loading and introspecting the schema of the server at startup::
+
+    python -m ploum.codegen --uri ldap://localhost -o myapp/ldap_classes.py \\
+        inetOrgPerson,posixAccount=Account groupOfNames
+    python -m ploum.codegen --ldif schema.ldif -o myapp/ldap_classes.py ...
+
+The schema is read from a server, from a LDIF file (a subschema subentry,
+or the cn=schema,cn=config entries of OpenLDAP) or from a schema snapshot.
+
+Each argument is a comma separated set of objectClasses, optionally
+followed by =ClassName. The module holds the attribute classes, the
+classes of the objectClasses and of their superior classes, and the
+compositions with their properties and field indexes, all precomputed
+and documented. Programs then use them directly, or through
+LDAPFactory.use_static_classes(module). With --compact, instances of the
+classes have no __dict__ (see LDAPFactory.use_compact_classes).
+"""
+
+import argparse
+import logging
+import re
+import sys
+
+import ldap
+import ldap.schema
+import ldif
+
+from . import schema_snapshot
+from .ldap_lib import field_doc
+from .ploum import ObjectClassDict, fetch_subschema
+from .plumbing import AttributeTypeDict
+
+logger = logging.getLogger(__name__)
+
+SCHEMA_ATTRS = {
+    'attributetypes': 'attributeTypes',
+    'olcattributetypes': 'attributeTypes',
+    'objectclasses': 'objectClasses',
+    'olcobjectclasses': 'objectClasses',
+}
+_OLC_INDEX = re.compile(br'^\{\d+\}')
+
+HEADER = '''# -*- encoding: utf-8
+"""Ploum classes generated by ploum.codegen
+
+Schema: {source}
+
+Do not edit, generate again with:
+
+    python -m ploum.codegen {command}
+"""
+
+from ploum.ldap_lib import field_property
+from ploum.ploum import PloumObj
+from ploum.plumbing import ArithmeticList, LDAPAttribute
+from ploum.static_schema import StaticClassDict, StaticTypeDict
+
+attr_types = StaticTypeDict()
+object_classes = StaticClassDict(attr_types)
+VIRTUAL_FIELDS = frozenset(a.lower() for a in PloumObj.virtual_fields)
+'''
+
+
+def read_ldif_schema(path):
+    """Read the schema of a LDIF file
+
+    The file holds a subschema subentry, or schema entries of the OpenLDAP
+    configuration (olcAttributeTypes and olcObjectClasses).
+
+    :param path: LDIF file
+    :return: subschema entry attributes"""
+    with open(path, encoding='utf-8') as f:
+        parser = ldif.LDIFRecordList(f)
+        parser.parse()
+    entry = {}
+    for (_, attrs) in parser.all_records:
+        for (name, values) in attrs.items():
+            name = SCHEMA_ATTRS.get(name.lower())
+            if name is not None:
+                entry.setdefault(name, []).extend(_OLC_INDEX.sub(b'', v) for v in values)
+    if not entry:
+        raise ValueError('No schema definitions in {}'.format(path))
+    return entry
+
+
+def read_server_schema(uri, credentials=None):
+    """Read the schema of a server
+
+    :param uri: URI of the LDAP server
+    :param credentials: optional (who, password) tuple to bind with
+    :return: subschema entry attributes"""
+    conn = ldap.initialize(uri)
+    try:
+        if credentials is not None:
+            conn.simple_bind_s(*credentials)
+        return fetch_subschema(conn)[1]
+    finally:
+        conn.unbind_s()
+
+
+def _identifier(name):
+    res = re.sub(r'\W', '_', name)
+    return '_' + res if res[:1].isdigit() else res
+
+
+def _docstring(text):
+    if '"""' in text or '\\' in text or text.endswith('"'):
+        return repr(text)
+    return '"""{}"""'.format(text.replace('\n', '\n    ').replace('\n    \n', '\n\n'))
+
+
+def _literal_list(values):
+    return 'ArithmeticList({!r})'.format(list(values))
+
+
+class Generator(object):
+    """Generate the source of a module of classes
+
+    :param entry: subschema entry attributes
+    :param source: description of where the schema comes from
+    :param command: arguments of ploum.codegen to generate the module again
+    :param compact: if True, generate classes whose instances have no __dict__"""
+
+    def __init__(self, entry, source='', command='', compact=False):
+        self.schemata = ldap.schema.SubSchema(entry)
+        self.typedict = AttributeTypeDict(self.schemata)
+        self.datadict = ObjectClassDict(self.schemata, self.typedict)
+        self.source = source
+        self.command = command
+        self.compact = compact
+        self.attr_names = {}
+        self.lines = []
+
+    def _emit(self, *lines):
+        self.lines.extend(lines)
+
+    def _attribute_class(self, attr_class):
+        props = attr_class.properties
+        name = 'LDAPAttr_{}'.format(_identifier(props['name']))
+        self.attr_names[props['oid']] = name
+        self._emit('', '', '@attr_types.register',
+                   'class {}(LDAPAttribute):'.format(name),
+                   '    ' + _docstring(props['desc'] or props['name']))
+        if self.compact:
+            self._emit('    __slots__ = ()')
+        self._emit('    properties = {')
+        for (key, value) in props.items():
+            self._emit('        {!r}: {!r},'.format(key, value))
+        self._emit('    }')
+
+    def _common_attrs(self, cls):
+        if self.compact:
+            self._emit('    __slots__ = ()')
+        self._emit('    names = {}'.format(_literal_list(cls.names)),
+                   '    must_fields = {}'.format(_literal_list(cls.must_fields)),
+                   '    may_fields = {}'.format(_literal_list(cls.may_fields)),
+                   '    sup_classes = {}'.format(_literal_list(cls.sup_classes)),
+                   '    obsolete = {!r}'.format(cls.obsolete),
+                   '    oid = {!r}'.format(cls.oid),
+                   '    attr_types = attr_types',
+                   '    datadict = object_classes')
+
+    def _object_class(self, oid):
+        obj = self.schemata.get_obj(ldap.schema.ObjectClass, oid)
+        cls = self.datadict[oid]
+        name = 'LDAPEntity_{}'.format(_identifier(cls.names[0]))
+        self._emit('', '', 'class {}(PloumObj):'.format(name),
+                   '    ' + _docstring(obj.desc or cls.names[0]))
+        self._common_attrs(cls)
+        self._emit('', '', 'object_classes.register({}, kind={!r})'.format(name, obj.kind))
+
+    def _composition(self, ocs, name):
+        typ = self.datadict.compose(ocs)
+        oids = sorted(frozenset().union(*(self.datadict.closure(oc) for oc in ocs)))
+        docs = ['Composition of {}'.format(', '.join(ocs)), '']
+        for oid in sorted(oids, key=self.datadict._sort_key):
+            obj = self.schemata.get_obj(ldap.schema.ObjectClass, oid)
+            docs.append('{}: {}'.format(obj.names[0], obj.desc or ''))
+        self._emit('', '', 'class {}(PloumObj):'.format(name),
+                   '    ' + _docstring('\n'.join(docs)))
+        self._common_attrs(typ)
+        self._emit('    _field_index = ({')
+        for (low, (field, attr_class)) in typ.get_field_index()[0].items():
+            self._emit('        {!r}: ({!r}, {}),'.format(
+                low, field, self.attr_names[attr_class.properties['oid']]))
+        self._emit('    }, VIRTUAL_FIELDS)')
+        late = []
+        for field in dict.fromkeys(typ.may_fields + typ.must_fields):
+            prop = 'field_property({!r}, {!r})'.format(
+                field, field_doc(field, typ.attr_types[field]))
+            if field.isidentifier():
+                self._emit('    {} = {}'.format(field, prop))
+            else:
+                late.append('setattr({}, {!r}, {})'.format(name, field, prop))
+        self._emit('', '')
+        self._emit(*late)
+        self._emit('object_classes.register_composed({}, {!r})'.format(name, tuple(oids)))
+
+    def generate(self, compositions):
+        """Generate the source of the module
+
+        :param compositions: list of (objectClass names, class name or None)
+        :return: str"""
+        self.lines = [HEADER.format(source=self.source, command=self.command).rstrip('\n')]
+        oids = set()
+        for (ocs, _) in compositions:
+            oids.update(*(self.datadict.closure(oc) for oc in ocs))
+        attrs = {}
+        for oid in oids:
+            cls = self.datadict[oid]
+            for field in ['objectClass'] + list(cls.must_fields) + list(cls.may_fields):
+                attr_class = self.typedict[field]
+                attrs[attr_class.properties['oid']] = attr_class
+        for attr_class in sorted(attrs.values(), key=lambda c: c.properties['name'].lower()):
+            self._attribute_class(attr_class)
+        for oid in sorted(oids, key=lambda o: self.datadict[o].names[0].lower()):
+            self._object_class(oid)
+        names = []
+        for (ocs, name) in compositions:
+            name = name or 'LDAP_{}'.format(_identifier('_'.join(ocs)))
+            names.append(name)
+            self._composition(ocs, name)
+        self._emit('', '', '__all__ = {!r}'.format(names + ['attr_types', 'object_classes']))
+        return '\n'.join(self.lines) + '\n'
+
+
+def parse_composition(arg):
+    """Parse a composition argument: objectClass[,objectClass...][=ClassName]
+
+    :return: (tuple of objectClass names, class name or None)"""
+    (ocs, _, name) = arg.partition('=')
+    return (tuple(oc.strip() for oc in ocs.split(',') if oc.strip()), name or None)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m ploum.codegen',
+                                     description=__doc__.split('\n')[0])
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--uri', help='read the schema of this LDAP server')
+    source.add_argument('--ldif', help='read the schema of this LDIF file')
+    source.add_argument('--snapshot', help='read the schema of this schema snapshot')
+    parser.add_argument('--bind-dn', help='DN to bind with to the server')
+    parser.add_argument('--password-file', help='file holding the password of --bind-dn')
+    parser.add_argument('-o', '--output', help='module to write, default to stdout')
+    parser.add_argument('--compact', action='store_true',
+                        help='generate classes whose instances have no __dict__')
+    parser.add_argument('compositions', nargs='+', metavar='OBJECTCLASS[,...][=NAME]',
+                        help='objectClasses to generate a class for')
+    args = parser.parse_args(argv)
+    if args.bind_dn and not args.password_file:
+        parser.error('--bind-dn requires --password-file')
+    logging.basicConfig(level=logging.WARNING)
+    if args.uri:
+        credentials = None
+        if args.bind_dn:
+            with open(args.password_file) as f:
+                credentials = (args.bind_dn, f.read().strip())
+        (entry, description) = (read_server_schema(args.uri, credentials), args.uri)
+    elif args.ldif:
+        (entry, description) = (read_ldif_schema(args.ldif), args.ldif)
+    else:
+        loaded = schema_snapshot.load_snapshot(args.snapshot)
+        if not loaded:
+            parser.error('unusable schema snapshot {}'.format(args.snapshot))
+        (entry, description) = (loaded[1], args.snapshot)
+    command = ' '.join(argv if argv is not None else sys.argv[1:])
+    code = Generator(entry, description, command, args.compact).generate(
+        [parse_composition(a) for a in args.compositions])
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(code)
+    else:
+        sys.stdout.write(code)
+
+
+def test_generate():
+    from benchmarks.fakeldap import load_schema_fixture
+    entry = load_schema_fixture()
+    source = Generator(entry).generate([(('inetOrgPerson', 'posixAccount'), 'Account'),
+                                        (('groupOfNames', ), None)])
+    namespace = {'__name__': 'ldap_classes'}
+    exec(compile(source, 'ldap_classes.py', 'exec'), namespace)
+    account = namespace['Account']
+    assert 'LDAP_groupOfNames' in namespace['__all__']
+    assert namespace['object_classes'].get_class(('posixAccount', 'inetOrgPerson')) is account
+    assert isinstance(account.uidNumber, property) and 'uidNumber' in account.must_fields
+    schemata = ldap.schema.SubSchema(entry)
+    dynamic = ObjectClassDict(schemata, AttributeTypeDict(schemata)).compose(
+        ('inetOrgPerson', 'posixAccount'))
+    assert sorted(account.get_field_index()[0]) == sorted(dynamic.get_field_index()[0])
+    assert hasattr(account('uid=a,dc=example,dc=com', {'uid': [b'a']}), '__dict__')
+    source = Generator(entry, compact=True).generate([(('inetOrgPerson', ), 'Person')])
+    exec(compile(source, 'ldap_classes.py', 'exec'), namespace)
+    person = namespace['Person']('uid=a,dc=example,dc=com', {'uid': [b'a']})
+    assert not hasattr(person, '__dict__')
+    assert not hasattr(person.get_attribute('uid'), '__dict__')
+
+
+def test_main_bind_dn():
+    try:
+        main(['--uri', 'ldap://localhost', '--bind-dn', 'cn=admin', 'inetOrgPerson'])
+    except SystemExit as e:
+        assert e.code == 2
+    else:
+        raise AssertionError('--bind-dn without --password-file was accepted')
+
+
+__all__ = ['Generator', 'read_ldif_schema', 'read_server_schema', 'parse_composition',
+           'main', ]
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,201 @@
+# -*- encoding: utf-8
+"""Ploum entry cache
+
+Identity map and cache of entries looked up by DN. Lookups of a DN already
+in the cache return the very same PloumObj without any round-trip to the
+server; DNs that do not exist are remembered too, for a shorter time.
+
+.. code:: python
+
+    cache = EntryCache(maxsize=4096, ttl=60, negative_ttl=10)
+    domain = cache.lookup(Domain, 'dc=example.com,ou=domains,dc=example,dc=com')(conn)
+
+Entries are keyed by normalized DN and requested attributes. Saving or
+deleting an item through save_ldap, delete_ldap or a Session drops every
+cached entry of its DN, and an entry written while it is being looked up
+is not cached.
+
+As with any identity map, the cached instances are shared: changes that are
+not saved are seen by all the users of the cache.
+"""
+
+import logging
+import threading
+
+import ldap
+from ctrmisctk.utils import BoundedCache
+
+from .plumbing import normalize_dn
+from .ploum import register_write_listener
+
+logger = logging.getLogger(__name__)
+
+
+class EntryCache(object):
+    """Cache of PloumObj looked up by DN
+
+    :param maxsize: maximum number of entries kept
+    :param ttl: seconds an entry stays valid, None for forever
+    :param negative_ttl: seconds a missing DN is remembered, 0 not to
+        remember missing DNs
+    :param name: name used to report statistics"""
+    # distinct (class, attributes, operational) lookups cached, other ones
+    # go to the server every time
+    max_shapes = 64
+
+    def __init__(self, maxsize=1024, ttl=300, negative_ttl=30, name='entries'):
+        self.entries = BoundedCache(maxsize=maxsize, ttl=ttl, name=name)
+        self.missing = None
+        if negative_ttl:
+            self.missing = BoundedCache(maxsize=maxsize, ttl=negative_ttl,
+                                        name=name + '.missing')
+        self._shapes = set()
+        # normalized DN → [lookups in progress, invalidations meanwhile]
+        self._fetching = {}
+        self._lock = threading.Lock()
+        register_write_listener(self)
+
+    @staticmethod
+    def _key(cls, dn, attrlist, operational):
+        shape = (cls, None if attrlist is None else tuple(sorted(a.lower() for a in attrlist)),
+                 operational)
+        return normalize_dn(dn), shape
+
+    def lookup(self, cls, dn, attrlist=None, operational=False):
+        """Get an entry by DN, from the cache when possible
+
+        Drop-in replacement for cls.search_all(base_dn=dn, force_full_dn=True)
+
+        :param cls: LDAPHelper or PloumObj class to search with
+        :param dn: DN of the entry
+        :param attrlist: attributes to request, None for all of them
+        :param operational: if True, also request operational attributes
+        :return: callable(ldapconn) that will make a list of zero or one item"""
+        key = self._key(cls, dn, attrlist, operational)
+        search_all = getattr(cls, 'search_all', None) or cls.search_all_ldap
+
+        def search(ldapconn):
+            item = self.entries.get(key)
+            if item is not None:
+                return [item]
+            if self.missing is not None and self.missing.get(key) is not None:
+                return []
+            with self._lock:
+                state = self._fetching.setdefault(key[0], [0, 0])
+                state[0] += 1
+                generation = state[1]
+            try:
+                res = search_all(base_dn=dn, force_full_dn=True, attrlist=attrlist,
+                                 operational=operational)(ldapconn)
+            except ldap.NO_SUCH_OBJECT:
+                res = []
+            finally:
+                with self._lock:
+                    state[0] -= 1
+                    if not state[0]:
+                        del self._fetching[key[0]]
+            with self._lock:
+                if state[1] != generation:
+                    # written meanwhile, what was read may be stale
+                    return res[:1]
+                if key[1] not in self._shapes:
+                    if len(self._shapes) >= self.max_shapes:
+                        return res[:1]
+                    self._shapes.add(key[1])
+                if res:
+                    self.entries.set(key, res[0])
+                elif self.missing is not None:
+                    self.missing.set(key, True)
+            return res[:1]
+        return search
+
+    def invalidate(self, dn):
+        """Drop all the cached entries of a DN
+
+        :param dn: DN of the entry
+        :return: True if something was cached"""
+        ndn = normalize_dn(dn)
+        with self._lock:
+            state = self._fetching.get(ndn)
+            if state is not None:
+                state[1] += 1
+            shapes = list(self._shapes)
+        found = False
+        for shape in shapes:
+            found |= self.entries.invalidate((ndn, shape))
+            if self.missing is not None:
+                found |= self.missing.invalidate((ndn, shape))
+        if found:
+            logger.debug('Invalidated cached entry %s', dn)
+        return found
+
+    def clear(self):
+        """Drop all the cached entries"""
+        self.entries.clear()
+        if self.missing is not None:
+            self.missing.clear()
+
+    def stats(self):
+        """Statistics of the cache
+
+        :return: dict with hits, misses, negative_hits, size and the
+            statistics of the underlying caches"""
+        entries = self.entries.stats()
+        missing = self.missing.stats() if self.missing is not None else None
+        negative_hits = missing['hits'] if missing else 0
+        return dict(hits=entries['hits'] + negative_hits,
+                    misses=entries['misses'] - negative_hits,
+                    negative_hits=negative_hits, size=entries['size'],
+                    entries=entries, missing=missing)
+
+
+def test_entry_cache():
+    from .ploum import notify_write, _test_item
+    item = _test_item()
+    searches = []
+
+    class Entries(object):
+        @staticmethod
+        def search_all(base_dn, **kwargs):
+            def search(ldapconn):
+                searches.append(base_dn)
+                return [item] if base_dn == item.dn else []
+            return search
+
+    cache = EntryCache()
+    assert cache.lookup(Entries, item.dn)(None) == [item]
+    assert cache.lookup(Entries, item.dn.upper())(None)[0] is item
+    assert cache.lookup(Entries, 'uid=nobody,dc=example,dc=com')(None) == []
+    assert cache.lookup(Entries, 'uid=nobody,dc=example,dc=com')(None) == []
+    assert len(searches) == 2 and cache.stats()['negative_hits'] == 1
+    notify_write(item.dn)
+    assert cache.lookup(Entries, item.dn)(None) == [item] and len(searches) == 3
+
+
+def test_entry_cache_write_during_lookup():
+    from .ploum import _test_item
+    item = _test_item()
+    cache = EntryCache()
+    writes = [item.dn]
+
+    class Entries(object):
+        @staticmethod
+        def search_all(base_dn, **kwargs):
+            def search(ldapconn):
+                if base_dn in writes:
+                    # the entry is saved while the lookup reads it
+                    cache.invalidate(writes.pop())
+                return [item]
+            return search
+
+    assert cache.lookup(Entries, item.dn)(None) == [item]
+    assert len(cache.entries) == 0 and not cache._fetching
+    cache.lookup(Entries, item.dn)(None)
+    assert len(cache.entries) == 1
+    cache.max_shapes = 1
+    cache.lookup(Entries, item.dn, attrlist=['cn'])(None)
+    cache.lookup(Entries, item.dn, attrlist=['sn'])(None)
+    assert len(cache._shapes) == 1
+
+
+__all__ = ['EntryCache', ]
@@ -0,0 +1,452 @@
+# -*- encoding: utf-8
+"""Ploum parallel exports
+
+Export a subtree to LDIF or JSON Lines, the subtree being split in
+partitions searched in parallel by a pool of processes, each with its own
+connection.
+
+.. code:: python
+
+    connect = functools.partial(export.connect, 'ldap://localhost',
+                                ('cn=admin,dc=example,dc=com', 'secret'))
+    with export.connect('ldap://localhost', credentials) as conn:
+        partitions = export.partition_by_children(conn, 'ou=people,dc=example,dc=com')
+    stats = export.Exporter(connect, processes=8, fmt='jsonl').export(
+        partitions, '/var/backups/people.jsonl')
+
+Partitions are either the subtrees of the children of an entry
+(partition_by_children, eg. with EmailDomain.local_dn() + base), or
+ranges of values of an attribute (partition_by_prefix, eg. uid=a*,
+uid=b*...).
+
+The output is deterministic, so that two exports can be diffed: inside a
+partition, entries are sorted by DN, parents before their children, and
+values are sorted; partitions are written in the order they were given.
+Each partition is sorted on disk by runs of run_size entries, so memory
+stays bounded whatever the size of the subtree.
+
+JSON Lines records are {"dn": ..., "attributes": {...}}, values being
+LDAPAttribute.portable_value(); values which are not UTF-8 are written as
+{"base64": ...}. Entries whose objectClass is unknown to the schema are
+exported with the raw values of their attributes.
+"""
+
+import base64
+import collections
+import concurrent.futures
+import contextlib
+import heapq
+import io
+import json
+import logging
+import multiprocessing.util
+import os
+import shutil
+import string
+import tempfile
+import time
+
+import ldap
+import ldap.dn
+import ldap.ldapobject
+import ldif
+
+from .filters import escape_value
+from .ldap_utils import get_proper_type, paged_search_pages
+from .ploum import load_schemas
+from .plumbing import normalize_dn
+from .views import decode_value
+
+logger = logging.getLogger(__name__)
+
+FORMATS = ('ldif', 'jsonl')
+
+Partition = collections.namedtuple('Partition', ('name', 'base', 'scope', 'filterstr'))
+PartitionResult = collections.namedtuple(
+    'PartitionResult', ('index', 'path', 'entries', 'bytes', 'duration'))
+ExportStats = collections.namedtuple(
+    'ExportStats', ('partitions', 'done', 'entries', 'bytes', 'duration', 'rate'))
+
+
+@contextlib.contextmanager
+def connect(uri, credentials=None, **kwargs):
+    """Open a connection for an export worker
+
+    Used as a context manager, the connection is closed when it exits.
+
+    :param uri: URI of the LDAP server
+    :param credentials: optional (who, password) tuple to bind with
+    :param kwargs: passed to ReconnectLDAPObject"""
+    conn = ldap.ldapobject.ReconnectLDAPObject(uri, **kwargs)
+    try:
+        if credentials is not None:
+            conn.simple_bind_s(*credentials)
+        yield conn
+    finally:
+        try:
+            conn.unbind_s()
+        except ldap.LDAPError as e:
+            logger.debug('Error while closing connection to %s: %s', uri, e)
+
+
+def dn_sort_key(dn):
+    """Sort key of a DN putting parents before their children
+
+    :param dn: distinguished name
+    :return: list of the normalized RDNs, from the root"""
+    ndn = normalize_dn(dn)
+    try:
+        rdns = ldap.dn.str2dn(ndn)
+    except ldap.DECODING_ERROR:
+        return [ndn]
+    return [ldap.dn.dn2str([rdn]) for rdn in reversed(rdns)]
+
+
+def partition_by_children(ldapconn, base, filterstr='(objectClass=*)'):
+    """Split a subtree by the children of its base
+
+    :param ldapconn: LDAP connection, to list the children
+    :param base: base of the exported subtree
+    :param filterstr: filter of the exported entries
+    :return: list of Partition: the base entry, then the subtree of each
+        child sorted by DN"""
+    children = [dn for (dn, _) in ldapconn.search_ext_s(
+        base, ldap.SCOPE_ONELEVEL, '(objectClass=*)', attrlist=['1.1']) if dn is not None]
+    children.sort(key=dn_sort_key)
+    return [Partition(base, base, ldap.SCOPE_BASE, filterstr)] + [
+        Partition(dn, dn, ldap.SCOPE_SUBTREE, filterstr) for dn in children]
+
+
+def partition_by_prefix(base, attribute='uid', prefixes=string.ascii_lowercase + string.digits,
+                        filterstr='(objectClass=*)'):
+    """Split a subtree by the first characters of the values of an attribute
+
+    Partitions do not overlap: an entry matching several prefixes, such as
+    an entry with several values of the attribute or with prefixes 'a' and
+    'ab', only belongs to the partition of the first prefix it matches. A
+    last partition holds the entries matching none of the prefixes,
+    including the ones without the attribute.
+
+    :param base: base of the exported subtree
+    :param attribute: attribute the partitions are made on
+    :param prefixes: prefixes of the values of each partition
+    :param filterstr: filter of the exported entries
+    :return: list of Partition"""
+    parts = ['({}={}*)'.format(attribute, escape_value(p)) for p in prefixes]
+    res = []
+    for (i, prefix) in enumerate(prefixes):
+        previous = '(!(|{}))'.format(''.join(parts[:i])) if i else ''
+        res.append(Partition('{}={}*'.format(attribute, prefix), base, ldap.SCOPE_SUBTREE,
+                             '(&{}{}{})'.format(filterstr, parts[i], previous)))
+    res.append(Partition('{} (other)'.format(attribute), base, ldap.SCOPE_SUBTREE,
+                         '(&{}(!(|{})))'.format(filterstr, ''.join(parts))))
+    return res
+
+
+def _portable(value):
+    if isinstance(value, bytes):
+        return {'base64': base64.b64encode(value).decode('ascii')}
+    return value
+
+
+def _sorted_values(values):
+    return sorted(values, key=lambda v: json.dumps(v, sort_keys=True))
+
+
+class PartitionExporter(object):
+    """Export partitions of a subtree to sorted files, in a worker
+
+    :param conn: LDAP connection
+    :param fmt: 'ldif' or 'jsonl'
+    :param directory: directory of the partition files
+    :param attrlist: attributes to export, None for all user attributes
+    :param page_size: entries per page of the searches
+    :param run_size: entries sorted in memory at once"""
+
+    def __init__(self, conn, fmt, directory, attrlist=None, page_size=500, run_size=50000):
+        if fmt not in FORMATS:
+            raise ValueError('Unknown export format {}'.format(fmt))
+        self.conn = conn
+        self.fmt = fmt
+        self.directory = directory
+        self.attrlist = attrlist
+        self.page_size = page_size
+        self.run_size = run_size
+        self._types = None
+
+    def types(self):
+        """Object classes of the schema, loaded on first use"""
+        if self._types is None:
+            self._types = load_schemas(self.conn)[0]
+        return self._types
+
+    def render(self, dn, attrs):
+        """Render an entry in the export format
+
+        :param dn: DN of the entry
+        :param attrs: attributes of the entry, as returned by python-ldap
+        :return: str"""
+        if self.fmt == 'ldif':
+            out = io.StringIO()
+            ldif.LDIFWriter(out).unparse(dn, dict(
+                (name, sorted(values)) for (name, values) in attrs.items()))
+            return out.getvalue()
+        try:
+            (fields, _) = get_proper_type(attrs, self.types()).get_field_index()
+        except KeyError as e:
+            logger.warning('Entry %s has no known objectClass (%s), exported with raw values',
+                           dn, e)
+            fields = {}
+        res = {}
+        for (name, values) in attrs.items():
+            field = fields.get(name.lower())
+            value = None
+            if field is not None:
+                name = field[0]
+                attr = field[1]()
+                try:
+                    attr += values
+                    value = attr.portable_value()
+                except UnicodeDecodeError:
+                    pass
+            if value is None:
+                # operational attributes, binary values and unknown classes
+                value = [decode_value(v) for v in values]
+            if isinstance(value, list):
+                value = _sorted_values([_portable(v) for v in value])
+            res[name] = _portable(value)
+        return json.dumps(dict(dn=dn, attributes=res), sort_keys=True,
+                          ensure_ascii=False) + '\n'
+
+    def _write_run(self, run, runs):
+        run.sort(key=lambda r: r[0])
+        (fd, path) = tempfile.mkstemp(prefix='run-', dir=self.directory)
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            for record in run:
+                f.write(json.dumps(record))
+                f.write('\n')
+        runs.append(path)
+
+    def export(self, index, partition):
+        """Export a partition to a file, sorted by DN
+
+        :param index: position of the partition in the export
+        :param partition: Partition
+        :return: PartitionResult"""
+        start = time.perf_counter()
+        attrs = ['*'] if self.attrlist is None else list(self.attrlist) + ['objectClass']
+        runs = []
+        run = []
+        entries = 0
+        try:
+            for page in paged_search_pages(self.conn, partition.base, partition.scope,
+                                           partition.filterstr, attrs, self.page_size):
+                for (dn, entry) in page:
+                    run.append((dn_sort_key(dn), self.render(dn, entry)))
+                entries += len(page)
+                if len(run) >= self.run_size:
+                    self._write_run(run, runs)
+                    run = []
+        except ldap.NO_SUCH_OBJECT:
+            logger.warning('Partition %s: %s does not exist', partition.name, partition.base)
+        path = os.path.join(self.directory, 'partition-{:06d}'.format(index))
+        size = 0
+        files = [open(p, encoding='utf-8') for p in runs]
+        try:
+            run.sort(key=lambda r: r[0])
+            streams = [run] + [(json.loads(line) for line in f) for f in files]
+            with open(path, 'w', encoding='utf-8') as out:
+                for (_, text) in heapq.merge(*streams, key=lambda r: r[0]):
+                    size += out.write(text)
+        finally:
+            for f in files:
+                f.close()
+            for p in runs:
+                os.unlink(p)
+        duration = time.perf_counter() - start
+        logger.debug('Exported partition %s: %d entries in %.2fs', partition.name, entries,
+                     duration)
+        return PartitionResult(index, path, entries, size, duration)
+
+
+# exporter of the current worker process, and the context of its connection
+_worker = None
+_worker_context = contextlib.ExitStack()
+
+
+def _init_worker(connect, fmt, directory, attrlist, page_size, run_size):
+    global _worker
+    # the connection stays open for the life of the worker process, and is
+    # closed by the finalizers run when the process exits
+    conn = _worker_context.enter_context(connect())
+    multiprocessing.util.Finalize(None, _worker_context.close, exitpriority=10)
+    _worker = PartitionExporter(conn, fmt, directory, attrlist, page_size, run_size)
+
+
+def _export_partition(index, partition):
+    return _worker.export(index, partition)
+
+
+class Exporter(object):
+    """Export partitions of a subtree in parallel to a single stream
+
+    :param connect: picklable callable returning a context manager giving a
+        bound connection, eg. functools.partial(connect, uri, credentials)
+    :param processes: number of worker processes, 0 to export in the
+        calling process
+    :param fmt: 'ldif' or 'jsonl'
+    :param attrlist: attributes to export, None for all user attributes
+    :param page_size: entries per page of the searches
+    :param run_size: entries each worker sorts in memory at once
+    :param progress: optional callable(ExportStats, PartitionResult) called
+        after each partition
+    :param mp_context: optional multiprocessing context of the pool"""
+
+    def __init__(self, connect, processes=None, fmt='ldif', attrlist=None, page_size=500,
+                 run_size=50000, progress=None, mp_context=None):
+        if fmt not in FORMATS:
+            raise ValueError('Unknown export format {}'.format(fmt))
+        self.connect = connect
+        self.processes = os.cpu_count() if processes is None else processes
+        self.fmt = fmt
+        self.attrlist = attrlist
+        self.page_size = page_size
+        self.run_size = run_size
+        self.progress = progress
+        self.mp_context = mp_context
+
+    def _results(self, partitions, directory):
+        """Export the partitions, yielding PartitionResult as they finish"""
+        args = (self.fmt, directory, self.attrlist, self.page_size, self.run_size)
+        if not self.processes:
+            with self.connect() as conn:
+                worker = PartitionExporter(conn, *args)
+                for (index, partition) in enumerate(partitions):
+                    yield worker.export(index, partition)
+            return
+        with concurrent.futures.ProcessPoolExecutor(
+                self.processes, mp_context=self.mp_context, initializer=_init_worker,
+                initargs=(self.connect, ) + args) as pool:
+            futures = [pool.submit(_export_partition, index, partition)
+                       for (index, partition) in enumerate(partitions)]
+            try:
+                for future in concurrent.futures.as_completed(futures):
+                    yield future.result()
+            finally:
+                for future in futures:
+                    future.cancel()
+
+    def export(self, partitions, output):
+        """Export partitions
+
+        Partition files are appended to the output in the order of the
+        partitions, as soon as all the previous ones are written.
+
+        :param partitions: list of Partition
+        :param output: path of the output file, or text file object
+        :return: ExportStats"""
+        partitions = list(partitions)
+        start = time.perf_counter()
+        entries = size = done = 0
+        pending = {}
+        position = 0
+        with contextlib.ExitStack() as stack:
+            if isinstance(output, (str, bytes, os.PathLike)):
+                output = stack.enter_context(open(output, 'w', encoding='utf-8'))
+            directory = stack.enter_context(tempfile.TemporaryDirectory(prefix='ploum-export-'))
+            for result in self._results(partitions, directory):
+                done += 1
+                entries += result.entries
+                size += result.bytes
+                pending[result.index] = result
+                while position in pending:
+                    path = pending.pop(position).path
+                    with open(path, encoding='utf-8') as f:
+                        shutil.copyfileobj(f, output)
+                    os.unlink(path)
+                    position += 1
+                stats = self._stats(len(partitions), done, entries, size, start)
+                logger.info('Exported partition %s: %d entries; %d/%d partitions, '
+                            '%d entries, %.0f entries/s',
+                            partitions[result.index].name, result.entries,
+                            done, len(partitions), entries, stats.rate)
+                if self.progress is not None:
+                    self.progress(stats, result)
+        return self._stats(len(partitions), done, entries, size, start)
+
+    @staticmethod
+    def _stats(partitions, done, entries, size, start):
+        duration = time.perf_counter() - start
+        return ExportStats(partitions, done, entries, size, duration,
+                           entries / duration if duration else 0.0)
+
+
+class _TestConnect(object):
+    """Picklable connect callable over a fake server, marking closed connections"""
+
+    def __init__(self, entries, directory):
+        self.entries = entries
+        self.directory = directory
+
+    @contextlib.contextmanager
+    def __call__(self):
+        from benchmarks.fakeldap import FakeLDAPObject
+        try:
+            yield FakeLDAPObject(self.entries)
+        finally:
+            open(os.path.join(self.directory, 'closed-{}'.format(os.getpid())), 'w').close()
+
+
+def _test_entries(reverse=False):
+    from .ldap_utils import _test_directory
+    conn = _test_directory(7)
+    conn.add_s('cn=printer,ou=people,dc=example,dc=com',
+               [('objectClass', [b'x-printer']), ('cn', [b'printer'])])
+    entries = [(dn, dict((k, sorted(v, reverse=reverse)) for (k, v) in attrs.items()))
+               for (dn, attrs, _) in conn.entries.values()]
+    return dict(reversed(entries) if reverse else entries)
+
+
+def test_partition_export():
+    from benchmarks.fakeldap import FakeLDAPObject
+    partition = Partition('people', 'ou=people,dc=example,dc=com', ldap.SCOPE_SUBTREE,
+                          '(objectClass=*)')
+    outputs = []
+    for reverse in (False, True):
+        with tempfile.TemporaryDirectory() as directory:
+            # runs of 3 entries over pages of 2, merged from disk
+            worker = PartitionExporter(FakeLDAPObject(_test_entries(reverse)), 'jsonl',
+                                       directory, page_size=2, run_size=3)
+            result = worker.export(0, partition)
+            assert os.listdir(directory) == ['partition-000000'] and result.entries == 9
+            with open(result.path, encoding='utf-8') as f:
+                outputs.append([json.loads(line) for line in f])
+    # the same entries exported in another order give the same file
+    assert outputs[0] == outputs[1]
+    dns = [r['dn'] for r in outputs[0]]
+    assert dns[0] == 'ou=people,dc=example,dc=com' and dns == sorted(dns, key=dn_sort_key)
+    printer = next(r for r in outputs[0] if r['dn'].startswith('cn=printer'))
+    assert printer['attributes'] == {'objectClass': ['x-printer'], 'cn': ['printer']}
+
+
+def test_export():
+    with tempfile.TemporaryDirectory() as directory:
+        connect = _TestConnect(_test_entries(), directory)
+        with connect() as conn:
+            partitions = partition_by_children(conn, 'ou=people,dc=example,dc=com')
+        single = io.StringIO()
+        Exporter(connect, processes=0, fmt='jsonl').export(partitions, single)
+        output = os.path.join(directory, 'people.jsonl')
+        stats = Exporter(connect, processes=2, fmt='jsonl', run_size=2).export(
+            partitions, output)
+        assert stats.entries == 9 and stats.done == len(partitions)
+        with open(output, encoding='utf-8') as f:
+            assert f.read() == single.getvalue()
+        # the connection of each worker process is closed when it exits
+        closed = [n for n in os.listdir(directory) if n.startswith('closed-')]
+        assert set(closed) - {'closed-{}'.format(os.getpid())}
+
+
+__all__ = ['Exporter', 'PartitionExporter', 'Partition', 'PartitionResult', 'ExportStats',
+           'connect', 'partition_by_children', 'partition_by_prefix', 'dn_sort_key',
+           'FORMATS', ]
@@ -0,0 +1,207 @@
+# -*- encoding: utf-8
+"""Ploum fan-out searches
+
+Run several searches at once and merge their results as they come, so that
+a request searching many subtrees waits for the slowest search instead of
+the sum of them.
+
+.. code:: python
+
+    specs = [(Mailbox, ou, dict(active='TRUE')) for ou in customer_ous]
+    for mailbox in fan_out(specs, pool, dedup=True, deadline=2.0):
+        ...
+
+    async for mailbox in fan_out_async(specs, conn, deadline=2.0):
+        ...
+
+Searches are either callables as returned by search_all_ldap or search_all,
+or (class, base_dn, criteria) specs, searched with the search_all of the
+class if it has one. fan_out runs them in threads, each search on its own
+connection of a LDAPConnectionPool; fan_out_async sends them all on one
+connection and awaits them with the message-id API (the callables must then
+come from search_all_ldap_async or search_all_async).
+
+Past the deadline, searches that did not finish, or could not check out a
+connection of the pool, are dropped and FanOutTimeout is raised, or the merge just stops if partial is set.
+Asynchronous searches are abandoned on the server; threads cannot be
+interrupted, their results are discarded when they finish.
+"""
+
+import asyncio
+import concurrent.futures
+import logging
+import threading
+import time
+import types
+
+from ldap.ldapobject import LDAPError
+
+from .ldap_utils import PoolTimeout
+from .plumbing import normalize_dn
+
+logger = logging.getLogger(__name__)
+
+
+class FanOutTimeout(LDAPError):
+    """Some searches of a fan-out did not finish before the deadline"""
+
+
+def _search_callable(search, asynchronous=False):
+    """Callable of a search given as a callable or a (cls, base_dn, criteria) spec"""
+    if callable(search):
+        return search
+    (cls, base_dn, criteria) = search
+    if asynchronous:
+        make = getattr(cls, 'search_all_async', None) or cls.search_all_ldap_async
+    else:
+        make = getattr(cls, 'search_all', None) or cls.search_all_ldap
+    return make(base_dn=base_dn, **(criteria or {}))
+
+
+class _Merger(object):
+    """Merge the results of searches, dropping DNs already seen if dedup"""
+
+    def __init__(self, dedup):
+        self.seen = set() if dedup else None
+
+    def __call__(self, results):
+        if self.seen is None:
+            yield from results
+            return
+        for item in results:
+            key = normalize_dn(item.dn)
+            if key not in self.seen:
+                self.seen.add(key)
+                yield item
+
+
+def _expired(pending, deadline, partial):
+    message = '{} searches did not finish in {}s'.format(pending, deadline)
+    if not partial:
+        raise FanOutTimeout(message)
+    logger.warning('Fan-out: %s', message)
+
+
+def fan_out(searches, pool, workers=None, dedup=False, deadline=None, partial=False):
+    """Run searches concurrently in threads, each on a connection of a pool
+
+    :param searches: list of search callables or (cls, base_dn, criteria)
+    :param pool: LDAPConnectionPool the connections are checked out of
+    :param workers: number of searches run at once, defaults to all of them
+    :param dedup: if True, yield each DN once
+    :param deadline: optional seconds allowed for all the searches
+    :param partial: if True, stop at the deadline instead of raising
+        FanOutTimeout
+    :return: generator of items, in the order searches finish"""
+    searches = [_search_callable(s) for s in searches]
+    if not searches:
+        return
+    end = None if deadline is None else time.monotonic() + deadline
+    merge = _Merger(dedup)
+
+    def run(search):
+        timeout = None if end is None else max(end - time.monotonic(), 0)
+        try:
+            with pool.connection(timeout=timeout) as conn:
+                res = search(conn)
+                # consume generators before the connection is checked in
+                return res if isinstance(res, list) else list(res)
+        except PoolTimeout as e:
+            raise FanOutTimeout('no connection before the deadline: {}'.format(e)) from e
+
+    executor = concurrent.futures.ThreadPoolExecutor(workers or len(searches))
+    futures = [executor.submit(run, s) for s in searches]
+    try:
+        timeout = None if end is None else max(end - time.monotonic(), 0)
+        for future in concurrent.futures.as_completed(futures, timeout):
+            try:
+                results = future.result()
+            except FanOutTimeout as e:
+                if not partial:
+                    raise
+                logger.warning('Fan-out: %s', e)
+                continue
+            yield from merge(results)
+    except concurrent.futures.TimeoutError:
+        _expired(sum(1 for f in futures if not f.done()), deadline, partial)
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+async def fan_out_async(searches, ldapconn, dedup=False, deadline=None, partial=False):
+    """Run searches concurrently on a connection, from a coroutine
+
+    :param searches: list of async search callables or (cls, base_dn, criteria)
+    :param ldapconn: LDAP connection
+    :param dedup: if True, yield each DN once
+    :param deadline: optional seconds allowed for all the searches
+    :param partial: if True, stop at the deadline instead of raising
+        FanOutTimeout
+    :return: async generator of items, in the order searches finish"""
+    tasks = [asyncio.ensure_future(_search_callable(s, asynchronous=True)(ldapconn))
+             for s in searches]
+    if not tasks:
+        return
+    merge = _Merger(dedup)
+    try:
+        for next_done in asyncio.as_completed(tasks, timeout=deadline):
+            for item in merge(await next_done):
+                yield item
+    except asyncio.TimeoutError:
+        _expired(sum(1 for t in tasks if not t.done()), deadline, partial)
+    finally:
+        for task in tasks:
+            # cancelled searches are abandoned by the result dispatcher
+            task.cancel()
+
+
+def test_fan_out():
+    from .ldap_utils import _TestPool
+
+    class ExhaustedPool(_TestPool):
+        """Pool running out of connections after some checkouts"""
+        available = 1
+
+        def checkout(self, credentials=None, timeout=-1):
+            with self._cond:
+                if not self.available:
+                    raise PoolTimeout('No LDAP connection available to {}'.format(self.uri))
+                self.available -= 1
+            return super().checkout(credentials, timeout)
+
+    def found(*dns):
+        return lambda conn: [types.SimpleNamespace(dn=dn) for dn in dns]
+
+    searches = [found('uid=a,dc=example,dc=com', 'uid=b,dc=example,dc=com'),
+                found('UID=A,dc=example,dc=com')]
+    assert len(list(fan_out(searches, _TestPool('ldap://localhost', max_size=1),
+                            dedup=True, deadline=5))) == 2
+    # a checkout running out of time is a fan-out timeout
+    try:
+        list(fan_out(searches, ExhaustedPool('ldap://localhost'), workers=1, deadline=5))
+    except FanOutTimeout:
+        pass
+    else:
+        assert False, 'the checkout timeout must be a FanOutTimeout'
+    partial = list(fan_out(searches, ExhaustedPool('ldap://localhost'),
+                           workers=1, deadline=5, partial=True))
+    assert [i.dn for i in partial] == ['uid=a,dc=example,dc=com', 'uid=b,dc=example,dc=com']
+    # a search outliving the deadline
+    release = threading.Event()
+
+    def stuck(conn):
+        release.wait(5)
+        return []
+    pool = _TestPool('ldap://localhost')
+    try:
+        list(fan_out([searches[0], stuck], pool, deadline=0.1))
+    except FanOutTimeout:
+        pass
+    else:
+        assert False, 'the stuck search must time out'
+    partial = list(fan_out([searches[0], stuck], pool, deadline=0.1, partial=True))
+    release.set()
+    assert len(partial) == 2
+
+
+__all__ = ['fan_out', 'fan_out_async', 'FanOutTimeout', ]
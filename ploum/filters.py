@@ -0,0 +1,647 @@
+# -*- encoding: utf-8
+"""Ploum filters
+
+Build LDAP search filters (RFC 4515) from Python expressions instead of
+formatting strings. Values are always escaped.
+
+.. code:: python
+
+    from ploum.filters import Attr, Param
+
+    expr = (Attr('mail').endswith('@example.com') &
+            (Attr('uidNumber') >= 1000) &
+            ~Attr('description').present())
+    EmailUser.search_all(base_dn='dc=example,dc=com', filterstr=expr)
+
+    # templates are compiled once, then rendered with bound parameters
+    by_uid = Attr('uid') == Param('uid')
+    EmailUser.search_all(base_dn='dc=example,dc=com', filterstr=by_uid,
+                         filter_params={'uid': 'jdoe'})
+
+Expressions are checked against the schema when compiled: the attributes
+must exist and have the matching rule the assertion relies on (EQUALITY,
+SUBSTR or ORDERING).
+
+Filter strings can be parsed back into expressions with parse_filter, and
+expressions can be evaluated against PloumObj items with matches(), which
+follows the matching rules of the attributes.
+"""
+
+import logging
+import re
+
+import ldap.filter
+from ctrmisctk.utils import debyte, is_scalar, slacker_cacher_decorator
+
+from .plumbing import matching_key
+
+logger = logging.getLogger(__name__)
+
+
+class FilterError(ValueError):
+    """A filter expression cannot be used with the schema"""
+
+
+class Param(object):
+    """Placeholder for a value bound when the filter is rendered
+
+    :param name: name of the parameter"""
+    __slots__ = ('name', )
+
+    def __init__(self, name):
+        self.name = name
+
+    def __eq__(self, other):
+        return isinstance(other, Param) and other.name == self.name
+
+    def __hash__(self):
+        return hash((Param, self.name))
+
+    def __repr__(self):
+        return 'Param({!r})'.format(self.name)
+
+
+def escape_value(value):
+    """Escape an assertion value (RFC 4515)
+
+    :param value: str, bytes or int
+    :return: escaped str"""
+    if isinstance(value, bytes):
+        try:
+            value = value.decode('utf-8')
+        except UnicodeDecodeError:
+            return ''.join('\\{:02x}'.format(c) for c in value)
+    return ldap.filter.escape_filter_chars(str(value))
+
+
+_ESCAPED = re.compile(rb'\\([0-9a-fA-F]{2})')
+
+
+def unescape_value(value):
+    """Unescape an assertion value (RFC 4515)
+
+    :param value: escaped str
+    :return: str, or bytes if the value is not UTF-8"""
+    if '\\' not in value:
+        return value
+    raw = _ESCAPED.sub(lambda m: bytes((int(m.group(1), 16), )), value.encode('utf-8'))
+    try:
+        return raw.decode('utf-8')
+    except UnicodeDecodeError:
+        return raw
+
+
+def _bound(value, params):
+    """Value of an assertion as str, Param placeholders replaced"""
+    if isinstance(value, Param):
+        if not params or value.name not in params:
+            raise FilterError('Missing filter parameter: {}'.format(value.name))
+        value = params[value.name]
+    value = debyte(value)
+    return value if isinstance(value, str) else str(value)
+
+
+def _item_values(item, name, rule):
+    """Values of an attribute of an item, and the key of one of its matching rules
+
+    :param item: PloumObj
+    :param name: name of the attribute
+    :param rule: 'equality', 'ordering' or 'substring'
+    :return: tuple (values, key function)"""
+    attr = item.get_attribute(name.lower())
+    if attr is None or attr.value is None:
+        return (), None
+    values = (attr.value, ) if is_scalar(attr.value) else tuple(attr.value)
+    return (tuple(_bound(v, None) for v in values),
+            matching_key(attr.properties.get(rule)) or (lambda v: v))
+
+
+class Filter(object):
+    """Base class of filter expressions
+
+    Expressions are immutable and hashable; compose them with & | ~"""
+    __slots__ = ('args', )
+
+    def __init__(self, *args):
+        self.args = args
+
+    def __and__(self, other):
+        return And(self, other)
+
+    def __or__(self, other):
+        return Or(self, other)
+
+    def __invert__(self):
+        return Not(self)
+
+    def __eq__(self, other):
+        # 1 == True == 1.0, but they are not rendered the same way
+        return (type(other) is type(self) and other.args == self.args and
+                all(type(a) is type(b) for (a, b) in zip(self.args, other.args)))
+
+    def __hash__(self):
+        return hash((type(self), self.args))
+
+    def __repr__(self):
+        return '{}{!r}'.format(self.__class__.__name__, self.args)
+
+    def parts(self, attr_types):
+        """Build the parts of the filter: strings and Param placeholders
+
+        :param attr_types: mapping of attribute names to attribute classes,
+            or None not to check the schema
+        :return: list"""
+        raise NotImplementedError
+
+    def matches(self, item, params=None):
+        """Evaluate the filter against an item
+
+        :param item: PloumObj
+        :param params: values of the Param placeholders
+        :return: bool"""
+        raise NotImplementedError
+
+    def __str__(self):
+        return compile_filter(self).render()
+
+
+class _Composite(Filter):
+    __slots__ = ()
+    op = None
+
+    def __init__(self, *filters):
+        flat = []
+        for f in filters:
+            # (a & b) & c → (&abc)
+            if type(f) is type(self):
+                flat.extend(f.args)
+            else:
+                flat.append(f)
+        super().__init__(*flat)
+
+    def parts(self, attr_types):
+        res = ['(' + self.op]
+        for f in self.args:
+            res.extend(f.parts(attr_types))
+        res.append(')')
+        return res
+
+
+class And(_Composite):
+    """All the filters must match"""
+    __slots__ = ()
+    op = '&'
+
+    def matches(self, item, params=None):
+        return all(f.matches(item, params) for f in self.args)
+
+
+class Or(_Composite):
+    """Any of the filters must match"""
+    __slots__ = ()
+    op = '|'
+
+    def matches(self, item, params=None):
+        return any(f.matches(item, params) for f in self.args)
+
+
+class Not(Filter):
+    """The filter must not match"""
+    __slots__ = ()
+
+    def parts(self, attr_types):
+        return ['(!'] + self.args[0].parts(attr_types) + [')']
+
+    def matches(self, item, params=None):
+        return not self.args[0].matches(item, params)
+
+
+_RULE_KEYWORDS = dict(equality='EQUALITY', ordering='ORDERING', substring='SUBSTR')
+
+
+def _value(value):
+    return value if isinstance(value, Param) else escape_value(value)
+
+
+class _Assertion(Filter):
+    """Assertion on an attribute: (attr OP value)"""
+    __slots__ = ()
+    op = '='
+    rule = None
+
+    def check(self, attr_types):
+        attr = self.args[0]
+        if attr_types is None:
+            return
+        if attr not in attr_types:
+            raise FilterError('Unknown attribute {} in filter'.format(attr))
+        if self.rule and not attr_types[attr].properties.get(self.rule):
+            raise FilterError('Attribute {} has no {} matching rule'.format(
+                attr, _RULE_KEYWORDS[self.rule]))
+
+    def parts(self, attr_types):
+        self.check(attr_types)
+        return ['({}{}'.format(self.args[0], self.op), _value(self.args[1]), ')']
+
+    def matches(self, item, params=None):
+        (values, key) = _item_values(item, self.args[0], self.rule or 'equality')
+        wanted = key(_bound(self.args[1], params)) if values else None
+        for v in values:
+            try:
+                if self.compare(key(v), wanted):
+                    return True
+            except TypeError:
+                # values not comparable with the assertion, eg. int and str
+                continue
+        return False
+
+    @staticmethod
+    def compare(value, wanted):
+        return value == wanted
+
+
+class Equal(_Assertion):
+    """(attr=value)"""
+    __slots__ = ()
+    rule = 'equality'
+
+
+class Approx(_Assertion):
+    """(attr~=value)"""
+    __slots__ = ()
+    op = '~='
+
+
+class GreaterOrEqual(_Assertion):
+    """(attr>=value)"""
+    __slots__ = ()
+    op = '>='
+    rule = 'ordering'
+
+    @staticmethod
+    def compare(value, wanted):
+        return value >= wanted
+
+
+class LessOrEqual(_Assertion):
+    """(attr<=value)"""
+    __slots__ = ()
+    op = '<='
+    rule = 'ordering'
+
+    @staticmethod
+    def compare(value, wanted):
+        return value <= wanted
+
+
+class Present(_Assertion):
+    """(attr=*)"""
+    __slots__ = ()
+
+    def parts(self, attr_types):
+        self.check(attr_types)
+        return ['({}=*)'.format(self.args[0])]
+
+    def matches(self, item, params=None):
+        return bool(_item_values(item, self.args[0], 'equality')[0])
+
+
+class Substring(_Assertion):
+    """(attr=initial*any*...*final)
+
+    :param attr: attribute name
+    :param initial: optional start of the value
+    :param any: tuple of substrings to find in order
+    :param final: optional end of the value"""
+    __slots__ = ()
+    rule = 'substring'
+
+    def __init__(self, attr, initial=None, any=(), final=None):
+        super().__init__(attr, initial, tuple(any), final)
+
+    def parts(self, attr_types):
+        self.check(attr_types)
+        (attr, initial, middle, final) = self.args
+        res = ['({}='.format(attr)]
+        if initial is not None:
+            res.append(_value(initial))
+        res.append('*')
+        for i in middle:
+            res.extend((_value(i), '*'))
+        if final is not None:
+            res.append(_value(final))
+        res.append(')')
+        return res
+
+    def matches(self, item, params=None):
+        (attr, initial, middle, final) = self.args
+        (values, key) = _item_values(item, attr, 'substring')
+        if not values:
+            return False
+        initial = key(_bound(initial, params)) if initial is not None else ''
+        final = key(_bound(final, params)) if final is not None else ''
+        middle = [key(_bound(i, params)) for i in middle]
+        for v in values:
+            v = str(key(v))
+            if not v.startswith(initial):
+                continue
+            pos = len(initial)
+            for i in middle:
+                pos = v.find(i, pos)
+                if pos < 0:
+                    break
+                pos += len(i)
+            if pos >= 0 and len(v) - len(final) >= pos and v.endswith(final):
+                return True
+        return False
+
+
+class Extensible(_Assertion):
+    """(attr:dn:rule:=value)
+
+    :param attr: attribute name, may be None when a rule is given
+    :param value: assertion value
+    :param rule: optional matching rule name or OID
+    :param dn: if True, also match the attributes of the DN"""
+    __slots__ = ()
+
+    def __init__(self, attr, value, rule=None, dn=False):
+        if attr is None and rule is None:
+            raise FilterError('Extensible match needs an attribute or a rule')
+        super().__init__(attr, value, rule, dn)
+
+    def parts(self, attr_types):
+        (attr, value, rule, dn) = self.args
+        if attr is not None:
+            self.check(attr_types)
+        return ['({}{}{}:='.format(attr or '', ':dn' if dn else '',
+                                   ':' + rule if rule else ''),
+                _value(value), ')']
+
+    def matches(self, item, params=None):
+        raise FilterError('Extensible match cannot be evaluated locally')
+
+
+class Attr(object):
+    """Filter builder for an attribute
+
+    Attr('uid') == 'jdoe', Attr('cn').startswith('Jo'), Attr('uidNumber') >= 1000
+
+    :param name: attribute name"""
+    __slots__ = ('name', )
+    __hash__ = None
+
+    def __init__(self, name):
+        self.name = name
+
+    def __eq__(self, value):
+        return Equal(self.name, value)
+
+    def __ne__(self, value):
+        return Not(Equal(self.name, value))
+
+    def __ge__(self, value):
+        return GreaterOrEqual(self.name, value)
+
+    def __le__(self, value):
+        return LessOrEqual(self.name, value)
+
+    def approx(self, value):
+        return Approx(self.name, value)
+
+    def present(self):
+        return Present(self.name)
+
+    def startswith(self, value):
+        return Substring(self.name, initial=value)
+
+    def endswith(self, value):
+        return Substring(self.name, final=value)
+
+    def contains(self, *values):
+        return Substring(self.name, any=values)
+
+    def match(self, value, rule=None, dn=False):
+        return Extensible(self.name, value, rule, dn)
+
+
+class CompiledFilter(object):
+    """A filter template, rendered with parameters
+
+    :param parts: strings (already escaped) and Param placeholders"""
+    __slots__ = ('parts', 'params')
+
+    def __init__(self, parts):
+        merged = []
+        for p in parts:
+            if merged and isinstance(p, str) and isinstance(merged[-1], str):
+                merged[-1] += p
+            else:
+                merged.append(p)
+        self.parts = tuple(merged)
+        self.params = frozenset(p.name for p in merged if isinstance(p, Param))
+
+    def render(self, params=None):
+        """Render the filter string
+
+        :param params: dict of the values of the Param placeholders
+        :return: str"""
+        if not self.params:
+            return self.parts[0] if self.parts else ''
+        params = params or {}
+        missing = self.params - set(params)
+        if missing:
+            raise FilterError('Missing filter parameters: {}'.format(', '.join(sorted(missing))))
+        return ''.join(p if isinstance(p, str) else escape_value(params[p.name])
+                       for p in self.parts)
+
+
+@slacker_cacher_decorator(maxsize=512)
+def compile_filter(expr, attr_types=None):
+    """Compile a filter expression into a reusable template
+
+    :param expr: Filter expression
+    :param attr_types: mapping of attribute names to attribute classes to
+        check the expression against, None not to check it
+    :return: CompiledFilter"""
+    return CompiledFilter(expr.parts(attr_types))
+
+
+def _parse_assertion(text):
+    """Parse the inside of a simple filter: attr OP value"""
+    idx = text.find('=')
+    if idx <= 0:
+        raise FilterError('Invalid filter item: {}'.format(text))
+    (attr, value) = (text[:idx], text[idx + 1:])
+    if attr.endswith('~'):
+        return Approx(attr[:-1], unescape_value(value))
+    if attr.endswith('>'):
+        return GreaterOrEqual(attr[:-1], unescape_value(value))
+    if attr.endswith('<'):
+        return LessOrEqual(attr[:-1], unescape_value(value))
+    if attr.endswith(':'):
+        parts = attr[:-1].split(':')
+        dn = any(p.lower() == 'dn' for p in parts[1:])
+        rules = [p for p in parts[1:] if p.lower() != 'dn']
+        return Extensible(parts[0] or None, unescape_value(value),
+                          rules[0] if rules else None, dn)
+    if value == '*':
+        return Present(attr)
+    if '*' in value:
+        pieces = [unescape_value(p) for p in value.split('*')]
+        return Substring(attr, initial=pieces[0] or None,
+                         any=[p for p in pieces[1:-1] if p], final=pieces[-1] or None)
+    return Equal(attr, unescape_value(value))
+
+
+def _parse(text, pos):
+    """Parse the filter starting at pos
+
+    :return: tuple (Filter, position after the filter)"""
+    if text[pos] != '(':
+        raise FilterError('Expected ( at {} in {}'.format(pos, text))
+    pos += 1
+    op = text[pos]
+    if op in '&|':
+        pos += 1
+        filters = []
+        while text[pos] == '(':
+            (f, pos) = _parse(text, pos)
+            filters.append(f)
+        res = And(*filters) if op == '&' else Or(*filters)
+    elif op == '!':
+        (f, pos) = _parse(text, pos + 1)
+        res = Not(f)
+    else:
+        end = text.index(')', pos)
+        res = _parse_assertion(text[pos:end])
+        pos = end
+    if text[pos] != ')':
+        raise FilterError('Expected ) at {} in {}'.format(pos, text))
+    return res, pos + 1
+
+
+@slacker_cacher_decorator(maxsize=512)
+def parse_filter(filterstr):
+    """Parse a filter string into an expression
+
+    :param filterstr: filter string (RFC 4515)
+    :return: Filter"""
+    text = filterstr.strip()
+    if not text.startswith('('):
+        text = '(' + text + ')'
+    try:
+        (res, pos) = _parse(text, 0)
+    except FilterError:
+        raise
+    except (IndexError, ValueError):
+        raise FilterError('Invalid filter: {}'.format(filterstr)) from None
+    if pos != len(text):
+        raise FilterError('Trailing characters in filter: {}'.format(filterstr))
+    return res
+
+
+def criteria_filter(criteria):
+    """Build the filter expression ANDing equality criteria
+
+    The values are Param placeholders named after the attributes, so that
+    searches on the same attributes share one compiled template.
+
+    :param criteria: dict attribute name → value
+    :return: tuple (Filter, dict of the values of its parameters), (None,
+        None) if there are no criteria"""
+    if not criteria:
+        return None, None
+    return And(*(Equal(k, Param(k)) for k in criteria)), dict(criteria)
+
+
+def test_escape_value():
+    assert escape_value('a*(b)\\') == 'a\\2a\\28b\\29\\5c'
+    assert unescape_value(escape_value('a*(b)\\')) == 'a*(b)\\'
+    assert escape_value(b'\xff') == '\\ff' and unescape_value('\\ff') == b'\xff'
+
+
+def test_compile_filter():
+    from .ploum import _test_item
+    attr_types = _test_item().attr_types
+    expr = (Attr('mail').endswith('@example.com') & (Attr('uid') == Param('uid'))) | \
+        ~Attr('cn').present()
+    compiled = compile_filter(expr, attr_types)
+    assert compiled.params == {'uid'}
+    assert compiled.render({'uid': 'j*'}) == '(|(&(mail=*@example.com)(uid=j\\2a))(!(cn=*)))'
+    # templates are cached by expression
+    same = (Attr('mail').endswith('@example.com') & (Attr('uid') == Param('uid'))) | \
+        ~Attr('cn').present()
+    assert compile_filter(same, attr_types) is compiled
+    for bad in (Attr('noSuchAttribute') == 'x', Attr('audio') == 'x', Attr('cn') >= 'x'):
+        try:
+            compile_filter(bad, attr_types)
+        except FilterError:
+            pass
+        else:
+            assert False, '{!r} must not compile'.format(bad)
+    try:
+        compiled.render()
+    except FilterError:
+        pass
+    else:
+        assert False, 'rendering without parameters must fail'
+
+
+def test_criteria_filter():
+    from .ploum import _test_item
+    cls = type(_test_item())
+    (_, _, filterstr) = cls._search_params('dc=example,dc=com', ldap.SCOPE_SUBTREE, None,
+                                           False, {'mail': 'j*'})
+    assert filterstr == '(&(&(mail=j\\2a))(objectClass=*))'
+    # keyword searches on the same attributes share one template
+    compiled = compile_filter(criteria_filter({'mail': 'x', 'cn': 'y'})[0], cls.attr_types)
+    assert compile_filter(criteria_filter({'mail': 'z', 'cn': 'w'})[0],
+                          cls.attr_types) is compiled
+    assert compiled.render(criteria_filter({'mail': 'z', 'cn': 'w'})[1]) == \
+        '(&(mail=z)(cn=w))'
+    # values equal in Python but rendered differently do not share one
+    assert compile_filter(Equal('uidNumber', 1)).render() == '(uidNumber=1)'
+    assert compile_filter(Equal('uidNumber', True)).render() == '(uidNumber=True)'
+    try:
+        cls._search_params('dc=example,dc=com', ldap.SCOPE_SUBTREE, None, False,
+                           {'noSuchAttribute': 'x'})
+    except FilterError:
+        pass
+    else:
+        assert False, 'unknown attributes must be refused'
+
+
+def test_parse_filter():
+    text = '(&(objectClass=person)(|(uid=j\\2a)(cn=Jo*h*n))(!(mail=*))(uidNumber>=1000))'
+    expr = parse_filter(text)
+    assert expr == And(Equal('objectClass', 'person'),
+                       Or(Equal('uid', 'j*'), Substring('cn', 'Jo', ['h'], 'n')),
+                       Not(Present('mail')), GreaterOrEqual('uidNumber', '1000'))
+    assert str(expr) == text
+    assert parse_filter('uid=jdoe') == Equal('uid', 'jdoe')
+    for bad in ('(uid=jdoe', '(&(uid=jdoe))x', '(=jdoe)'):
+        try:
+            parse_filter(bad)
+        except FilterError:
+            pass
+        else:
+            assert False, '{} must not parse'.format(bad)
+
+
+def test_matches():
+    from .ploum import _test_item
+    item = _test_item()
+    # matching rules: caseIgnoreIA5 for mail, caseIgnore (spaces folded) for cn
+    assert Attr('mail').endswith('@EXAMPLE.com').matches(item)
+    assert (Attr('cn') == 'john  DOE').matches(item)
+    assert Attr('cn').contains('hn', 'do').matches(item)
+    assert not (Attr('uid') == 'jdoe').matches(item)
+    assert (~Attr('uid').present() & (Attr('sn') == Param('sn'))).matches(item, {'sn': 'doe'})
+    assert parse_filter('(|(uid=x)(mail=john@example.com))').matches(item)
+
+
+__all__ = ['Filter', 'And', 'Or', 'Not', 'Equal', 'Approx', 'GreaterOrEqual',
+           'LessOrEqual', 'Present', 'Substring', 'Extensible', 'Attr', 'Param',
+           'CompiledFilter', 'FilterError', 'compile_filter', 'criteria_filter',
+           'escape_value', 'unescape_value', 'parse_filter', ]
@@ -57,16 +57,64 @@ class LDAPHelper(object):
     def search_all(cls, **kwargs):
         d = cls()
         def search(conn):
-            return [cls(a) for a in d.search_all_ldap(**kwargs)(conn)]
+            res = d.search_all_ldap(**kwargs)(conn)
+            if kwargs.get('view'):
+                return res
+            return [cls(a) for a in res]
+        return search
+
+    @classmethod
+    def search_all_async(cls, **kwargs):
+        """Coroutine version of search_all
+
+        :return: async callable(ldapconn) that will make a list of matches"""
+        async def search(conn):
+            return [cls(a) for a in await cls.search_all_ldap_async(**kwargs)(conn)]
+        return search
+
+    @classmethod
+    def search_iter(cls, page_size=500, **kwargs):
+        """Generator version of search_all, using a paged search
+
+        :param page_size: number of entries requested per page
+        :return: callable(ldapconn) that will make a generator of matches"""
+        def search(conn):
+            res = cls.search_iter_ldap(page_size=page_size, **kwargs)(conn)
+            if kwargs.get('view'):
+                yield from res
+                return
+            for a in res:
+                yield cls(a)
         return search
 
     def __init__(self, obj=None):
         super(LDAPHelper, self).__init__()
         if isinstance(obj, ploum.PloumObj):
             # eat the attributes of this PloumObj.
-            self.__dict__.update(obj.__dict__)
+            for i in ploum.PloumObj.state_slots:
+                setattr(self, i, getattr(obj, i))
+            self.__dict__.update(getattr(obj, '__dict__', {}))
         self._pk = dict(dn=self.dn)
         self._mode = 'normal'
 
 
+def test_search_iter():
+    from .ldap_utils import _test_directory
+    from .ploum import _test_item
+
+    class Person(LDAPHelper, type(_test_item())):
+        OBJECT_CLASSES = ('inetOrgPerson', )
+    conn = _test_directory()
+    search = Person.search_iter(page_size=2, base_dn='ou=people,dc=example,dc=com')
+    people = list(search(conn))
+    assert len(people) == 5 and all(isinstance(p, Person) for p in people)
+    assert sorted(p.dn for p in people)[0] == 'uid=user0,ou=people,dc=example,dc=com'
+    # reading the first page only leaves no paged search open
+    matches = search(conn)
+    next(matches)
+    assert conn.paged
+    matches.close()
+    assert conn.paged == {}
+
+
 __all__ = ['LDAPHelper', ]
@@ -0,0 +1,412 @@
+# -*- encoding: utf-8
+"""Ploum bulk imports
+
+Stream a LDIF or JSON Lines file (as written by ploum.export) into the
+directory, with concurrent adds over the connections of a pool.
+
+.. code:: python
+
+    pool = LDAPConnectionPool('ldap://localhost', credentials, max_size=8)
+    importer = Importer(pool, connections=8, checkpoint='/var/tmp/people.ckpt')
+    totals = importer.run('/var/backups/people.ldif')
+
+Records are read batch by batch, never all at once. Each record is
+validated against the schema before being sent, by loading its attributes
+in the class get_proper_type gives, as populate does, and by checking that
+the attributes its objectClasses require are there; invalid records are
+reported and skipped. Inside a batch, an entry is
+only added once its parent is, and a batch is finished before the next one
+starts, so files sorted parents first (as exports are) import in order.
+
+Entries that already exist are modified (their imported attributes are
+replaced), skipped or reported as errors, depending on on_exists.
+
+After each batch, the position in the file is written to the checkpoint
+file: running the same import again resumes after the last finished batch.
+The positions of the records that were not imported are kept in the
+checkpoint too, and the next run tries them again.
+"""
+
+import base64
+import collections
+import concurrent.futures
+import contextlib
+import json
+import logging
+import os
+import time
+
+import ldap
+import ldap.modlist
+import ldif
+
+from ctrmisctk.utils import atomic_write
+
+from . import instrumentation
+from .ldap_utils import get_proper_type
+from .ploum import load_schemas, notify_write
+from .plumbing import normalize_dn, parent_dn
+
+logger = logging.getLogger(__name__)
+
+CHECKPOINT_VERSION = 1
+ON_EXISTS = ('modify', 'skip', 'error')
+
+Record = collections.namedtuple('Record', ('position', 'dn', 'attrs', 'error'))
+BatchReport = collections.namedtuple(
+    'BatchReport', ('number', 'first', 'records', 'added', 'modified', 'skipped', 'errors',
+                    'duration', 'rate'))
+
+
+def _load_value(value):
+    if isinstance(value, dict):
+        return base64.b64decode(value['base64'])
+    return value.encode('utf-8')
+
+
+def jsonl_records(f):
+    """Read the entries of a JSON Lines file written by ploum.export
+
+    :param f: text file object
+    :return: generator of (dn, attrs), values as bytes"""
+    for line in f:
+        if not line.strip():
+            continue
+        data = json.loads(line)
+        attrs = {}
+        for (name, values) in data['attributes'].items():
+            if not isinstance(values, list):
+                values = [values]
+            attrs[name] = [_load_value(v) for v in values]
+        yield (data['dn'], attrs)
+
+
+class _LDIFReader(ldif.LDIFParser):
+    """LDIF parser handing each entry record to a callable"""
+
+    def __init__(self, f, sink):
+        super().__init__(f)
+        self.sink = sink
+
+    def handle(self, dn, entry):
+        self.sink(dn, entry)
+
+
+class Importer(object):
+    """Import LDIF or JSON Lines files
+
+    :param pool: LDAPConnectionPool the entries are written with
+    :param connections: number of entries written at the same time
+    :param batch_size: records per batch
+    :param on_exists: 'modify', 'skip' or 'error' when an entry already exists
+    :param all_types: object classes of the schema, loaded from the pool by
+        default
+    :param checkpoint: optional path of the checkpoint file
+    :param report: optional callable(BatchReport) called after each batch"""
+
+    def __init__(self, pool, connections=4, batch_size=1000, on_exists='modify',
+                 all_types=None, checkpoint=None, report=None):
+        if on_exists not in ON_EXISTS:
+            raise ValueError('on_exists must be one of {}'.format(', '.join(ON_EXISTS)))
+        self.pool = pool
+        self.connections = connections
+        self.batch_size = batch_size
+        self.on_exists = on_exists
+        self.all_types = all_types
+        self.checkpoint = checkpoint
+        self.report = report
+
+    def _types(self):
+        if self.all_types is None:
+            with self.pool.connection() as conn:
+                self.all_types = load_schemas(conn)[0]
+        return self.all_types
+
+    # checkpoints
+
+    def _load_checkpoint(self, source):
+        """Where to resume an import of source from
+
+        :return: (position, totals, positions of the records to retry)"""
+        if not self.checkpoint:
+            return 0, collections.Counter(), []
+        try:
+            with open(self.checkpoint, encoding='utf-8') as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return 0, collections.Counter(), []
+        if data.get('version') != CHECKPOINT_VERSION or data.get('source') != source:
+            logger.warning('Ignoring checkpoint %s of another import', self.checkpoint)
+            return 0, collections.Counter(), []
+        failed = data.get('failed', [])
+        logger.info('Resuming import of %s after %d records, retrying %d failed records',
+                    source, data['position'], len(failed))
+        return data['position'], collections.Counter(data.get('totals', {})), failed
+
+    def _save_checkpoint(self, source, position, totals, failed, finished=False):
+        if not self.checkpoint:
+            return
+        data = dict(version=CHECKPOINT_VERSION, source=source, position=position,
+                    totals=dict(totals), failed=failed, finished=finished)
+        with atomic_write(self.checkpoint, '.ploum-import-') as f:
+            json.dump(data, f)
+
+    # records
+
+    @staticmethod
+    def _field_name(typ, name):
+        """Field of typ an attribute name stands for, resolving aliases
+
+        :raise KeyError: if the attribute is unknown to the schema"""
+        (fields, virtual) = typ.get_field_index()
+        low = name.lower()
+        if low in fields or low in virtual:
+            return name
+        oid = typ.attr_types[name].properties['oid']
+        for (field, attr_class) in fields.values():
+            if attr_class.properties['oid'] == oid:
+                return field
+        return name
+
+    def validate(self, position, dn, attrs):
+        """Check a record against the schema
+
+        :param position: number of the record in the file
+        :param dn: DN of the entry
+        :param attrs: attributes of the entry, lists of bytes
+        :return: Record"""
+        if 'changetype' in attrs:
+            return Record(position, dn, attrs, 'change records are not supported')
+        present = set()
+        try:
+            typ = get_proper_type(attrs, self._types())
+            item = typ()
+            item.dn = dn
+            for (name, values) in attrs.items():
+                field = self._field_name(typ, name)
+                if values:
+                    present.add(field.lower())
+                try:
+                    item.load_attribute(field, values)
+                except UnicodeDecodeError:
+                    # binary values are sent as they are
+                    pass
+        except (KeyError, ValueError, TypeError) as e:
+            return Record(position, dn, attrs, 'invalid entry: {}'.format(e))
+        missing = [name for name in dict.fromkeys(typ.must_fields)
+                   if name.lower() not in present]
+        if missing:
+            return Record(position, dn, attrs, 'missing required attributes: {}'.format(
+                ', '.join(missing)))
+        return Record(position, dn, attrs, None)
+
+    def _apply(self, record):
+        """Write a record to the directory
+
+        :return: 'added', 'modified' or 'skipped'"""
+        with self.pool.connection() as conn:
+            with instrumentation.operation('add', record.dn) as op:
+                try:
+                    with op.phase('server'):
+                        conn.add_s(record.dn, ldap.modlist.addModlist(record.attrs))
+                    notify_write(record.dn)
+                    return 'added'
+                except ldap.ALREADY_EXISTS:
+                    if self.on_exists == 'error':
+                        raise
+                    if self.on_exists == 'skip':
+                        return 'skipped'
+            with instrumentation.operation('modify', record.dn) as op:
+                with op.phase('server'):
+                    conn.modify_s(record.dn, [(ldap.MOD_REPLACE, name, values)
+                                              for (name, values) in record.attrs.items()])
+            notify_write(record.dn)
+            return 'modified'
+
+    def run_batch(self, executor, number, batch):
+        """Write a batch of records, parents before their children
+
+        :param executor: executor the records are written with
+        :param number: number of the batch
+        :param batch: list of Record
+        :return: BatchReport"""
+        start = time.perf_counter()
+        counts = collections.Counter()
+        errors = []
+        index = dict((normalize_dn(r.dn), i) for (i, r) in enumerate(batch))
+        children = collections.defaultdict(list)
+        ready = []
+        for (i, record) in enumerate(batch):
+            parent = index.get(normalize_dn(parent_dn(record.dn)))
+            if parent is not None and parent != i:
+                children[parent].append(i)
+            else:
+                ready.append(i)
+
+        def fail(i, message):
+            errors.append((batch[i].position, batch[i].dn, message))
+            for child in children.pop(i, ()):
+                fail(child, 'parent {} not imported'.format(batch[i].dn))
+
+        futures = {}
+
+        def submit(indexes):
+            for i in indexes:
+                if batch[i].error is not None:
+                    fail(i, batch[i].error)
+                else:
+                    futures[executor.submit(self._apply, batch[i])] = i
+
+        submit(ready)
+        while futures:
+            (done, _) = concurrent.futures.wait(
+                futures, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                i = futures.pop(future)
+                try:
+                    counts[future.result()] += 1
+                except ldap.LDAPError as e:
+                    fail(i, str(e))
+                else:
+                    submit(children.pop(i, ()))
+        duration = time.perf_counter() - start
+        report = BatchReport(number, batch[0].position, len(batch), counts['added'],
+                             counts['modified'], counts['skipped'], errors, duration,
+                             len(batch) / duration if duration else 0.0)
+        logger.info('Imported batch %d (records %d-%d): %d added, %d modified, %d skipped, '
+                    '%d errors, %.0f entries/s', number, report.first,
+                    report.first + len(batch) - 1, report.added, report.modified,
+                    report.skipped, len(errors), report.rate)
+        for (position, dn, message) in errors:
+            logger.warning('Record %d %s not imported: %s', position, dn, message)
+        return report
+
+    def run(self, path, fmt=None):
+        """Import a file, resuming from the checkpoint if there is one
+
+        :param path: LDIF or JSON Lines file
+        :param fmt: 'ldif' or 'jsonl', guessed from the extension by default
+        :return: Counter of added, modified, skipped and errors, errors being
+            the records still not imported"""
+        if fmt is None:
+            fmt = 'jsonl' if path.endswith(('.jsonl', '.json')) else 'ldif'
+        source = os.path.abspath(path)
+        (resume, totals, retry) = self._load_checkpoint(source)
+        retry = frozenset(retry)
+        failed = []
+        batch = []
+        position = 0
+        number = 0
+
+        def pending(last):
+            """Records not imported: failed ones, and ones still to retry"""
+            return failed + sorted(p for p in retry if p > last)
+
+        def flush():
+            nonlocal batch, number
+            number += 1
+            report = self.run_batch(executor, number, batch)
+            failed.extend(p for (p, _, _) in report.errors)
+            totals.update(added=report.added, modified=report.modified,
+                          skipped=report.skipped)
+            last = batch[-1].position
+            totals['errors'] = len(pending(last))
+            self._save_checkpoint(source, max(resume, last + 1), totals, pending(last))
+            batch = []
+            if self.report is not None:
+                self.report(report)
+
+        def sink(dn, attrs):
+            nonlocal position
+            if position >= resume or position in retry:
+                batch.append(self.validate(position, dn, attrs))
+                if len(batch) >= self.batch_size:
+                    flush()
+            position += 1
+
+        with concurrent.futures.ThreadPoolExecutor(self.connections) as executor:
+            with open(path, encoding='utf-8') as f:
+                if fmt == 'ldif':
+                    _LDIFReader(f, sink).parse_entry_records()
+                else:
+                    for (dn, attrs) in jsonl_records(f):
+                        sink(dn, attrs)
+            if batch:
+                flush()
+        totals['errors'] = len(failed)
+        self._save_checkpoint(source, position, totals, failed, finished=True)
+        logger.info('Imported %s: %d records, %d added, %d modified, %d skipped, %d errors',
+                    path, position, totals['added'], totals['modified'], totals['skipped'],
+                    totals['errors'])
+        return totals
+
+
+def test_validate():
+    from benchmarks.fakeldap import load_schema_fixture
+    from .plumbing import AttributeTypeDict
+    from .ploum import ObjectClassDict
+    schemata = ldap.schema.SubSchema(load_schema_fixture())
+    importer = Importer(None, all_types=ObjectClassDict(schemata, AttributeTypeDict(schemata)))
+    dn = 'uid=jdoe,dc=example,dc=com'
+    attrs = {'objectClass': [b'inetOrgPerson'], 'uid': [b'jdoe'], 'cn': [b'John Doe']}
+    assert importer.validate(1, dn, attrs).error == 'missing required attributes: sn'
+    attrs['SN'] = [b'Doe']
+    assert importer.validate(1, dn, attrs).error is None
+    attrs['objectClass'] = [b'inetOrgPerson', b'posixAccount']
+    error = importer.validate(1, dn, attrs).error
+    assert error.startswith('missing required attributes: ') and 'uidNumber' in error
+    # LDIF may write names in any case, and aliases
+    attrs = {'objectclass': [b'inetOrgPerson'], 'commonName': [b'John Doe'], 'surname': [b'Doe']}
+    assert importer.validate(1, dn, attrs).error is None
+    error = importer.validate(1, dn, {'cn': [b'John Doe']}).error
+    assert error == "invalid entry: 'entry without objectClass'"
+
+
+class _TestPool(object):
+    """Pool of one connection refusing to add some DNs"""
+
+    def __init__(self, refuse=()):
+        self.refuse = set(refuse)
+        self.added = []
+
+    @contextlib.contextmanager
+    def connection(self):
+        yield self
+
+    def add_s(self, dn, modlist):
+        if dn in self.refuse:
+            raise ldap.UNWILLING_TO_PERFORM({'desc': 'Server is unwilling to perform'})
+        self.added.append(dn)
+
+
+def test_run_retries_failed_records():
+    import tempfile
+    from benchmarks.fakeldap import load_schema_fixture
+    from .plumbing import AttributeTypeDict
+    from .ploum import ObjectClassDict
+    schemata = ldap.schema.SubSchema(load_schema_fixture())
+    all_types = ObjectClassDict(schemata, AttributeTypeDict(schemata))
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, 'people.jsonl')
+    checkpoint = os.path.join(directory, 'people.ckpt')
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(json.dumps({'dn': 'ou=people,dc=example,dc=com', 'attributes': {
+            'objectClass': ['organizationalUnit'], 'ou': 'people'}}) + '\n')
+        for uid in ('a', 'b'):
+            f.write(json.dumps({'dn': 'uid={},ou=people,dc=example,dc=com'.format(uid),
+                                'attributes': {'objectClass': ['inetOrgPerson'], 'uid': uid,
+                                               'cn': uid, 'sn': uid}}) + '\n')
+    pool = _TestPool(refuse=['uid=a,ou=people,dc=example,dc=com'])
+    importer = Importer(pool, batch_size=2, all_types=all_types, checkpoint=checkpoint)
+    totals = importer.run(path)
+    assert (totals['added'], totals['errors']) == (2, 1)
+    pool.refuse.clear()
+    totals = importer.run(path)
+    assert pool.added[-1] == 'uid=a,ou=people,dc=example,dc=com' and len(pool.added) == 3
+    assert (totals['added'], totals['errors']) == (3, 0)
+    for name in os.listdir(directory):
+        os.unlink(os.path.join(directory, name))
+    os.rmdir(directory)
+
+
+__all__ = ['Importer', 'BatchReport', 'Record', 'jsonl_records', 'ON_EXISTS', ]
@@ -0,0 +1,367 @@
+# -*- encoding: utf-8
+"""Ploum instrumentation
+
+Hooks called after every search, save, delete and schema load made through
+the callables of PloumObj, with the time spent in each phase of the
+operation.
+
+.. code:: python
+
+    from ploum import instrumentation
+
+    collector = instrumentation.HistogramCollector()
+    instrumentation.register_hook(collector)
+    ...
+    collector.write_prometheus('/var/lib/node_exporter/ploum.prom')
+
+A hook is any callable taking an OperationEvent. Phases of a search are
+'server' (round-trip and decoding by python-ldap), 'types' (get_proper_type)
+and 'populate'; saves report 'prepare' (modlist computation) and 'server'.
+A paged search (search_iter) is a single event once its iteration is over,
+the phases being summed over its pages; its duration includes the time the
+caller spent between pages.
+
+When no hook is registered, operations use a shared no-op event and are
+not timed.
+"""
+
+import bisect
+import collections
+import logging
+import threading
+import time
+
+from ctrmisctk.utils import atomic_write
+
+logger = logging.getLogger(__name__)
+_hooks = []
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def register_hook(hook):
+    """Call hook(event) after every operation
+
+    :param hook: callable taking an OperationEvent
+    :return: hook"""
+    _hooks.append(hook)
+    return hook
+
+
+def unregister_hook(hook):
+    """Stop calling a hook
+
+    :param hook: hook previously registered"""
+    try:
+        _hooks.remove(hook)
+    except ValueError:
+        pass
+
+
+class _NullPhase(object):
+    """Phase of an operation that is not recorded"""
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+class _NullEvent(object):
+    """Operation that is not recorded, used when no hook is registered"""
+    __slots__ = ()
+    _phase = _NullPhase()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def phase(self, name):
+        return self._phase
+
+    def add_phase(self, name, duration):
+        pass
+
+    def record_results(self, results):
+        pass
+
+
+_NULL_EVENT = _NullEvent()
+
+
+class _Phase(object):
+    __slots__ = ('event', 'name', 'start')
+
+    def __init__(self, event, name):
+        self.event = event
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.event.add_phase(self.name, time.perf_counter() - self.start)
+        return False
+
+
+class OperationEvent(object):
+    """Report of an operation, handed to the hooks once it is over
+
+    :param operation: 'search', 'add', 'modify', 'delete' or 'load_schemas'
+    :param base: base DN of the search, or DN of the entry
+    :param filterstr: filter of the search, None for other operations"""
+    __slots__ = ('operation', 'base', 'filterstr', 'entries', 'bytes_decoded',
+                 'phases', 'duration', 'error', '_start')
+
+    def __init__(self, operation, base=None, filterstr=None):
+        self.operation = operation
+        self.base = base
+        self.filterstr = filterstr
+        self.entries = 0
+        self.bytes_decoded = 0
+        self.phases = {}
+        self.duration = None
+        self.error = None
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.duration = time.perf_counter() - self._start
+        # a generator closed before its end did not fail
+        self.error = None if isinstance(exc, GeneratorExit) else exc
+        for hook in list(_hooks):
+            try:
+                hook(self)
+            except Exception:
+                logger.exception('Instrumentation hook %r failed', hook)
+        return False
+
+    def phase(self, name):
+        """Time a phase of the operation
+
+        :param name: name of the phase
+        :return: context manager"""
+        return _Phase(self, name)
+
+    def add_phase(self, name, duration):
+        """Record the duration of a phase timed elsewhere
+
+        :param name: name of the phase
+        :param duration: seconds, None if it was not timed"""
+        if duration is None:
+            return
+        self.phases[name] = self.phases.get(name, 0.0) + duration
+
+    def record_results(self, results):
+        """Count the entries and the bytes of the values of a search result
+
+        :param results: list of (dn, attrs) as returned by python-ldap"""
+        self.entries += len(results)
+        self.bytes_decoded += sum(len(v) for (_, attrs) in results
+                                  for values in attrs.values() for v in values)
+
+    def __repr__(self):
+        return 'OperationEvent({}, {!r}, entries={}, duration={!r}, phases={!r})'.format(
+            self.operation, self.base, self.entries, self.duration, self.phases)
+
+
+def operation(operation, base=None, filterstr=None):
+    """Start instrumenting an operation
+
+    Use as a context manager; the hooks are called when it exits.
+
+    :param operation: type of the operation
+    :param base: base DN of the search, or DN of the entry
+    :param filterstr: filter of the search
+    :return: OperationEvent, or a no-op event if no hook is registered"""
+    if not _hooks:
+        return _NULL_EVENT
+    return OperationEvent(operation, base, filterstr)
+
+
+def timer():
+    """Start timing something an OperationEvent may be told about later
+
+    :return: callable returning the seconds elapsed since the call to
+        timer(), or None if no hook is registered"""
+    if not _hooks:
+        return lambda: None
+    start = time.perf_counter()
+    return lambda: time.perf_counter() - start
+
+
+class Histogram(object):
+    """Cumulative histogram of durations
+
+    :param buckets: sorted upper bounds of the buckets, in seconds"""
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * len(self.buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        idx = bisect.bisect_left(self.buckets, value)
+        if idx < len(self.counts):
+            self.counts[idx] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        """Counts of observations below each bucket bound, +Inf included
+
+        :return: list of (bound, count)"""
+        res = []
+        total = 0
+        for (bound, count) in zip(self.buckets, self.counts):
+            total += count
+            res.append((bound, total))
+        res.append((float('inf'), self.count))
+        return res
+
+
+def _labels(**labels):
+    return '{' + ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                          for (k, v) in labels.items()) + '}'
+
+
+def _bound(value):
+    return '+Inf' if value == float('inf') else repr(value)
+
+
+class HistogramCollector(object):
+    """Hook keeping latency histograms of the operations in memory
+
+    :param buckets: upper bounds of the histogram buckets, in seconds"""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self.durations = {}
+        self.phases = {}
+        self.entries = collections.Counter()
+        self.bytes_decoded = collections.Counter()
+        self.errors = collections.Counter()
+        self._lock = threading.Lock()
+
+    def _histogram(self, store, key):
+        hist = store.get(key)
+        if hist is None:
+            hist = store[key] = Histogram(self.buckets)
+        return hist
+
+    def __call__(self, event):
+        with self._lock:
+            self._histogram(self.durations, event.operation).observe(event.duration)
+            for (name, duration) in event.phases.items():
+                self._histogram(self.phases, (event.operation, name)).observe(duration)
+            self.entries[event.operation] += event.entries
+            self.bytes_decoded[event.operation] += event.bytes_decoded
+            if event.error is not None:
+                self.errors[event.operation] += 1
+
+    def reset(self):
+        """Forget all the observations"""
+        with self._lock:
+            self.durations.clear()
+            self.phases.clear()
+            self.entries.clear()
+            self.bytes_decoded.clear()
+            self.errors.clear()
+
+    def to_prometheus(self, prefix='ploum'):
+        """Export the metrics in the Prometheus text format
+
+        :param prefix: prefix of the metric names
+        :return: str"""
+        lines = []
+
+        def histogram(name, help, store, labels):
+            lines.append('# HELP {}_{} {}'.format(prefix, name, help))
+            lines.append('# TYPE {}_{} histogram'.format(prefix, name))
+            for (key, hist) in sorted(store.items()):
+                lbl = labels(key)
+                for (bound, count) in hist.cumulative():
+                    lines.append('{}_{}_bucket{} {}'.format(
+                        prefix, name, _labels(**lbl, le=_bound(bound)), count))
+                lines.append('{}_{}_sum{} {!r}'.format(prefix, name, _labels(**lbl), hist.sum))
+                lines.append('{}_{}_count{} {}'.format(prefix, name, _labels(**lbl), hist.count))
+
+        def counter(name, help, values):
+            lines.append('# HELP {}_{} {}'.format(prefix, name, help))
+            lines.append('# TYPE {}_{} counter'.format(prefix, name))
+            for (op, value) in sorted(values.items()):
+                lines.append('{}_{}{} {}'.format(prefix, name, _labels(operation=op), value))
+
+        with self._lock:
+            histogram('operation_duration_seconds', 'Duration of LDAP operations.',
+                      self.durations, lambda op: dict(operation=op))
+            histogram('phase_duration_seconds', 'Duration of the phases of LDAP operations.',
+                      self.phases, lambda key: dict(operation=key[0], phase=key[1]))
+            counter('entries_total', 'Entries returned by LDAP operations.', self.entries)
+            counter('decoded_bytes_total', 'Bytes of attribute values received.',
+                    self.bytes_decoded)
+            counter('errors_total', 'LDAP operations that failed.', self.errors)
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, path, prefix='ploum'):
+        """Write the metrics to a file, atomically, eg. for the textfile
+        collector of the node exporter
+
+        :param path: file to write
+        :param prefix: prefix of the metric names"""
+        with atomic_write(path, '.ploum-metrics-', mode=0o644) as f:
+            f.write(self.to_prometheus(prefix))
+
+
+def test_histogram_collector():
+    import tempfile
+    from .helper_class import LDAPHelper
+    from .ldap_utils import _test_directory
+    from .ploum import _test_item
+
+    class Person(LDAPHelper, type(_test_item())):
+        OBJECT_CLASSES = ('inetOrgPerson', )
+    collector = register_hook(HistogramCollector(buckets=(0.5, 60.0)))
+    try:
+        conn = _test_directory()
+        assert len(list(Person.search_iter(
+            page_size=2, base_dn='ou=people,dc=example,dc=com')(conn))) == 5
+        # abandoned after the first page
+        matches = Person.search_iter(page_size=2, base_dn='ou=people,dc=example,dc=com')(conn)
+        next(matches)
+        matches.close()
+        try:
+            with operation('delete', 'uid=nobody,dc=example,dc=com'):
+                raise ValueError('failed')
+        except ValueError:
+            pass
+    finally:
+        unregister_hook(collector)
+    lines = collector.to_prometheus().splitlines()
+    assert '# TYPE ploum_operation_duration_seconds histogram' in lines
+    assert 'ploum_operation_duration_seconds_bucket{operation="search",le="+Inf"} 2' in lines
+    assert 'ploum_operation_duration_seconds_count{operation="search"} 2' in lines
+    assert 'ploum_phase_duration_seconds_count{operation="search",phase="server"} 2' in lines
+    assert 'ploum_entries_total{operation="search"} 7' in lines
+    assert 'ploum_errors_total{operation="delete"} 1' in lines
+    # the search closed after its first page is not an error
+    assert not [line for line in lines if line.startswith('ploum_errors_total{operation="search"}')]
+    with tempfile.TemporaryDirectory() as directory:
+        path = directory + '/ploum.prom'
+        collector.write_prometheus(path)
+        with open(path) as f:
+            assert f.read().splitlines() == lines
+
+
+__all__ = ['register_hook', 'unregister_hook', 'operation', 'timer', 'OperationEvent',
+           'Histogram', 'HistogramCollector', 'DEFAULT_BUCKETS', ]
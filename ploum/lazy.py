@@ -0,0 +1,146 @@
+# -*- encoding: utf-8
+"""Ploum lazy attributes
+
+When a search only requests some attributes, the other ones are fetched
+on first access. The fetch is done for every item of the result set at
+once, so that reading a field of N items costs one search, not N.
+
+The connection of the search is only kept if it does not belong to a
+LDAPConnectionPool: otherwise a connection is checked out of the pool for
+each fetch, as the one of the search went back to the pool meanwhile. Mind
+that reading items of search_iter while the search still holds its
+connection then needs a second connection of the pool.
+"""
+
+import contextlib
+import logging
+
+import ldap.dn
+import ldap.filter
+
+from .ldap_utils import pooled_connection
+
+logger = logging.getLogger(__name__)
+
+
+def rdn_filter(dn):
+    """Build a filter matching the RDN of a DN
+
+    :param dn: distinguished name
+    :return: filter string"""
+    rdn = ldap.dn.str2dn(dn)[0]
+    return '(&{})'.format(''.join(
+        '({}={})'.format(t, ldap.filter.escape_filter_chars(v)) for (t, v, _) in rdn))
+
+
+class LazyFetcher(object):
+    """Fetch the attributes left out of a search for a set of items
+
+    :param conn: LDAP connection the search was made on, only kept if it
+        does not belong to a pool
+    :param base: base DN of the search
+    :param scope: scope of the search
+    :param filterstr: filter of the search
+    :param requested: attribute names requested by the search
+    :param batch_size: maximum number of items fetched by a single search"""
+
+    def __init__(self, conn, base, scope, filterstr, requested, batch_size=500):
+        self.checkout = pooled_connection(conn)
+        self.conn = conn if self.checkout is None else None
+        self.base = base
+        self.scope = scope
+        self.filterstr = filterstr
+        self.requested = frozenset(a.lower() for a in requested) | {'objectclass'}
+        self.batch_size = batch_size
+        self.fetched = {}
+        self.items = {}
+
+    def register(self, items):
+        """Attach items of the result set to this fetcher
+
+        :param items: iterable of PloumObj
+        :return: items"""
+        for item in items:
+            self.items[item.dn.lower()] = item
+            item._fetcher = self
+        return items
+
+    def is_missing(self, low, dn):
+        """Whether an attribute of an item still has to be fetched
+
+        :param low: lowercase name of the attribute
+        :param dn: DN of the item"""
+        return (low not in self.requested and
+                dn.lower() not in self.fetched.get(low, ()))
+
+    def fetch(self, name):
+        """Fetch an attribute for all the registered items not having it yet
+
+        :param name: name of the attribute"""
+        fetched = self.fetched.setdefault(name.lower(), set())
+        dns = [dn for dn in self.items if dn not in fetched]
+        logger.debug('Fetching %s for %d items', name, len(dns))
+        if not dns:
+            return
+        with self._connection() as conn:
+            for start in range(0, len(dns), self.batch_size):
+                batch = dns[start:start + self.batch_size]
+                filterstr = '(&{}(|{}))'.format(self.filterstr, ''.join(
+                    rdn_filter(self.items[dn].dn) for dn in batch))
+                results = conn.search_ext_s(self.base, self.scope, filterstr, attrlist=[name])
+                # only fetched once the search succeeded, to be fetched again otherwise
+                fetched.update(batch)
+                for (dn, attrs) in results:
+                    item = self.items.get(dn.lower()) if dn else None
+                    if item is None:
+                        continue
+                    for (k, v) in attrs.items():
+                        item.load_attribute(k, v)
+
+    def _connection(self):
+        if self.checkout is not None:
+            return self.checkout()
+        return contextlib.nullcontext(self.conn)
+
+
+class _TestConnection(object):
+    """Connection answering lazy fetches, failing the first ones"""
+
+    def __init__(self, failures=0):
+        self.failures = failures
+        self.searches = []
+
+    def search_ext_s(self, base, scope, filterstr, attrlist=None):
+        self.searches.append(filterstr)
+        if len(self.searches) <= self.failures:
+            raise ldap.SERVER_DOWN({'desc': "Can't contact LDAP server"})
+        return [('uid=jdoe,dc=example,dc=com', {'telephoneNumber': [b'+33 1 23 45 67 89']}),
+                (None, ['ldap://other.example.com/'])]
+
+
+def test_lazy_fetch():
+    from .ploum import _test_item
+    item = _test_item()
+    conn = _TestConnection(failures=1)
+    fetcher = LazyFetcher(conn, 'dc=example,dc=com', ldap.SCOPE_SUBTREE, '(uid=*)',
+                          ['cn', 'sn', 'displayName', 'mail', 'description'])
+    fetcher.register([item])
+    assert not fetcher.is_missing('mail', item.dn)
+    assert fetcher.is_missing('telephonenumber', item.dn)
+    try:
+        item.get_attribute('telephonenumber')
+    except ldap.SERVER_DOWN:
+        pass
+    else:
+        assert False, 'the failure of the fetch must be raised'
+    # the failed fetch is tried again
+    assert fetcher.is_missing('telephonenumber', item.dn)
+    assert list(item.get_attribute('telephonenumber').value) == ['+33 1 23 45 67 89']
+    assert item.get_attribute('telephonenumber') is not None and len(conn.searches) == 2
+    assert conn.searches[-1] == '(&(uid=*)(|(&(uid=jdoe))))'
+    # fetched but absent: not searched again
+    assert item.get_attribute('title') is None and item.get_attribute('title') is None
+    assert len(conn.searches) == 3
+
+
+__all__ = ['LazyFetcher', 'rdn_filter', ]
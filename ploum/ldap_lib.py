@@ -9,46 +9,65 @@ from .plumbing import LDAPAttribute
 logger = logging.getLogger(__name__)
 
 
+def set_field(self, low, value):
+    """Assign a value to a field of a PloumObj, as its property does
+
+    :param self: PloumObj
+    :param low: lowercase name of the field
+    :param value: value to add, or LDAPAttribute replacing the field"""
+    self.get_attribute(low)
+    if self._mode == 'self_update':
+        if low not in self._attrs:
+            self._attrs[low] = self.get_field_index()[0][low][1]()
+        self._attrs[low].set_value(value)
+        return
+    logger.info("Setting value to %s", value)
+    if isinstance(value, LDAPAttribute):
+        self.replace_attribute(low, value)
+    else:
+        if low not in self._attrs:
+            self._attrs[low] = self.get_field_index()[0][low][1]()
+        self._attrs[low] += value
+    logger.info("Value is now %s", self._attrs[low]._value)
+    logger.debug("Attr type: %s → %s", type(self._attrs[low]), self._attrs[low])
+    assert isinstance(self._attrs[low], LDAPAttribute)
+
+
+def field_doc(name, attr_class):
+    """Docstring of the property of a field
+
+    :param name: name of the field
+    :param attr_class: LDAPAttribute class of the field"""
+    return """
+            {0} property (automatically added by ldap_lib.py)
+
+            Description: {1[desc]}
+            Single value? {1[single_value]}
+            Usage: {1[usage]}
+            --
+            {2}""".format(name, attr_class.properties,
+                          'str' if attr_class.properties['single_value'] else 'list(str)')
+
+
+def field_property(name, doc=None):
+    """Property reading and writing a field of a PloumObj
+
+    :param name: name of the field
+    :param doc: docstring of the property"""
+    def _get(self, low=name.lower()):
+        return self.get_attribute(low)
+
+    def _set(self, value, low=name.lower()):
+        set_field(self, low, value)
+    return property(fget=_get, fset=_set, doc=doc)
+
+
 def build_properties(attr_dict):
     """Sort-of decorator to lately build properties on LDAP classes.
 
     Expects a PloumObj class"""
     def build_properties_real(cls):
         for i in cls.may_fields + cls.must_fields:
-            def _get(self, low=i.lower()):
-                return self._attrs.get(low)
-
-            def _set(self, value, low=i.lower()):
-                if self._mode == 'self_update':
-                    self._attrs[low].set_value(value)
-                    return
-                logger.info("Setting value to %s", value)
-                if isinstance(value, LDAPAttribute):
-                    self._attrs[low] = value
-                else:
-                    if low not in self._attrs:
-                        logger.error("Cannot find attribute %s", i)
-                    self._attrs[low] += value
-                logger.info("Value is now %s", self._attrs[low]._value)
-                logger.debug("Attr type: %s → %s", type(self._attrs[low]), self._attrs[low])
-                assert isinstance(self._attrs[low], LDAPAttribute)
-            setattr(cls, i,
-                    property(
-                        fget=_get, fset=_set,
-                        doc="""
-            {0} property (automatically added by ldap_lib.py)
-
-            Description: {1.properties[desc]}
-            Single value? {1.properties[single_value]}
-            Usage: {1.usage}
-            --
-            {2}""".format(
-                            i,
-                            attr_dict[i],
-                            'str' if cls.attr_types[i].properties['single_value']
-                            else 'list(str)'
-                        )))
+            setattr(cls, i, field_property(i, field_doc(i, cls.attr_types[i])))
         return cls
     return build_properties_real
-
-
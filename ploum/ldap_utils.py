@@ -1,61 +1,495 @@
 # -*- encoding: utf-8
+import contextlib
+import functools
 import logging
-from ctrmisctk.utils import slacker_cacher_decorator
+import threading
+import time
+import weakref
 from .plumbing import AttributeFactory
 import ldap
+from ldap.controls import SimplePagedResultsControl
+import ldap.ldapobject
 from ldap.ldapobject import LDAPObject, LDAPError
 
 import ldap.schema
 
 logger = logging.getLogger(__name__)
 _ldap_conns = dict()
+_ldap_conns_lock = threading.Lock()
+_ldap_pools = dict()
+_ldap_pools_lock = threading.Lock()
+_connection_pools = weakref.WeakKeyDictionary()
 
 
-def get_ldap(identifier:str='DEFAULT', **kwargs) -> LDAPObject:
+class PoolTimeout(LDAPError):
+    """No connection could be checked out of a pool in time"""
+
+
+class _PoolEntry(object):
+    __slots__ = ('conn', 'credentials', 'last_used')
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.credentials = None
+        self.last_used = time.monotonic()
+
+
+class LDAPConnectionPool(object):
+    """A thread safe pool of LDAP connections
+
+    Connections are ReconnectLDAPObject instances, so they reconnect and bind
+    again by themselves when the server restarts.
+
+    .. code:: python
+
+        pool = LDAPConnectionPool('ldap://localhost', ('cn=admin,dc=ex', 'secret'))
+        with pool.connection() as conn:
+            items = EmailDomain.search_all(base_dn='dc=ex')(conn)
+
+    :param uri: URI of the LDAP server
+    :param credentials: default (who, password) tuple connections are bound with
+    :param min_size: number of connections kept open even when idle
+    :param max_size: maximum number of connections open at the same time
+    :param idle_timeout: seconds after which an idle connection above min_size is closed
+    :param check_interval: idle seconds after which a connection is checked
+        for liveness before being handed out
+    :param timeout: default seconds to wait for a connection, None to wait forever
+    :param retry_max: reconnection attempts of each connection
+    :param retry_delay: seconds between reconnection attempts
+    :param kwargs: passed to the LDAP object constructor"""
+
+    def __init__(self, uri, credentials=None, min_size=0, max_size=10,
+                 idle_timeout=300, check_interval=30, timeout=None,
+                 retry_max=3, retry_delay=1.0, **kwargs):
+        self.uri = uri
+        self.credentials = credentials
+        self.min_size = min_size
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.check_interval = check_interval
+        self.timeout = timeout
+        self.retry_max = retry_max
+        self.retry_delay = retry_delay
+        self.kwargs = kwargs
+        self._idle = []
+        self._in_use = {}
+        self._pending = 0
+        self._cond = threading.Condition()
+        self.metrics = dict(created=0, closed=0, checkouts=0, waits=0,
+                            wait_time=0.0, failed_checks=0, binds=0)
+        for _ in range(min_size):
+            self._idle.append(self._connect())
+
+    def _connect(self):
+        logger.info('Creating new connection to LDAP: %s', self.uri)
+        conn = ldap.ldapobject.ReconnectLDAPObject(
+            self.uri, retry_max=self.retry_max, retry_delay=self.retry_delay,
+            **self.kwargs)
+        self._count('created')
+        _connection_pools[conn] = self
+        return _PoolEntry(conn)
+
+    def _count(self, metric):
+        with self._cond:
+            self.metrics[metric] += 1
+
+    def _close(self, entry):
+        """Close a connection taken out of the pool. Must not hold the lock."""
+        self._count('closed')
+        try:
+            entry.conn.unbind_s()
+        except LDAPError as e:
+            logger.debug('Error while closing connection to %s: %s', self.uri, e)
+
+    def _size(self):
+        return len(self._idle) + len(self._in_use) + self._pending
+
+    def _full(self):
+        return not self._idle and self._size() >= self.max_size
+
+    def _reap(self):
+        """Take idle connections above min_size out of the pool. Must hold the lock.
+
+        :return: list of the entries to close once the lock is released"""
+        limit = time.monotonic() - self.idle_timeout
+        res = []
+        while (self._size() > self.min_size and
+               self._idle and self._idle[0].last_used < limit):
+            res.append(self._idle.pop(0))
+        return res
+
+    def _is_alive(self, entry):
+        if time.monotonic() - entry.last_used < self.check_interval:
+            return True
+        try:
+            entry.conn.whoami_s()
+        except LDAPError as e:
+            logger.warning('Dropping dead connection to %s: %s', self.uri, e)
+            self._count('failed_checks')
+            return False
+        return True
+
+    def _bind(self, entry, credentials):
+        """Bind a connection with credentials, anonymously if None"""
+        if entry.credentials != credentials:
+            entry.conn.simple_bind_s(*(credentials or ('', '')))
+            entry.credentials = credentials
+            self._count('binds')
+
+    def checkout(self, credentials=None, timeout=-1):
+        """Take a connection out of the pool
+
+        :param credentials: (who, password) the connection must be bound with,
+            defaults to the credentials of the pool; without either, the
+            connection is anonymous
+        :param timeout: seconds to wait for a connection, defaults to the pool timeout
+        :return: LDAP connection, to be given back with checkin"""
+        timeout = self.timeout if timeout == -1 else timeout
+        credentials = credentials or self.credentials
+        deadline = None if timeout is None else time.monotonic() + timeout
+        expired = []
+        try:
+            with self._cond:
+                self.metrics['checkouts'] += 1
+                expired = self._reap()
+                if self._full():
+                    self.metrics['waits'] += 1
+                    start = time.monotonic()
+                    while self._full():
+                        remaining = None if deadline is None else deadline - time.monotonic()
+                        if remaining is not None and remaining <= 0:
+                            raise PoolTimeout(
+                                'No LDAP connection available to {}'.format(self.uri))
+                        self._cond.wait(remaining)
+                    self.metrics['wait_time'] += time.monotonic() - start
+                entry = self._idle.pop() if self._idle else None
+                # reserve a slot while connecting or checking outside the lock
+                self._pending += 1
+        finally:
+            for old in expired:
+                self._close(old)
+        try:
+            if entry is not None and not self._is_alive(entry):
+                self._close(entry)
+                entry = None
+            if entry is None:
+                entry = self._connect()
+            self._bind(entry, credentials)
+        except BaseException:
+            with self._cond:
+                self._pending -= 1
+                self._cond.notify()
+            if entry is not None:
+                self._close(entry)
+            raise
+        with self._cond:
+            self._pending -= 1
+            self._in_use[id(entry.conn)] = entry
+        return entry.conn
+
+    def checkin(self, conn, broken=False):
+        """Give a connection back to the pool
+
+        :param conn: connection obtained with checkout
+        :param broken: if True, the connection is closed instead of reused"""
+        with self._cond:
+            entry = self._in_use.pop(id(conn), None)
+            if entry is None:
+                logger.error('Connection %s does not belong to this pool', conn)
+                return
+            entry.last_used = time.monotonic()
+            if broken:
+                closing = [entry]
+            else:
+                self._idle.append(entry)
+                closing = []
+            closing.extend(self._reap())
+            self._cond.notify()
+        for old in closing:
+            self._close(old)
+
+    @contextlib.contextmanager
+    def connection(self, credentials=None, timeout=-1):
+        """Context manager checking a connection out and back in
+
+        The connection is dropped if the server went away meanwhile.
+
+        :param credentials: (who, password) the connection must be bound with
+        :param timeout: seconds to wait for a connection"""
+        conn = self.checkout(credentials, timeout)
+        broken = False
+        try:
+            yield conn
+        except ldap.SERVER_DOWN:
+            broken = True
+            raise
+        finally:
+            self.checkin(conn, broken)
+
+    def credentials_of(self, conn):
+        """Credentials a connection of the pool is bound with
+
+        :param conn: connection of the pool
+        :return: (who, password) or None"""
+        with self._cond:
+            entry = self._in_use.get(id(conn))
+            if entry is None:
+                entry = next((e for e in self._idle if e.conn is conn), None)
+            return entry.credentials if entry is not None else None
+
+    def stats(self):
+        """Metrics of the pool
+
+        :return: dict of counters plus size, idle and in_use"""
+        with self._cond:
+            res = dict(self.metrics)
+            res.update(size=self._size(),
+                       idle=len(self._idle), in_use=len(self._in_use))
+        return res
+
+    def close(self):
+        """Close all idle connections"""
+        with self._cond:
+            (idle, self._idle) = (self._idle, [])
+        for entry in idle:
+            self._close(entry)
+
+
+def pooled_connection(conn):
+    """How to check out again a connection like one of a pool
+
+    Connections of a pool go back to it after each operation, so they must
+    not be kept for later use: check another one out instead.
+
+    :param conn: LDAP connection
+    :return: callable returning a context manager giving a connection of the
+        same pool bound with the same credentials, None if conn does not
+        belong to a LDAPConnectionPool"""
+    pool = _connection_pools.get(conn)
+    if pool is None:
+        return None
+    return functools.partial(pool.connection, pool.credentials_of(conn))
+
+
+def get_pool(identifier: str='DEFAULT', **kwargs) -> LDAPConnectionPool:
+    """Get a LDAP connection pool.
+
+    First time a pool is called, the kwargs are used and passed to
+    LDAPConnectionPool.
+
+    :param identifier: identifier of the pool
+    """
+    with _ldap_pools_lock:
+        try:
+            return _ldap_pools[identifier]
+        except KeyError:
+            logger.info('Creating new connection pool to LDAP: %s ', identifier)
+        try:
+            pool = _ldap_pools[identifier] = LDAPConnectionPool(**kwargs)
+            return pool
+        except (TypeError, LDAPError) as e:
+            logger.error('Cannot initialize LDAP connection pool %s: %s', identifier, str(e))
+            raise
+
+
+def get_ldap(identifier: str='DEFAULT', **kwargs) -> LDAPObject:
     """Get a LDAP connection.
 
     First time a connection is called and created successfully, the
-    kwargs are used and passed to ldap.initialize.
+    kwargs are used and passed to ldap.initialize. The connection is shared
+    by all the callers: multi-threaded programs use get_pool instead.
 
     :param identifier: identifier of the connection
     """
-    global _ldap_conns
+    with _ldap_conns_lock:
+        try:
+            return _ldap_conns[identifier]
+        except KeyError:
+            logger.info('Creating new connection to LDAP: %s ', identifier)
+        try:
+            s = ldap.initialize(**kwargs)
+            _ldap_conns[identifier] = s
+            return s
+        except (TypeError, LDAPError) as e:
+            logger.error('Cannot get or initialize LDAP connection %s: %s', identifier, str(e))
+            raise
+
+
+def test_connection_pool():
+    # connections are opened lazily by python-ldap, no bind without credentials
+    pool = LDAPConnectionPool('ldap://localhost', max_size=2, idle_timeout=0)
+    done = threading.Event()
+
+    def worker():
+        with pool.connection() as conn:
+            held.append(conn)
+            done.wait(5)
+    held = []
+    threads = [threading.Thread(target=worker) for _ in range(2)]
+    for t in threads:
+        t.start()
+    deadline = time.monotonic() + 5
+    while len(held) < 2 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert len(held) == 2 and held[0] is not held[1]
     try:
-        return _ldap_conns[identifier]
-    except KeyError:
-        logger.info('Creating new connection to LDAP: %s ', identifier)
+        pool.checkout(timeout=0.05)
+    except PoolTimeout:
+        pass
+    else:
+        assert False, 'the pool must be exhausted'
+    done.set()
+    for t in threads:
+        t.join()
+    with pool.connection():
+        stats = pool.stats()
+        assert stats['in_use'] == 1 and stats['size'] == 1
+    stats = pool.stats()
+    # idle connections are closed at once with idle_timeout=0
+    assert stats['created'] == 3 and stats['closed'] == 3 and stats['waits'] == 1
+    assert stats['checkouts'] == 4 and stats['size'] == 0
+
+
+class _TestConnection(object):
+    """Connection recording the identities it is bound with"""
+
+    def __init__(self):
+        self.binds = []
+
+    def simple_bind_s(self, who, cred):
+        self.binds.append(who)
+
+    def unbind_s(self):
+        pass
+
+
+class _TestPool(LDAPConnectionPool):
+    def _connect(self):
+        self._count('created')
+        return _PoolEntry(_TestConnection())
+
+
+def test_connection_pool_credentials():
+    pool = _TestPool('ldap://localhost', max_size=1)
+    with pool.connection(('cn=a,dc=example,dc=com', 'a')) as conn:
+        assert conn.binds == ['cn=a,dc=example,dc=com']
+    # the same connection is bound anonymously again, not left bound as cn=a
+    with pool.connection() as anonymous:
+        assert anonymous is conn and conn.binds[-1] == ''
+        assert pool.credentials_of(anonymous) is None
+    with pool.connection():
+        pass
+    assert pool.stats()['binds'] == 2 and pool.stats()['created'] == 1
+
+
+def paged_search(ldap_conn, base, scope, filterstr='(objectClass=*)',
+                 attrlist=None, page_size=500):
+    """Search with the Simple Paged Results control (RFC 2696)
+
+    Generator yielding (dn, attrs) tuples page by page. If the generator is
+    closed before the last page, the paged search is abandoned on the server.
+
+    :param ldap_conn: a LDAP connection
+    :param base: base DN of the search
+    :param scope: scope of the search
+    :param filterstr: filter of the search
+    :param attrlist: attributes to request
+    :param page_size: number of entries per page"""
+    for page in paged_search_pages(ldap_conn, base, scope, filterstr,
+                                   attrlist, page_size):
+        yield from page
+
+
+def paged_search_pages(ldap_conn, base, scope, filterstr='(objectClass=*)',
+                       attrlist=None, page_size=500):
+    """Search with the Simple Paged Results control (RFC 2696)
+
+    Generator yielding lists of (dn, attrs) tuples, one list per page. If the
+    generator is closed before the last page, the paged search is abandoned
+    on the server.
+
+    :param ldap_conn: a LDAP connection
+    :param base: base DN of the search
+    :param scope: scope of the search
+    :param filterstr: filter of the search
+    :param attrlist: attributes to request
+    :param page_size: number of entries per page"""
+    ctrl = SimplePagedResultsControl(True, size=page_size, cookie='')
+    done = False
     try:
-        s = ldap.initialize(**kwargs)
-        _ldap_conns[identifier] = s
-        return s
-    except (TypeError, LDAPError) as e:
-        logger.error('Cannot get or initialize LDAP connection %s: %s', identifier, str(e))
-        raise
+        while True:
+            msgid = ldap_conn.search_ext(base, scope, filterstr,
+                                         attrlist=attrlist, serverctrls=[ctrl])
+            (_, rdata, _, rctrls) = ldap_conn.result3(msgid)
+            ctrl.cookie = ''
+            for c in rctrls or []:
+                if c.controlType == SimplePagedResultsControl.controlType:
+                    ctrl.cookie = c.cookie
+            if not ctrl.cookie:
+                done = True
+            # skip search continuation references
+            yield [(dn, attrs) for (dn, attrs) in rdata if dn is not None]
+            if done:
+                return
+    finally:
+        if not done and ctrl.cookie:
+            logger.debug('Abandoning paged search on %s', base)
+            ctrl.size = 0
+            try:
+                ldap_conn.result3(ldap_conn.search_ext(
+                    base, scope, filterstr, attrlist=attrlist, serverctrls=[ctrl]))
+            except LDAPError as e:
+                logger.warning('Cannot abandon paged search on %s: %s', base, e)
+
+
+def _test_directory(count=5):
+    from benchmarks.fakeldap import FakeLDAPObject
+    entries = {'ou=people,dc=example,dc=com': {'objectClass': [b'organizationalUnit'],
+                                               'ou': [b'people']}}
+    for i in range(count):
+        entries['uid=user{},ou=people,dc=example,dc=com'.format(i)] = {
+            'objectClass': [b'inetOrgPerson'], 'uid': ['user{}'.format(i).encode()],
+            'cn': [b'User'], 'sn': [b'User']}
+    return FakeLDAPObject(entries)
+
 
+def test_paged_search_pages():
+    conn = _test_directory()
+    pages = list(paged_search_pages(conn, 'ou=people,dc=example,dc=com',
+                                    ldap.SCOPE_ONELEVEL, page_size=2))
+    assert [len(p) for p in pages] == [2, 2, 1]
+    assert len(set(dn for page in pages for (dn, _) in page)) == 5
+    assert conn.paged == {}
+    # closing the generator early abandons the search on the server
+    search = paged_search_pages(conn, 'ou=people,dc=example,dc=com',
+                                ldap.SCOPE_ONELEVEL, page_size=2)
+    assert len(next(search)) == 2 and conn.paged
+    search.close()
+    assert conn.paged == {} and conn._results == {}
 
 def get_proper_type(result, all_types):
-    return build_composedtype(result.get('objectClass', []), all_types)
+    """Class of an entry, from its objectClass values
+
+    :param result: attributes of the entry, objectClass in any case
+    :param all_types: ObjectClassDict of all available types
+    :return: PloumObj class
+    :raise KeyError: if the entry has no objectClass, or one unknown to the schema"""
+    ocs = result.get('objectClass')
+    if ocs is None:
+        ocs = next((v for (k, v) in result.items() if k.lower() == 'objectclass'), None)
+    typ = build_composedtype(ocs or (), all_types)
+    if typ is None:
+        raise KeyError('entry without objectClass')
+    return typ
 
 
-@slacker_cacher_decorator
 def build_composedtype(ocs, all_types):
     """Build a composed type from a list of object classes.
 
-    all_types
+    Entries with the same objectClasses, in any order, share a single class.
+
     :param ocs: wanted object classes
-    :param all_types: dict of all available types previously discovered"""
-    typ = None
-    met_types = []
-    for i in ocs:
-        if typ is None:
-            typ = all_types[i]
-        else:
-            typ += all_types[i]
-        for j in typ.sup_classes:
-            if j not in met_types:
-                typ += all_types[j]
-                met_types.append(j)
-        met_types.append(i)
-    return typ
+    :param all_types: ObjectClassDict of all available types previously discovered"""
+    return all_types.compose(ocs)
 
 
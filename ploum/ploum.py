@@ -4,16 +4,52 @@
 by Chloé Desoutter <chloe.desoutter@nbs-system.com>, <chloe@tigres-rouges.net>
 """
 
+import contextlib
 import logging
+import weakref
 from . import plumbing
-from .ldap_utils import get_proper_type, get_ldap
+from .ldap_utils import get_proper_type, get_ldap, get_pool, paged_search_pages
 from .ldap_lib import build_properties
-from copy import deepcopy
 from ctrmisctk.utils import is_scalar, bytify, slacker_cacher_decorator
 import ldap.modlist
+from . import classmagic
 from .classmagic import ComposableType
+from . import schema_snapshot
+from . import aio
+from . import instrumentation
+from .lazy import LazyFetcher
+from .views import EntryView
+from .filters import Filter, compile_filter, criteria_filter
 
 logger = logging.getLogger(__name__)
+_write_listeners = weakref.WeakSet()
+
+
+def register_write_listener(listener):
+    """Register an object to be told when an item is saved or deleted
+
+    listener.invalidate(dn) is called once the write succeeded. Listeners
+    are weakly referenced.
+
+    :param listener: object with an invalidate(dn) method"""
+    _write_listeners.add(listener)
+
+
+def notify_write(dn):
+    """Tell the write listeners that an item was saved or deleted
+
+    :param dn: DN of the item"""
+    for listener in list(_write_listeners):
+        listener.invalidate(dn)
+
+
+def _state_values(value):
+    """Values of an attribute state as a list"""
+    if value is None:
+        return []
+    if is_scalar(value):
+        return [value]
+    return list(value)
 
 
 class PloumObj(object, metaclass=ComposableType):
@@ -26,13 +62,20 @@ class PloumObj(object, metaclass=ComposableType):
     :param initial_attrs: optional initial attributes of this LDAP entity
 
     initial_attrs must implement a mapping interface (multidict) and be
-    iterable over items(), values() and keys()."""
+    iterable over items(), values() and keys().
+
+    The state of instances is held in __slots__, the schema metadata by the
+    class. Classes built in compact mode (LDAPFactory.use_compact_classes)
+    add no __dict__, so items then take no ad-hoc attributes."""
+    state_slots = ('_already_exists', '_dn', '_attrs', '_deleted', '_journal', '_fetcher')
+    __slots__ = state_slots + ('__weakref__', )
     virtual_fields = (
         'entryDN', 'subschemaSubentry', 'modifyTimestamp', 'modifiersName',
         'creatorsName', 'creatorsTimestamp', 'hasSubordinates', 'entryCSN',
         'createTimestamp', 'structuralObjectClass', 'entryUUID',
         'contextCSN',
     )
+    per_class_attrs = ('_field_index', '_serial_plan')
 
     def __new__(cls, *args, **kwargs):
         obj = super().__new__(cls)
@@ -45,26 +88,78 @@ class PloumObj(object, metaclass=ComposableType):
         self._dn = None
         self._attrs = {}
         self._deleted = False
-        self._base_state = None
+        self._journal = {}
+        self._fetcher = None
         if dn and initial_attrs:
             self.populate(dn, initial_attrs)
 
+    @classmethod
+    def get_field_index(cls):
+        """Case-insensitive index of the fields of this class
+
+        Built once per class, on first use.
+
+        :return: tuple (dict lowercase name → (name, attribute class),
+            frozenset of lowercase virtual field names)"""
+        idx = cls.__dict__.get('_field_index')
+        if idx is None:
+            fields = {}
+            for name in ('objectClass', ) + tuple(cls.must_fields) + tuple(cls.may_fields):
+                if name.lower() not in fields:
+                    fields[name.lower()] = (name, cls.attr_types[name])
+            idx = (fields, frozenset(a.lower() for a in cls.virtual_fields))
+            cls._field_index = idx
+        return idx
+
     def populate(self, dn, attrs):
         self.dn = dn
         self._already_exists = True
         for (i, j) in attrs.items():
-            low = i.lower()
-            if low in list(a.lower() for a in self.virtual_fields):
-                continue
-            if low not in ('objectclass',) + tuple(
-                    a.lower() for a in self.may_fields + self.must_fields):
-                logger.error('%s: cannot assign unknown attribute %s', type(self), i)
-                raise KeyError('Cannot assign unknown attribute !')
-            if low not in self._attrs:
-                self._attrs[low] = self.attr_types[i]()
-            self._attrs[low] += j
-            self._attrs[low].set_clean()
-        self._base_state = deepcopy(self._attrs)
+            self.load_attribute(i, j)
+        self._journal = {}
+
+    def load_attribute(self, name, values):
+        """Load values of an attribute as read from the server
+
+        :param name: name of the attribute
+        :param values: values of the attribute"""
+        (fields, virtual) = self.get_field_index()
+        low = name.lower()
+        if low in virtual:
+            return
+        try:
+            attr_class = fields[low][1]
+        except KeyError:
+            logger.error('%s: cannot assign unknown attribute %s', type(self), name)
+            raise KeyError('Cannot assign unknown attribute !') from None
+        if low not in self._attrs:
+            self._attrs[low] = attr_class()
+        self._attrs[low] += values
+        self._attrs[low].set_clean()
+
+    def get_attribute(self, low):
+        """Return the LDAPAttribute of a field
+
+        If the field was left out of the search that loaded this item, it is
+        fetched first, for the whole result set.
+
+        :param low: lowercase name of the field
+        :return: LDAPAttribute or None"""
+        attr = self._attrs.get(low)
+        if attr is None and self._fetcher is not None and self._fetcher.is_missing(low, self.dn):
+            self._fetcher.fetch(self.get_field_index()[0][low][0])
+            attr = self._attrs.get(low)
+        return attr
+
+    def replace_attribute(self, low, attr):
+        """Replace an attribute of this item, remembering its clean value
+
+        :param low: lowercase name of the attribute
+        :param attr: new LDAPAttribute"""
+        if low not in self._journal:
+            old = self._attrs.get(low)
+            self._journal[low] = old.get_base_state() if old is not None else None
+        self._attrs[low] = attr
 
     def __repr__(self):
         return '{}({}, {})'.format(self.__class__.__name__, repr(self.dn), repr(self._attrs))
@@ -76,70 +171,274 @@ class PloumObj(object, metaclass=ComposableType):
         return '(objectClass=*)'
 
     def get_old_and_current_state(self) -> list:
-        """Generate a modification list for this PloumObj"""
+        """Generate a modification list for this PloumObj
+
+        Clean values are read from the journal of replaced attributes, or
+        from the attributes themselves, which keep them on first change."""
         old = {}
         new = {}
-        old_item = self._base_state
         for (k, v) in self._attrs.items():
-            if old_item:
-                old[k] = old_item[k]._value
+            if k in self._journal:
+                old[k] = self._journal[k]
             else:
                 old[k] = v.get_base_state()
-            if is_scalar(old[k]):
+            if old[k] is None:
+                old[k] = []
+            elif is_scalar(old[k]):
                 logger.debug("Wrapping in array: %s", old[k])
                 old[k] = [bytify(old[k])]
-            if is_scalar(v.value):
+            else:
+                old[k] = list(bytify(a) for a in old[k])
+            if v.value is None:
+                new[k] = []
+            elif is_scalar(v.value):
                 new[k] = [bytify(v.value)]
             else:
-                new[k] = list(bytify(a) for a in v.value or [])
+                new[k] = list(bytify(a) for a in v.value)
             logger.info("New: %s → %s", k, new[k])
         return old, new
 
-    def mark_clean(self):
-        """Mark all attributes as clean"""
+    def get_modlist(self) -> list:
+        """Generate the modification list of the changes made to this item
+
+        Only dirty or replaced attributes are compared with their clean
+        value. Multi-valued attributes get MOD_DELETE and MOD_ADD operations
+        for the values removed and added, compared following their equality
+        matching rule, single-valued ones a MOD_REPLACE.
+
+        :return: list of (op, name, values), empty if nothing changed"""
+        fields = self.get_field_index()[0]
+        res = []
+        for (low, attr) in self._attrs.items():
+            if low in self._journal:
+                old = self._journal[low]
+            elif attr is not None and attr.dirty:
+                old = attr.get_base_state()
+            else:
+                continue
+            old = _state_values(old)
+            new = _state_values(attr.value if attr is not None else None)
+            (old_values, new_values) = (set(old), set(new))
+            if old_values == new_values:
+                continue
+            (name, attr_class) = fields[low]
+            if not new:
+                res.append((ldap.MOD_DELETE, name, None))
+            elif attr_class.properties['single_value']:
+                res.append((ldap.MOD_REPLACE, name, [bytify(v) for v in new]))
+            elif not old:
+                res.append((ldap.MOD_ADD, name, [bytify(v) for v in new]))
+            else:
+                deleted = [v for v in old if v not in new_values]
+                added = [v for v in new if v not in old_values]
+                key = plumbing.matching_key(attr_class.properties['equality'])
+                if key is not None:
+                    # values differing as strings may still be equal for the server
+                    (deleted_keys, added_keys) = (set(map(key, deleted)), set(map(key, added)))
+                    deleted = [v for v in deleted if key(v) not in added_keys]
+                    added = [v for v in added if key(v) not in deleted_keys]
+                if deleted:
+                    res.append((ldap.MOD_DELETE, name, [bytify(v) for v in deleted]))
+                if added:
+                    res.append((ldap.MOD_ADD, name, [bytify(v) for v in added]))
+        return res
+
+    def mark_clean(self, notify=True):
+        """Mark all attributes as clean
+
+        :param notify: tell the write listeners, to be left out when nothing
+            was written"""
         for i in self._attrs.values():
             i.set_clean()
+        self._journal = {}
+        if notify:
+            notify_write(self.dn)
         return True
 
     def mark_deleted(self):
         self._deleted = True
+        notify_write(self.dn)
         return True
 
+    @classmethod
+    def build_filter(cls, expr, params=None):
+        """Render a filter expression, checked against the schema
+
+        :param expr: ploum.filters.Filter expression
+        :param params: values of the Param placeholders of the expression
+        :return: filter string"""
+        return compile_filter(expr, cls.attr_types).render(params)
+
+    @classmethod
+    def _search_params(cls, base_dn, scope, filterstr, force_full_dn, criteria,
+                       filter_params=None):
+        """Compute base, scope and filter of a search
+
+        Keyword criteria are equality assertions: their values are escaped
+        and their attributes checked against the schema.
+
+        :param base_dn: where we will search
+        :param scope: scope of the search
+        :param filterstr: optional filter, string or ploum.filters.Filter expression
+        :param force_full_dn: if True, search base_dn itself
+        :param criteria: dict of the keyword criteria, used without filterstr
+        :param filter_params: values of the Param placeholders of filterstr
+        :return: tuple (base, scope, filterstr)
+        :raise ploum.filters.FilterError: if an attribute is unknown or has
+            no matching rule for its assertion"""
+        if not base_dn:
+            raise ValueError('No base_dn provided. Cannot search.')
+        if force_full_dn:
+            return base_dn, ldap.SCOPE_BASE, '(objectClass=*)'
+        if isinstance(filterstr, Filter):
+            filterstr = cls.build_filter(filterstr, filter_params)
+        elif not filterstr and criteria:
+            filterstr = cls.build_filter(*criteria_filter(criteria))
+        filterstr = filterstr or '(objectClass=*)'
+        filterstr = "(&{}{})".format(filterstr, cls.get_minimal_filter())
+        return cls.local_dn() + base_dn, scope, filterstr
+
+    @staticmethod
+    def _search_attrlist(attrlist, operational):
+        """Compute the attributes requested by a search
+
+        :param attrlist: wanted attributes, None for all user attributes
+        :param operational: if True, also request operational attributes
+        :return: list of attribute names"""
+        if attrlist is None:
+            res = ['*']
+        else:
+            res = list(attrlist) + ['objectClass']
+        if operational:
+            res.append('+')
+        return res
+
     @classmethod
     def search_all_ldap(cls, base_dn=None,
                         scope=ldap.SCOPE_SUBTREE, filterstr=None,
-                        force_full_dn=False,
-                        **kwargs):
-        """Search all items that match the provided '=' criteria
+                        force_full_dn=False, attrlist=None, operational=False,
+                        filter_params=None, view=False, **kwargs):
+        """Search all items that match the provided '=' criteria, or filterstr
 
         :param base_dn: where we will search
         :param scope: scope of the search
-        :param filterstr: optional filter
+        :param filterstr: optional filter, string or ploum.filters.Filter expression
         :param force_full_dn: if True, take provided filterstr literally
+        :param attrlist: attributes to request, None for all of them. Other
+            attributes are fetched on first access, for all the matches at once.
+        :param operational: if True, also request operational attributes
+        :param filter_params: values of the Param placeholders of filterstr
+        :param view: if True, make read-only ploum.views.EntryView instead of
+            PloumObj, decoding values only when read
         :return: callable(ldapconn) that will make a list of matches"""
-        if not base_dn:
-            raise ValueError('No base_dn provided. Cannot search.')
-        if not force_full_dn:
-            filterstr = filterstr or '(&{})'.format(
-                ''.join(list(
-                    '({}={})'.format(k, v) for (k, v) in kwargs.items())
-                )
-            )
-            if filterstr == '(&)':
-                filterstr = '(objectClass=*)'
-            filterstr = "(&{}{})".format(filterstr, cls.get_minimal_filter())
-            return lambda ldapconn: [
-                get_proper_type(attr, cls.datadict)(dn, attr)
-                for (dn, attr) in ldapconn.search_ext_s(
-                    cls.local_dn() + base_dn, scope, filterstr=filterstr, attrlist=['*', '+'])]
-        else:
-            return lambda ldapconn: [
-                get_proper_type(attr, cls.datadict)(dn, attr)
-                for (dn, attr) in ldapconn.search_ext_s(
-                    base_dn, ldap.SCOPE_BASE, filterstr='(objectClass=*)',
-                    attrlist=['*', '+']
-                )
-                ]
+        (base, scope, filterstr) = cls._search_params(
+            base_dn, scope, filterstr, force_full_dn, kwargs, filter_params)
+        attrs = cls._search_attrlist(attrlist, operational)
+
+        def search(ldapconn):
+            with instrumentation.operation('search', base, filterstr) as op:
+                with op.phase('server'):
+                    results = ldapconn.search_ext_s(
+                        base, scope, filterstr=filterstr, attrlist=attrs)
+                res = cls._materialize(results, op, view)
+            if attrlist is not None and not view:
+                LazyFetcher(ldapconn, base, scope, filterstr, attrs).register(res)
+            return res
+        return search
+
+    @classmethod
+    def _materialize(cls, results, op, view=False):
+        """Build the items of a search result
+
+        :param results: list of (dn, attrs)
+        :param op: instrumentation event of the search
+        :param view: if True, build EntryView instead of PloumObj
+        :return: list of PloumObj or EntryView"""
+        op.record_results(results)
+        if view:
+            return [EntryView(dn, attr, cls) for (dn, attr) in results]
+        with op.phase('types'):
+            types = [get_proper_type(attr, cls.datadict) for (_, attr) in results]
+        with op.phase('populate'):
+            return [typ(dn, attr) for (typ, (dn, attr)) in zip(types, results)]
+
+    @classmethod
+    def search_iter_ldap(cls, base_dn=None,
+                         scope=ldap.SCOPE_SUBTREE, filterstr=None,
+                         force_full_dn=False, page_size=500,
+                         attrlist=None, operational=False,
+                         filter_params=None, view=False, **kwargs):
+        """Search all items that match the provided '=' criteria, page by page
+
+        Same as search_all_ldap, but the search uses the Simple Paged Results
+        control and items are yielded as pages arrive.
+
+        :param base_dn: where we will search
+        :param scope: scope of the search
+        :param filterstr: optional filter, string or ploum.filters.Filter expression
+        :param force_full_dn: if True, take provided filterstr literally
+        :param page_size: number of entries requested per page
+        :param attrlist: attributes to request, None for all of them. Other
+            attributes are fetched on first access, for all the matches of
+            the page at once.
+        :param operational: if True, also request operational attributes
+        :param filter_params: values of the Param placeholders of filterstr
+        :param view: if True, make read-only ploum.views.EntryView instead of
+            PloumObj, decoding values only when read
+        :return: callable(ldapconn) that will make a generator of matches"""
+        (base, scope, filterstr) = cls._search_params(
+            base_dn, scope, filterstr, force_full_dn, kwargs, filter_params)
+        attrs = cls._search_attrlist(attrlist, operational)
+
+        def search(ldapconn):
+            pages = paged_search_pages(ldapconn, base, scope, filterstr,
+                                       attrs, page_size)
+            # a single event for the whole iteration, its phases summed over the pages
+            with contextlib.closing(pages), \
+                    instrumentation.operation('search', base, filterstr) as op:
+                while True:
+                    with op.phase('server'):
+                        page = next(pages, None)
+                    if page is None:
+                        return
+                    items = cls._materialize(page, op, view)
+                    if attrlist is not None and not view:
+                        LazyFetcher(ldapconn, base, scope, filterstr,
+                                    attrs, page_size).register(items)
+                    yield from items
+        return search
+
+    @classmethod
+    def search_all_ldap_async(cls, base_dn=None,
+                              scope=ldap.SCOPE_SUBTREE, filterstr=None,
+                              force_full_dn=False, attrlist=None,
+                              operational=False, filter_params=None,
+                              view=False, **kwargs):
+        """Search all items that match the provided '=' criteria, asynchronously
+
+        Same as search_all_ldap, but the callable is a coroutine function
+        that does not block the event loop. Attributes left out of attrlist
+        are not fetched on access.
+
+        :param base_dn: where we will search
+        :param scope: scope of the search
+        :param filterstr: optional filter, string or ploum.filters.Filter expression
+        :param force_full_dn: if True, take provided filterstr literally
+        :param attrlist: attributes to request, None for all of them
+        :param operational: if True, also request operational attributes
+        :param filter_params: values of the Param placeholders of filterstr
+        :param view: if True, make read-only ploum.views.EntryView instead of PloumObj
+        :return: async callable(ldapconn) that will make a list of matches"""
+        (base, scope, filterstr) = cls._search_params(
+            base_dn, scope, filterstr, force_full_dn, kwargs, filter_params)
+        attrs = cls._search_attrlist(attrlist, operational)
+
+        async def search(ldapconn):
+            with instrumentation.operation('search', base, filterstr) as op:
+                with op.phase('server'):
+                    results = await aio.search(ldapconn, base, scope, filterstr, attrs)
+                return cls._materialize(results, op, view)
+        return search
 
     @classmethod
     def local_dn(cls):
@@ -160,55 +459,169 @@ class PloumObj(object, metaclass=ComposableType):
     def dn(self, value):
         self._dn = value
 
-    def save_ldap(self) -> 'callable(ldapconn)':
-        """Prepare save of an item. Return a callable that eats the connection.
+    def _prepare_save(self):
+        """Compute the operation needed to save this item
 
-        :return: lambda(SimpleLDAPObject) which, when called, will persist the item
-            and mark it clean"""
-        to_create = True
+        :return: tuple (to_create, modlist)"""
         logger.info("saving entity %s: %s", self.names, self.dn)
-        (initial_state, new_state) = self.get_old_and_current_state()
         if self._already_exists:
             to_create = False
-            ldif = ldap.modlist.modifyModlist(initial_state, new_state, ignore_oldexistent=1)
+            ldif = self.get_modlist()
         else:
-            ldif = ldap.modlist.addModlist(new_state)
-        logger.info("to-create: %s - Will save %s from\n[\n%s,\n%s]", to_create, ldif, initial_state, new_state)
-        if to_create:
-            return lambda ldapconn: ldapconn.add_s(self.dn, ldif) and self.mark_clean()
-        return lambda ldapconn: ldapconn.modify_s(self.dn, ldif) and self.mark_clean()
+            to_create = True
+            ldif = ldap.modlist.addModlist(self.get_old_and_current_state()[1])
+        logger.info("to-create: %s - Will save %s", to_create, ldif)
+        return to_create, ldif
+
+    def save_ldap(self) -> 'callable(ldapconn)':
+        """Prepare save of an item. Return a callable that eats the connection.
+
+        :return: lambda(SimpleLDAPObject) which, when called, will persist the item
+            and mark it clean"""
+        elapsed = instrumentation.timer()
+        (to_create, ldif) = self._prepare_save()
+        prepare_time = elapsed()
+
+        def save(ldapconn):
+            if not to_create and not ldif:
+                logger.debug('Nothing to save for %s', self.dn)
+                return self.mark_clean(notify=False)
+            with instrumentation.operation('add' if to_create else 'modify', self.dn) as op:
+                op.add_phase('prepare', prepare_time)
+                with op.phase('server'):
+                    if to_create:
+                        res = ldapconn.add_s(self.dn, ldif)
+                    else:
+                        res = ldapconn.modify_s(self.dn, ldif)
+                return res and self.mark_clean()
+        return save
+
+    def save_ldap_async(self) -> 'coroutine function(ldapconn)':
+        """Prepare save of an item. Return a coroutine function that eats the connection.
+
+        :return: async callable(SimpleLDAPObject) which, when awaited, will persist
+            the item and mark it clean"""
+        elapsed = instrumentation.timer()
+        (to_create, ldif) = self._prepare_save()
+        prepare_time = elapsed()
+
+        async def save(ldapconn):
+            if not to_create and not ldif:
+                logger.debug('Nothing to save for %s', self.dn)
+                return self.mark_clean(notify=False)
+            with instrumentation.operation('add' if to_create else 'modify', self.dn) as op:
+                op.add_phase('prepare', prepare_time)
+                with op.phase('server'):
+                    if to_create:
+                        res = await aio.add(ldapconn, self.dn, ldif)
+                    else:
+                        res = await aio.modify(ldapconn, self.dn, ldif)
+                return res and self.mark_clean()
+        return save
 
     def delete_ldap(self) -> 'callable(ldapconn)':
         """Prepare delete of an item. Return a callable that eats the connection.
 
         :return: lambda(SimpleLDAPObject) which when called will delete the entry
         and mark it deleted"""
-        return lambda ldapconn: ldapconn.delete_s(self.dn) and self.mark_deleted()
+        def delete(ldapconn):
+            with instrumentation.operation('delete', self.dn) as op:
+                with op.phase('server'):
+                    res = ldapconn.delete_s(self.dn)
+                return res and self.mark_deleted()
+        return delete
+
+    def delete_ldap_async(self) -> 'coroutine function(ldapconn)':
+        """Prepare delete of an item. Return a coroutine function that eats the connection.
+
+        :return: async callable(SimpleLDAPObject) which, when awaited, will delete
+            the entry and mark it deleted"""
+        async def delete(ldapconn):
+            with instrumentation.operation('delete', self.dn) as op:
+                with op.phase('server'):
+                    res = await aio.delete(ldapconn, self.dn)
+                return res and self.mark_deleted()
+        return delete
 
 
 class LDAPFactory(object):
     """Factory class to build LDAP classes
 
     Optionally one may establish_connection before doing the get_class calls.
-    This makes passing the conn parameter optional.
+    This makes passing the conn parameter optional: the schema is then loaded
+    once, on a connection checked out of LDAPFactory.pool.
     """
     __module__ = __name__
     objclasses = None
+    typedict = None
     conn = None
+    pool = None
     base_dn = None
+    snapshot_path = None
+    offline = False
+    compact = False
+    static = False
 
     @classmethod
-    def establish_connection(cls, ldap_url, credentials, base_dn):
+    def establish_connection(cls, ldap_url, credentials, base_dn, **pool_options):
         """Establish a connection to a LDAP
 
+        LDAPFactory.conn is a bound connection shared by all its users.
+        Multi-threaded programs rather check connections out of the pool
+        LDAPFactory.pool per operation, with LDAPFactory.pool.connection().
+
         :param ldap_url: URL of LDAP to connect to
         :param credentials: tuple (login, password) of credentials passed to bind
+        :param pool_options: options of the LDAPConnectionPool
         :return: None
         """
         cls.conn = get_ldap('LDAPFactory', uri=ldap_url)
         cls.conn.bind(*credentials)
+        cls.pool = get_pool('LDAPFactory', uri=ldap_url, credentials=credentials,
+                            **pool_options)
         cls.base_dn = base_dn
         cls.objclasses = None
+        cls.static = False
+
+    @classmethod
+    def use_schema_snapshot(cls, path, offline=False):
+        """Use a local schema snapshot file to build classes
+
+        :param path: path of the snapshot file, created if missing
+        :param offline: if True, never contact the server to load the schema
+        :return: None
+        """
+        cls.snapshot_path = path
+        cls.offline = offline
+        cls.objclasses = None
+        cls.static = False
+
+    @classmethod
+    def use_compact_classes(cls, compact=True):
+        """Build classes whose instances have no __dict__
+
+        Saves memory on large result sets, but the items and their
+        attributes cannot hold ad-hoc attributes anymore.
+
+        :param compact: if False, go back to classes with a __dict__
+        :return: None
+        """
+        cls.compact = compact
+        cls.objclasses = None
+        cls.static = False
+
+    @classmethod
+    def use_static_classes(cls, module):
+        """Use the classes of a module generated by ploum.codegen
+
+        No schema is loaded anymore: get_class only knows the objectClasses
+        of the module.
+
+        :param module: generated module
+        :return: None
+        """
+        cls.objclasses = module.object_classes
+        cls.static = True
 
     @classmethod
     def get_class(cls, objectclasses: (str,), conn: "ldap connection"=None) -> PloumObj:
@@ -217,29 +630,36 @@ class LDAPFactory(object):
         :param objectclasses: string objectClass or tuple of strings objectClasses
         :param conn: optional connection to use
         :return: python class"""
-        if not conn and not cls.conn:
+        if cls.static:
+            return cls.objclasses.get_class(objectclasses)
+        if conn or cls.offline:
+            cls.objclasses, cls.typedict = load_schemas(
+                conn, snapshot=cls.snapshot_path, offline=cls.offline, compact=cls.compact)
+        elif cls.pool is None and cls.conn is None:
             raise RuntimeError('Cannot get_class without establish_connection before')
-        elif not conn and cls.conn:
-            conn = cls.conn
-        cls.objclasses, typedict = load_schemas(conn)
-        if isinstance(objectclasses, str):
-            objectclasses = (objectclasses,)
-        typ = get_proper_type(dict(objectClass=objectclasses), cls.objclasses)
-        typ.__name__ = 'LDAP_{}'.format('_'.join(objectclasses))
-        return build_properties(typedict)(typ)
-
-
-def build_ldapclass(object_class, attrdefs, all_types):
+        elif cls.objclasses is None and cls.pool is None:
+            cls.objclasses, cls.typedict = load_schemas(
+                cls.conn, snapshot=cls.snapshot_path, offline=cls.offline, compact=cls.compact)
+        elif cls.objclasses is None:
+            with cls.pool.connection() as conn:
+                cls.objclasses, cls.typedict = load_schemas(
+                    conn, snapshot=cls.snapshot_path, offline=cls.offline,
+                    compact=cls.compact)
+        return cls.objclasses.get_class(objectclasses)
+
+
+def build_ldapclass(object_class, attrdefs, all_types, compact=False):
     """Build a Python class for a LDAP objectClass
 
     :param object_class: objectClass for which we want a python class
     :param attrdefs: dict of possible attributes introspecet
     :param all_types: dict referencing all introspected types
+    :param compact: if True, instances have no __dict__
     :return: python class"""
     if object_class:
         c = type('LDAPEntity_{}'.format(object_class.names[0]),
                  (PloumObj,),
-                 {
+                 dict({} if not compact else {'__slots__': ()}, **{
                      'names': plumbing.ArithmeticList(object_class.names or []),
                      'must_fields': plumbing.ArithmeticList(object_class.must or []),
                      'may_fields': plumbing.ArithmeticList(object_class.may or []),
@@ -248,16 +668,16 @@ def build_ldapclass(object_class, attrdefs, all_types):
                      'oid': object_class.oid,
                      'attr_types': attrdefs,
                      'datadict': all_types
-                 }
+                 })
                  )
         return c
 
 
-@slacker_cacher_decorator
-def load_schemas(ldap_conn) -> dict:
-    """Load schemas from a LDAP connection and return them
+def fetch_subschema(ldap_conn) -> (str, dict):
+    """Fetch the subschema subentry of a LDAP server
 
-    :param ldap_conn: a LDAP connection"""
+    :param ldap_conn: a LDAP connection
+    :return: (subschema DN, subschema entry attributes)"""
     subschema_res = ldap_conn.search_s(
         base='', scope=ldap.SCOPE_BASE,
         filterstr='(objectClass=*)', attrlist=['subschemaSubEntry'])
@@ -272,25 +692,238 @@ def load_schemas(ldap_conn) -> dict:
     logger.debug('Loading LDAP schema')
     schemata_r = ldap_conn.search_s(
         base=subschemacn, scope=ldap.SCOPE_BASE, attrlist=['*', '+'])
-    schemata = ldap.schema.SubSchema(schemata_r[0][1])
-    object_classes = schemata.tree(ldap.schema.ObjectClass)
-    attrs_types = schemata.tree(ldap.schema.AttributeType)
-    datadict = {}
-    typedict = {}
-    for t in attrs_types:
-        typ = schemata.get_obj(ldap.schema.AttributeType, t)
-        if not typ:
-            logger.error("Cannot find type for %s", t)
-            continue
-        for n in typ.names:
-            typedict[n] = plumbing.AttributeFactory.build_attribute_class(typ, attrs_types)
-    for o in object_classes:
-        obj = schemata.get_obj(ldap.schema.ObjectClass, o)
-        if obj:
-            c = build_ldapclass(obj, typedict, datadict)
-            for i in obj.names:
-                datadict[i] = c
-                datadict[i.encode('utf-8')] = c
+    return subschemacn, schemata_r[0][1]
+
+
+class ObjectClassDict(plumbing.LazySchemaDict):
+    """Lazy mapping of objectClass names to PloumObj classes
+
+    Building a class also builds the classes of its superior objectClasses.
+
+    :param schemata: ldap.schema.SubSchema to build classes from
+    :param typedict: mapping of attribute names to attribute classes
+    :param compact: if True, build classes whose instances have no __dict__"""
+    schema_class = ldap.schema.ObjectClass
+
+    # STRUCTURAL, AUXILIARY then ABSTRACT classes
+    kind_order = {0: 0, 2: 1, 1: 2}
+    max_variants = 4096
+
+    def __init__(self, schemata, typedict, compact=False):
+        super().__init__(schemata)
+        self.typedict = typedict
+        self.compact = compact
+        self._closures = {}
+        self._composed = {}
+        self._variants = {}
+        self._with_properties = set()
+
+    def build(self, obj):
+        c = build_ldapclass(obj, self.typedict, self, self.compact)
+        for sup in obj.sup or ():
+            self.get(sup)
+        return c
+
+    def closure(self, name):
+        """OIDs of an objectClass and of all its superior classes
+
+        Computed once per objectClass.
+
+        :param name: name of the objectClass
+        :return: frozenset of OIDs"""
+        oid = self._getoid(name)
+        res = self._closures.get(oid)
+        if res is None:
+            obj = self.schemata.get_obj(self.schema_class, oid)
+            res = frozenset([oid]).union(*(self.closure(sup) for sup in obj.sup or ()))
+            self._closures[oid] = res
+        return res
+
+    def _sort_key(self, oid):
+        obj = self.schemata.get_obj(self.schema_class, oid)
+        return (self.kind_order.get(obj.kind, 0), -len(self._closures[oid]), oid)
+
+    def compose(self, ocs):
+        """Get the class of entries having some objectClasses
+
+        The objectClasses and all their superior classes are composed in a
+        single step. Sets of objectClasses with the same closure share one
+        class, whatever their order, case or aliases; its non-sequence
+        attributes come from the most specific structural class.
+
+        :param ocs: objectClass names, str or bytes, as read from an entry
+        :return: PloumObj class, None if ocs is empty"""
+        key = tuple(ocs)
+        try:
+            return self._variants[key]
+        except KeyError:
+            pass
+        if not key:
+            return None
+        with self._lock:
+            oids = frozenset().union(*(self.closure(oc) for oc in key))
+            typ = self._composed.get(oids)
+            if typ is None:
+                classes = [self[oid] for oid in sorted(oids, key=self._sort_key)]
+                typ = classmagic.ComposableType.compose(
+                    classes, 'LDAPEntity_' + '_'.join(c.names[0] for c in classes))
+                self._composed[oids] = typ
+            if len(self._variants) >= self.max_variants:
+                self._variants.clear()
+            self._variants[key] = typ
+        return typ
+
+    def get_class(self, objectclasses):
+        """Class of some objectClasses, with a property per attribute
+
+        The class is the one compose() gives, shared by all the orderings
+        of the objectClasses; its properties are built once.
+
+        :param objectclasses: objectClass name or names
+        :return: PloumObj class"""
+        if isinstance(objectclasses, str):
+            objectclasses = (objectclasses, )
+        typ = self.compose(objectclasses)
+        if typ not in self._with_properties:
+            with self._lock:
+                if typ not in self._with_properties:
+                    build_properties(self.typedict)(typ)
+                    self._with_properties.add(typ)
+        return typ
+
+    def clear_cache(self):
+        """Forget the composed classes, keep the classes of the objectClasses"""
+        with self._lock:
+            self._composed.clear()
+            self._variants.clear()
+            self._with_properties.clear()
+
+
+@slacker_cacher_decorator
+def load_schemas(ldap_conn, snapshot=None, offline=False, compact=False) -> dict:
+    """Load schemas from a LDAP connection and return them
+
+    :param ldap_conn: a LDAP connection, may be None when offline
+    :param snapshot: optional path of a schema snapshot file. A fresh snapshot
+        is used instead of downloading the schema, a stale or missing one is
+        (re)written after download.
+    :param offline: trust the snapshot without checking it against the server
+    :param compact: build classes whose instances have no __dict__
+    :return: (datadict, typedict), lazy mappings of objectClass names to
+        PloumObj classes and of attribute names to LDAPAttribute classes"""
+    with instrumentation.operation('load_schemas') as op:
+        schema_entry = None
+        if snapshot:
+            with op.phase('snapshot'):
+                loaded = schema_snapshot.load_snapshot(
+                    snapshot, None if offline else ldap_conn)
+            if loaded:
+                schema_entry = loaded[1]
+            elif offline:
+                raise RuntimeError('No usable schema snapshot in {}'.format(snapshot))
+        if schema_entry is None:
+            with op.phase('server'):
+                subschemacn, schema_entry = fetch_subschema(ldap_conn)
+            if snapshot:
+                schema_snapshot.save_snapshot(snapshot, subschemacn, schema_entry)
+        with op.phase('parse'):
+            schemata = ldap.schema.SubSchema(schema_entry)
+            typedict = plumbing.AttributeTypeDict(schemata, compact)
+            datadict = ObjectClassDict(schemata, typedict, compact)
     return datadict, typedict
 
+def _test_item():
+    from benchmarks.fakeldap import load_schema_fixture
+    schemata = ldap.schema.SubSchema(load_schema_fixture())
+    typedict = plumbing.AttributeTypeDict(schemata)
+    typ = ObjectClassDict(schemata, typedict).compose(('inetOrgPerson', ))
+    return typ('uid=jdoe,dc=example,dc=com', {
+        'objectClass': [b'inetOrgPerson'], 'cn': [b'John Doe'], 'sn': [b'Doe'],
+        'displayName': [b'John'], 'mail': [b'jdoe@example.com', b'john@example.com'],
+        'description': [b'Someone']})
+
+
+def test_get_modlist():
+    item = _test_item()
+    assert item.get_modlist() == []
+    item.get_attribute('mail').value.add('doe@example.com')
+    item.get_attribute('mail').value.remove('john@example.com')
+    item.get_attribute('displayname').set_value('Johnny')
+    item.get_attribute('description').set_value(None)
+    assert sorted(item.get_modlist()) == [
+        (ldap.MOD_ADD, 'mail', [b'doe@example.com']),
+        (ldap.MOD_DELETE, 'description', None),
+        (ldap.MOD_DELETE, 'mail', [b'john@example.com']),
+        (ldap.MOD_REPLACE, 'displayName', [b'Johnny'])]
+    item.mark_clean()
+    assert item.get_modlist() == []
+
+
+def test_get_class():
+    from benchmarks.fakeldap import load_schema_fixture
+    schemata = ldap.schema.SubSchema(load_schema_fixture())
+    datadict = ObjectClassDict(schemata, plumbing.AttributeTypeDict(schemata))
+    typ = datadict.get_class(('inetOrgPerson', 'posixAccount'))
+    name = typ.__name__
+    assert datadict.get_class(('posixAccount', 'inetOrgPerson')) is typ
+    assert typ.__name__ == name and isinstance(typ.uidNumber, property)
+    datadict.clear_cache()
+    assert datadict.get_class(('posixAccount', 'inetOrgPerson')) is not typ
+
+
+
+def test_compact_classes():
+    from benchmarks.fakeldap import FakeLDAPObject
+    attrs = {'objectClass': [b'inetOrgPerson'], 'cn': [b'John Doe'], 'sn': [b'Doe']}
+    item = _test_item()
+    # by default, items and attributes take ad-hoc attributes
+    item.note = 'seen'
+    item.get_attribute('cn').note = 'seen'
+    (datadict, _) = load_schemas.__wrapped__(FakeLDAPObject(), compact=True)
+    compact = datadict.compose(('inetOrgPerson', ))('uid=jdoe,dc=example,dc=com', attrs)
+    for obj in (compact, compact.get_attribute('cn')):
+        try:
+            obj.note = 'seen'
+        except AttributeError:
+            pass
+        else:
+            assert False, 'compact instances have no __dict__'
+    assert compact.get_attribute('cn').value == item.get_attribute('cn').value
+
+class _TestListener(object):
+    """Write listener and connection recording the DNs they are given"""
+
+    def __init__(self):
+        self.dns = []
+        self.modified = []
+
+    def invalidate(self, dn):
+        self.dns.append(dn)
+
+    def modify_s(self, dn, modlist):
+        self.modified.append(dn)
+        return True
+
+
+def test_save_notify():
+    item = _test_item()
+    listener = _TestListener()
+    register_write_listener(listener)
+    # nothing to save, nothing written: listeners are left alone
+    assert item.save_ldap()(None)
+    assert listener.dns == []
+    item.get_attribute('mail').value.add('doe@example.com')
+    assert item.save_ldap()(listener)
+    assert listener.modified == listener.dns == [item.dn]
+
+
+def test_get_modlist_matching_rule():
+    item = _test_item()
+    # mail follows caseIgnoreIA5Match: the server holds the same values
+    item.get_attribute('mail').set_value(['JDoe@Example.com', 'john@example.com'])
+    assert item.get_modlist() == []
+    item.get_attribute('mail').value.add('JOHN.DOE@example.com')
+    assert item.get_modlist() == [(ldap.MOD_ADD, 'mail', [b'JOHN.DOE@example.com'])]
+
+
 __all__ = ["PloumObj", "LDAPFactory", ]
@@ -1,7 +1,10 @@
 # -*- encoding: utf-8
 from ctrmisctk.utils import debyte, is_scalar, slacker_cacher_decorator
+import collections.abc
+import ldap.dn
 import ldap.schema
 import logging
+import threading
 
 logger = logging.getLogger(__name__)
 
@@ -9,21 +12,32 @@ logger = logging.getLogger(__name__)
 class AttributeFactory(object):
     """Factory class to build classes that describe attributes"""
     @staticmethod
-    def build_attribute_class(atr, attrs_dict):
+    def build_attribute_class(atr, attrs_dict, compact=False):
+        """Build the class of an attribute type
+
+        Matching rules and syntax missing from the definition are inherited
+        from the superior attribute type, when attrs_dict knows it.
+
+        :param atr: ldap.schema.AttributeType
+        :param attrs_dict: mapping of attribute names to attribute classes
+        :param compact: if True, instances have no __dict__, only the slots
+            of LDAPAttribute
+        :return: LDAPAttribute subclass"""
         typename = 'LDAPAttr_{}'.format(atr.names[0])
-        attrtype = type(typename,
-                        (LDAPAttribute,) + LDAPAttribute.__bases__,
-                        dict(LDAPAttribute.__dict__))
+        attrtype = type(typename, (LDAPAttribute,), {'__slots__': ()} if compact else {})
+        sup = {}
+        if atr.sup and atr.sup[0] in attrs_dict:
+            sup = attrs_dict[atr.sup[0]].properties
         attrtype.properties = {
             'oid': atr.oid,
             'name': atr.names[0],
             'names': atr.names,
             'desc': atr.desc,
             'sup': atr.sup,
-            'equality': atr.equality,
-            'ordering': atr.ordering,
-            'substring': atr.substr,
-            'syntax': atr.syntax,
+            'equality': atr.equality or sup.get('equality'),
+            'ordering': atr.ordering or sup.get('ordering'),
+            'substring': atr.substr or sup.get('substring'),
+            'syntax': atr.syntax or sup.get('syntax'),
             'single_value': atr.single_value,
             'collective': atr.collective,
             'no_user_modification': atr.no_user_mod,
@@ -32,31 +46,139 @@ class AttributeFactory(object):
         return attrtype
 
 
+class LazySchemaDict(collections.abc.Mapping):
+    """Mapping of schema element names to classes built on first lookup.
+
+    Names are looked up case-insensitively, as str or bytes, and all the
+    names (aliases) of a schema element share the same class.
+
+    :param schemata: ldap.schema.SubSchema to build classes from"""
+    schema_class = None
+    __eq__ = object.__eq__
+    __hash__ = object.__hash__
+
+    def __init__(self, schemata):
+        self.schemata = schemata
+        self._built = {}
+        self._lock = threading.RLock()
+
+    def build(self, obj):
+        """Build the class of a schema element
+
+        :param obj: ldap.schema.SchemaElement to build a class for"""
+        raise NotImplementedError
+
+    def _getoid(self, name):
+        if isinstance(name, bytes):
+            name = name.decode('utf-8')
+        if not isinstance(name, str):
+            raise KeyError(name)
+        try:
+            return self.schemata.getoid(self.schema_class, name, raise_keyerror=1)
+        except KeyError:
+            raise KeyError(name) from None
+
+    def __getitem__(self, name):
+        oid = self._getoid(name)
+        try:
+            return self._built[oid]
+        except KeyError:
+            pass
+        with self._lock:
+            if oid not in self._built:
+                self._built[oid] = self.build(
+                    self.schemata.get_obj(self.schema_class, oid))
+            return self._built[oid]
+
+    def __contains__(self, name):
+        try:
+            self._getoid(name)
+        except KeyError:
+            return False
+        return True
+
+    def __iter__(self):
+        for oid in self.schemata.listall(self.schema_class):
+            yield from self.schemata.get_obj(self.schema_class, oid).names
+
+    def __len__(self):
+        return sum(len(self.schemata.get_obj(self.schema_class, oid).names)
+                   for oid in self.schemata.listall(self.schema_class))
+
+    def __repr__(self):
+        return '{}({} built)'.format(self.__class__.__name__, len(self._built))
+
+    def built(self):
+        """Return the classes built so far
+
+        :return: dict OID → class"""
+        return dict(self._built)
+
+
+class AttributeTypeDict(LazySchemaDict):
+    """Lazy mapping of attribute type names to LDAPAttribute classes
+
+    :param schemata: ldap.schema.SubSchema to build classes from
+    :param compact: if True, build classes whose instances have no __dict__"""
+    schema_class = ldap.schema.AttributeType
+
+    def __init__(self, schemata, compact=False):
+        super().__init__(schemata)
+        self.compact = compact
+
+    def build(self, obj):
+        for sup in obj.sup or ():
+            # build the superior first so its rules get inherited
+            self.get(sup)
+        return AttributeFactory.build_attribute_class(obj, self, self.compact)
+
 
 class LDAPAttribute(object):
     """A class representing a LDAP attribute.
 
     Not meant to be instanciated directly. You are looking for
-    `AttributeFactory`.`build_attribute_class`"""
+    `AttributeFactory`.`build_attribute_class`
+
+    Schema metadata lives in the properties dict of the generated class;
+    instances hold their value and change tracking state in slots, plus a
+    __dict__ unless the class was built in compact mode."""
+    __slots__ = ('_dirty', '_value', '_base_state')
+    properties = {}
 
     def __init__(self, value=None):
         self._dirty = False
         self._value = None
+        self._base_state = None
         self.set_value(value)
-        self.properties = {}
 
     def get_base_state(self):
-        """Return previous state of the item if any"""
-        return getattr(self, '_base_state',
-                       None if self.single_value else [])
+        """Return the value of the item when it was last clean"""
+        if self._dirty:
+            return self._base_state
+        if self._value.__class__ is ArithmeticList and not self._value.is_clean():
+            return self._value.get_base_state()
+        return self._value
+
+    def _save_base_state(self):
+        """Keep the clean value aside before the first change (copy on write)
+
+        Lists of values changed in place keep their own base state."""
+        if not self._dirty:
+            value = self._value
+            if value.__class__ is ArithmeticList:
+                value = value.get_base_state()
+            self._base_state = value
+            self._dirty = True
 
     def set_clean(self):
         self._dirty = False
+        self._base_state = None
+        if self._value.__class__ is ArithmeticList:
+            self._value.set_clean()
 
     def set_value(self, value):
         """Set value of this LDAPAttribute"""
-        self._dirty = True
-        self._base_state = self._value
+        self._save_base_state()
         if self.single_value:
             if is_scalar(value):
                 self._value = value
@@ -64,7 +186,7 @@ class LDAPAttribute(object):
                 logger.warning("Wrong initial value for scalar type %s: %s",
                                type(self), value)
         else:
-            self._value = ArithmeticList()
+            self._value = ArithmeticList(key=matching_key(self.equality))
             if value:
                 self._value += value
             logger.info("Set value of %s to %s", self, self._value)
@@ -74,23 +196,25 @@ class LDAPAttribute(object):
 
         For single value, replace _value by other
         Else append new value to _value"""
-        self._dirty = True
-        self._base_state = self._value
         if self.single_value:
+            self._save_base_state()
             if not is_scalar(other):
                 self._value = debyte(other[0])
             else:
                 self._value = debyte(other)
         else:
-            if not self._value:
-                self._value = ArithmeticList()
+            if self._value is None:
+                self._save_base_state()
+                self._value = ArithmeticList(key=matching_key(self.equality))
             if other:
                 self._value += debyte(other)
         return self
 
     @property
     def dirty(self):
-        return self._dirty
+        if self._dirty:
+            return True
+        return self._value.__class__ is ArithmeticList and not self._value.is_clean()
 
     @property
     def oid(self):
@@ -170,47 +294,392 @@ class LDAPAttribute(object):
     json_helper = portable_value
 
 
+def _spaces_key(value):
+    return ' '.join(value.split())
+
+
+def _case_ignore_key(value):
+    return ' '.join(value.casefold().split())
+
+
+def _numeric_key(value):
+    return ''.join(value.split())
+
+
+def _integer_key(value):
+    try:
+        return int(value)
+    except ValueError:
+        return value
+
+
+def _telephone_key(value):
+    return ''.join(c for c in value.casefold() if c not in ' -')
+
+
+def normalize_dn(value):
+    """Normalize a DN for comparison: lowercase, sorted multi-valued RDNs
+
+    :param value: distinguished name
+    :return: str"""
+    try:
+        rdns = ldap.dn.str2dn(value)
+    except ldap.DECODING_ERROR:
+        return value.lower()
+    return ldap.dn.dn2str([
+        sorted((t.lower(), v.lower(), f) for (t, v, f) in rdn) for rdn in rdns])
+
+
+def parent_dn(value):
+    """DN of the parent of an entry
+
+    :param value: distinguished name
+    :return: str, empty for the root DSE and top-level entries"""
+    rdns = ldap.dn.str2dn(value)
+    return ldap.dn.dn2str(rdns[1:]) if rdns else ''
+
+
+MATCHING_RULE_KEYS = {
+    'caseignorematch': _case_ignore_key,
+    'caseignoreia5match': _case_ignore_key,
+    'caseignorelistmatch': _case_ignore_key,
+    'objectidentifiermatch': str.lower,
+    'caseexactmatch': _spaces_key,
+    'caseexactia5match': _spaces_key,
+    'numericstringmatch': _numeric_key,
+    'integermatch': _integer_key,
+    'telephonenumbermatch': _telephone_key,
+    'distinguishednamematch': normalize_dn,
+    'uniquemembermatch': normalize_dn,
+    # ORDERING and SUBSTR rules, used to evaluate filters locally
+    'caseignoreorderingmatch': _case_ignore_key,
+    'caseexactorderingmatch': _spaces_key,
+    'numericstringorderingmatch': _numeric_key,
+    'integerorderingmatch': _integer_key,
+    'caseignoresubstringsmatch': _case_ignore_key,
+    'caseignoreia5substringsmatch': _case_ignore_key,
+    'caseexactsubstringsmatch': _spaces_key,
+    'numericstringsubstringsmatch': _numeric_key,
+    'telephonenumbersubstringsmatch': _telephone_key,
+}
+
+
+def matching_key(equality):
+    """Return the function normalizing values for a matching rule
+
+    Values equal according to the matching rule have the same key. Unknown
+    matching rules compare values as they are.
+
+    :param equality: name of the matching rule, or None
+    :return: callable or None"""
+    if not equality:
+        return None
+    func = MATCHING_RULE_KEYS.get(equality.lower())
+    if func is None:
+        return None
+
+    def key(value):
+        if isinstance(value, str):
+            return func(value)
+        return value
+    return key
+
+
 class ArithmeticList(list):
-    """A list on which you can + and - items"""
+    """A list on which you can + and - items
+
+    Items are decoded from bytes and deduplicated as they are added. Beside
+    the ordered list, items are indexed by a key following the equality
+    matching rule of the attribute, so that membership tests and additions
+    cost O(1); removals cost O(N) as for a list.
+
+    :param iterable: initial item or items
+    :param key: function normalizing items for comparison, see matching_key"""
+    __slots__ = ('_index', '_key', '_clean', '_base_state')
+
+    def __init__(self, iterable=None, key=None):
+        super().__init__()
+        self._index = {}
+        self._key = key
+        self._clean = False
+        self._base_state = None
+        if iterable is not None:
+            self.extend(iterable)
+
+    def __reduce__(self):
+        return (self.__class__, (list(self), self._key), (self._clean, self._base_state))
+
+    def __setstate__(self, state):
+        (self._clean, self._base_state) = state
+
+    def _k(self, item):
+        return self._key(item) if self._key else item
+
+    def _changing(self):
+        """Save the base state before the first change since set_clean (copy on write)"""
+        if self._clean:
+            self._base_state = list(self)
+            self._clean = False
 
-    def __add__(self, other):
-        res = ArithmeticList(self)
-        if not is_scalar(other):
+    def _reset(self, items):
+        self._changing()
+        super().clear()
+        self._index = {}
+        self.extend(items)
+
+    def add(self, item):
+        """Add an item if not already there
+
+        :return: True if the item was added"""
+        item = debyte(item)
+        k = self._k(item)
+        if k in self._index:
+            return False
+        if self._clean:
+            self._changing()
+        self._index[k] = item
+        list.append(self, item)
+        return True
+
+    def append(self, item):
+        self.add(item)
+
+    def extend(self, other):
+        if is_scalar(other):
+            self.add(other)
+        else:
             for i in other:
-                if debyte(i) not in self:
-                    res.append(debyte(i))
-            res._clean = False
-        elif debyte(other) not in self:
-            res._clean = False
-            res.append(debyte(other))
+                self.add(i)
+
+    def insert(self, index, item):
+        item = debyte(item)
+        k = self._k(item)
+        if k in self._index:
+            return
+        self._changing()
+        self._index[k] = item
+        super().insert(index, item)
+
+    def discard(self, item):
+        """Remove an item if present
+
+        :return: True if the item was removed"""
+        k = self._k(debyte(item))
+        stored = self._index.pop(k, None)
+        if stored is None:
+            return False
+        self._changing()
+        super().remove(stored)
+        return True
+
+    def remove(self, item):
+        if not self.discard(item):
+            raise ValueError('Cannot remove item from list not having it')
+
+    def pop(self, index=-1):
+        self._changing()
+        item = super().pop(index)
+        del self._index[self._k(item)]
+        return item
+
+    def clear(self):
+        self._changing()
+        super().clear()
+        self._index = {}
+
+    def copy(self):
+        res = ArithmeticList(key=self._key)
+        list.extend(res, self)
+        res._index = dict(self._index)
+        return res
+
+    def index(self, item, *args):
+        try:
+            stored = self._index[self._k(debyte(item))]
+        except KeyError:
+            raise ValueError('{!r} is not in list'.format(item)) from None
+        return super().index(stored, *args)
+
+    def count(self, item):
+        return 1 if item in self else 0
+
+    def __contains__(self, item):
+        return self._k(debyte(item)) in self._index
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return ArithmeticList(super().__getitem__(index), key=self._key)
+        return super().__getitem__(index)
+
+    def __setitem__(self, index, value):
+        if isinstance(index, slice):
+            items = list(self)
+            items[index] = value
+            self._reset(items)
+            return
+        value = debyte(value)
+        (old, k) = (self[index], self._k(value))
+        if k in self._index and self._k(old) != k:
+            # the new value is already there: drop the replaced one
+            del self[index]
+            return
+        self._changing()
+        del self._index[self._k(old)]
+        self._index[k] = value
+        super().__setitem__(index, value)
+
+    def __delitem__(self, index):
+        self._changing()
+        removed = super().__getitem__(index)
+        super().__delitem__(index)
+        for item in (removed if isinstance(index, slice) else [removed]):
+            del self._index[self._k(item)]
+
+    def sort(self, key=None, reverse=False):
+        self._changing()
+        super().sort(key=key, reverse=reverse)
+
+    def reverse(self):
+        self._changing()
+        super().reverse()
+
+    def __add__(self, other):
+        res = self.copy()
+        res.extend(other)
         return res
 
+    def __radd__(self, other):
+        res = ArithmeticList(other, key=self._key)
+        res.extend(self)
+        return res
+
+    def __iadd__(self, other):
+        self.extend(other)
+        return self
+
     def __sub__(self, other):
-        if other in self:
-            self.remove(debyte(other))
-            self._clean = False
+        res = self.copy()
+        res -= other
+        return res
+
+    def __isub__(self, other):
+        if is_scalar(other):
+            self.remove(other)
         else:
-            raise ValueError('Cannot remove item from list not having it')
+            for i in other:
+                self.remove(i)
+        return self
+
+    def __mul__(self, n):
+        return self.copy() if n > 0 else ArithmeticList(key=self._key)
+
+    __rmul__ = __mul__
+
+    def __imul__(self, n):
+        if n <= 0:
+            self.clear()
+        return self
 
-    def __init__(self, iterable=None):
-        if is_scalar(iterable) and iterable:
-            iterable = [debyte(iterable)]
-        if iterable:
-            for i in set(iterable):
-                j = debyte(i)
-                if j not in self:
-                    self += j
-        super().__init__(set(iterable or []))
+    def __eq__(self, other):
+        """Compare values in order, following the matching rule"""
+        if isinstance(other, (list, tuple)):
+            return len(self) == len(other) and all(
+                self._k(a) == self._k(debyte(b)) for (a, b) in zip(self, other))
+        return NotImplemented
+
+    def __ne__(self, other):
+        res = self.__eq__(other)
+        return res if res is NotImplemented else not res
+
+    def __repr__(self):
+        return 'ArithmeticList({})'.format(super().__repr__())
 
     def set_clean(self):
-        """Mark this list clean and save its base state"""
+        """Mark this list clean, its base state is saved on the next change"""
         self._clean = True
-        self._base_state = list(self)
+        self._base_state = None
 
     def get_base_state(self):
-        return getattr(self, '_base_state', [])
+        """Return the items of this list when it was last marked clean"""
+        if self._clean:
+            return list(self)
+        return self._base_state if self._base_state is not None else []
 
     def is_clean(self):
-        return hasattr(self, '_clean', False)
-
-
+        return self._clean
+
+
+def _test_attribute_class(equality='caseIgnoreIA5Match', single_value=False):
+    return type('LDAPAttr_test', (LDAPAttribute,), {'__slots__': (), 'properties': {
+        'name': 'test', 'equality': equality, 'single_value': single_value}})
+
+
+def test_arithmeticlist():
+    values = ArithmeticList([b'A@example.com', 'b@example.com'],
+                            key=matching_key('caseIgnoreIA5Match'))
+    assert list(values) == ['A@example.com', 'b@example.com']
+    assert 'a@EXAMPLE.com' in values and b'B@example.com' in values
+    assert not values.add('a@example.com') and len(values) == 2
+    values -= 'b@example.COM'
+    assert values == ['a@example.com']
+    try:
+        values.remove('c@example.com')
+    except ValueError:
+        pass
+    else:
+        assert False, 'removing a missing item must fail'
+    assert values + ['c@example.com'] == ['A@example.com', 'c@example.com']
+    assert values == ['a@example.com']
+
+
+def test_arithmeticlist_is_a_list():
+    import copy
+    import json
+    values = ArithmeticList(['a', 'B', 'c'], key=matching_key('caseIgnoreMatch'))
+    assert isinstance(values, list) and json.dumps(values) == '["a", "B", "c"]'
+    assert values == ['A', 'b', 'C'] and values != ['c', 'b', 'a']
+    values[1] = 'd'
+    assert values == ['a', 'd', 'c'] and 'b' not in values and 'D' in values
+    values.insert(0, 'C')
+    assert values == ['a', 'd', 'c'], 'duplicates are not inserted'
+    values.insert(0, 'e')
+    del values[-1]
+    assert values == ['e', 'a', 'd'] and 'c' not in values
+    assert values.index('A') == 1 and values.pop() == 'd' and 'd' not in values
+    values[0] = 'a'
+    assert values == ['a'], 'replacing with a value already there drops the item'
+    copied = copy.copy(values)
+    assert copied == values and type(copied) is ArithmeticList and 'A' in copied
+
+
+def test_arithmeticlist_base_state():
+    values = ArithmeticList(['a', 'b'])
+    values.set_clean()
+    assert values.is_clean() and values.get_base_state() == ['a', 'b']
+    values.add('c')
+    values.discard('a')
+    assert not values.is_clean() and values.get_base_state() == ['a', 'b']
+    values.set_clean()
+    assert values.get_base_state() == ['b', 'c']
+
+
+def test_attribute_in_place_change():
+    attr = _test_attribute_class()()
+    attr += [b'a@example.com', b'b@example.com']
+    attr.set_clean()
+    assert not attr.dirty
+    attr.value.add('c@example.com')
+    assert attr.dirty and attr.get_base_state() == ['a@example.com', 'b@example.com']
+    attr.value.remove('a@example.com')
+    attr += 'd@example.com'
+    assert attr.get_base_state() == ['a@example.com', 'b@example.com']
+    attr.set_clean()
+    attr.value.remove('b@example.com')
+    attr.set_value(['e@example.com'])
+    assert attr.dirty and attr.get_base_state() == ['b@example.com', 'c@example.com',
+                                                    'd@example.com']
+    single = _test_attribute_class(single_value=True)()
+    single += 'x'
+    single.set_clean()
+    single += 'y'
+    assert single.dirty and single.get_base_state() == 'x' and single.value == 'y'
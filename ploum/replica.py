@@ -0,0 +1,360 @@
+# -*- encoding: utf-8
+"""Ploum replicas
+
+A Replica is a local, in-process mirror of a subtree of the directory,
+kept up to date with the Content Synchronization Operation (syncrepl,
+RFC 4533). Searches are then answered from memory.
+
+.. code:: python
+
+    replica = Replica('ou=domains,dc=example,dc=com', '(objectClass=mailDomain)')
+    replica.load('/var/cache/ploum/domains.json')      # optional, resumes with the cookie
+    replica.sync(conn, mode='refreshOnly')
+    domains = replica.search_all(EmailDomain, base_dn='dc=example,dc=com',
+                                 domainName='example.com')()
+    replica.save('/var/cache/ploum/domains.json')
+
+With mode='refreshAndPersist', sync() does not return and keeps applying
+the changes sent by the server: run it in a dedicated thread, on a
+dedicated connection, or call start() then poll() from an event loop.
+
+Entries are materialized as PloumObj through get_proper_type and populate.
+They are shared by all the searches: treat them as read-only.
+"""
+
+import base64
+import json
+import logging
+import threading
+
+import ldap
+from ldap.syncrepl import SyncreplConsumer
+
+from ctrmisctk.utils import atomic_write
+
+from .filters import parse_filter
+from .helper_class import LDAPHelper
+from .ldap_utils import get_proper_type
+from .plumbing import normalize_dn, parent_dn
+
+logger = logging.getLogger(__name__)
+
+REPLICA_VERSION = 1
+
+
+def _dump_value(value):
+    if isinstance(value, bytes):
+        return {'base64': base64.b64encode(value).decode('ascii')}
+    return value
+
+
+def _load_value(value):
+    if isinstance(value, dict):
+        return base64.b64decode(value['base64'])
+    return value
+
+
+class Replica(SyncreplConsumer):
+    """Local mirror of a subtree, kept up to date with syncrepl
+
+    :param base_dn: base of the replicated subtree
+    :param filterstr: filter of the replicated entries
+    :param scope: scope of the replication
+    :param attrlist: attributes to replicate, None for all user attributes
+    :param all_types: object classes of the schema, defaults to the ones of
+        LDAPFactory
+    :param cookie: sync cookie to resume from"""
+
+    def __init__(self, base_dn, filterstr='(objectClass=*)', scope=ldap.SCOPE_SUBTREE,
+                 attrlist=None, all_types=None, cookie=None):
+        self.base_dn = base_dn
+        self.filterstr = filterstr
+        self.scope = scope
+        self.attrlist = attrlist
+        self.all_types = all_types
+        self.cookie = cookie
+        self.conn = None
+        self.msgid = None
+        self.refreshed = False
+        # entryUUID → (item, normalized DN, normalized parent DN)
+        self.entries = {}
+        # normalized DN → entryUUID
+        self.dns = {}
+        self._present = set()
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _types(self):
+        if self.all_types is None:
+            from .ploum import LDAPFactory
+            if LDAPFactory.objclasses is None:
+                raise RuntimeError('Cannot build replica entries: no schema loaded')
+            return LDAPFactory.objclasses
+        return self.all_types
+
+    # LDAPObject methods used by SyncreplConsumer
+
+    def search_ext(self, *args, **kwargs):
+        return self.conn.search_ext(*args, **kwargs)
+
+    def result4(self, *args, **kwargs):
+        return self.conn.result4(*args, **kwargs)
+
+    # synchronization
+
+    def start(self, ldapconn, mode='refreshAndPersist'):
+        """Send the sync request
+
+        :param ldapconn: LDAP connection, dedicated to the replica in
+            refreshAndPersist mode
+        :param mode: 'refreshOnly' or 'refreshAndPersist'
+        :return: message id of the sync operation"""
+        self.conn = ldapconn
+        self.refreshed = False
+        self._present = set()
+        self.msgid = self.syncrepl_search(
+            self.base_dn, self.scope, mode=mode, filterstr=self.filterstr,
+            attrlist=['*'] if self.attrlist is None else list(self.attrlist) + ['objectClass'])
+        logger.info('Started %s sync of %s %s', mode, self.base_dn, self.filterstr)
+        return self.msgid
+
+    def poll(self, timeout=None, all=0):
+        """Apply the changes sent by the server
+
+        :param timeout: seconds to wait for a message, None to block
+        :param all: if true, only return when the operation is finished
+        :return: True while the sync operation is in progress"""
+        return self.syncrepl_poll(msgid=self.msgid, timeout=timeout, all=all)
+
+    def sync(self, ldapconn, mode='refreshOnly'):
+        """Synchronize the replica
+
+        Returns once the refresh is done in refreshOnly mode, never in
+        refreshAndPersist mode.
+
+        :param ldapconn: LDAP connection
+        :param mode: 'refreshOnly' or 'refreshAndPersist'
+        :return: the new sync cookie"""
+        self.start(ldapconn, mode)
+        while self.poll():
+            pass
+        return self.cookie
+
+    # SyncreplConsumer callbacks
+
+    def syncrepl_get_cookie(self):
+        return self.cookie
+
+    def syncrepl_set_cookie(self, cookie):
+        self.cookie = cookie
+
+    def syncrepl_entry(self, dn, attrs, uuid):
+        try:
+            item = get_proper_type(attrs, self._types())(dn, attrs)
+        except KeyError as e:
+            logger.error('Cannot replicate %s: %s', dn, e)
+            self._remove(uuid)
+            return
+        ndn = normalize_dn(dn)
+        with self._lock:
+            self._remove(uuid)
+            self.entries[uuid] = (item, ndn, parent_dn(ndn))
+            self.dns[ndn] = uuid
+
+    def syncrepl_delete(self, uuids):
+        with self._lock:
+            for uuid in uuids:
+                self._remove(uuid)
+
+    def syncrepl_present(self, uuids, refreshDeletes=False):
+        if uuids is not None:
+            self._present.update(uuids)
+            return
+        if not refreshDeletes:
+            with self._lock:
+                for uuid in [u for u in self.entries if u not in self._present]:
+                    self._remove(uuid)
+        self._present = set()
+
+    def syncrepl_refreshdone(self):
+        self.refreshed = True
+        logger.info('Refreshed replica of %s: %d entries', self.base_dn, len(self.entries))
+
+    def _remove(self, uuid):
+        with self._lock:
+            old = self.entries.pop(uuid, None)
+            if old is not None and self.dns.get(old[1]) == uuid:
+                del self.dns[old[1]]
+
+    # queries
+
+    def get(self, dn):
+        """Get a replicated entry by DN
+
+        :param dn: DN of the entry
+        :return: PloumObj or None"""
+        with self._lock:
+            uuid = self.dns.get(normalize_dn(dn))
+            return self.entries[uuid][0] if uuid is not None else None
+
+    def _in_scope(self, base, scope):
+        """Replicated items in the scope of a search"""
+        with self._lock:
+            if scope == ldap.SCOPE_BASE:
+                uuid = self.dns.get(base)
+                return [self.entries[uuid][0]] if uuid is not None else []
+            entries = list(self.entries.values())
+        if scope == ldap.SCOPE_ONELEVEL:
+            return [item for (item, _, parent) in entries if parent == base]
+        suffix = ',' + base
+        return [item for (item, ndn, _) in entries
+                if not base or ndn == base or ndn.endswith(suffix)]
+
+    def search_all_ldap(self, cls, base_dn=None, scope=ldap.SCOPE_SUBTREE,
+                        filterstr=None, force_full_dn=False, filter_params=None,
+                        **kwargs):
+        """Search the replica as cls.search_all_ldap would search the server
+
+        Filters are evaluated locally, extensible matches are not supported.
+        Searches outside of the replicated subtree or filter only find the
+        replicated entries.
+
+        :param cls: PloumObj class searched
+        :return: callable(ldapconn=None) that will make a list of matches"""
+        (base, scope, filterstr) = cls._search_params(
+            base_dn, scope, filterstr, force_full_dn, kwargs, filter_params)
+        expr = parse_filter(filterstr)
+        base = normalize_dn(base)
+
+        def search(ldapconn=None):
+            return [item for item in self._in_scope(base, scope) if expr.matches(item)]
+        return search
+
+    def search_all(self, cls, **kwargs):
+        """Search the replica as cls.search_all would search the server
+
+        :param cls: LDAPHelper or PloumObj class searched
+        :return: callable(ldapconn=None) that will make a list of matches"""
+        search = self.search_all_ldap(cls, **kwargs)
+        if not issubclass(cls, LDAPHelper):
+            return search
+        return lambda ldapconn=None: [cls(a) for a in search(ldapconn)]
+
+    # persistence
+
+    def save(self, path):
+        """Write the replicated entries and the sync cookie to path, atomically
+
+        :param path: file to write
+        :return: None"""
+        with self._lock:
+            entries = list(self.entries.items())
+        data = dict(version=REPLICA_VERSION, base_dn=self.base_dn, filterstr=self.filterstr,
+                    scope=self.scope, cookie=_dump_value(self.cookie), entries=[])
+        for (uuid, (item, _, _)) in entries:
+            names = item.get_field_index()[0]
+            attrs = {}
+            for (low, attr) in item._attrs.items():
+                values = attr.get_base_state()
+                if values is None:
+                    continue
+                values = [values] if isinstance(values, (str, bytes)) else list(values)
+                attrs[names[low][0]] = [_dump_value(v) for v in values]
+            data['entries'].append([_dump_value(uuid), item.dn, attrs])
+        with atomic_write(path, '.ploum-replica-') as f:
+            json.dump(data, f)
+        logger.info('Saved replica of %s to %s: %d entries', self.base_dn, path, len(entries))
+
+    def load(self, path):
+        """Restore the entries and the sync cookie written by save()
+
+        The file is ignored if it does not replicate the same subtree.
+
+        :param path: file to read
+        :return: True if the replica was restored"""
+        try:
+            with open(path, encoding='utf-8') as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return False
+        except (OSError, ValueError) as e:
+            logger.warning('Ignoring unreadable replica %s: %s', path, e)
+            return False
+        if (data.get('version') != REPLICA_VERSION or
+                (data.get('base_dn'), data.get('filterstr'), data.get('scope')) !=
+                (self.base_dn, self.filterstr, self.scope)):
+            logger.warning('Ignoring replica %s of another subtree', path)
+            return False
+        with self._lock:
+            self.entries = {}
+            self.dns = {}
+            for (uuid, dn, attrs) in data['entries']:
+                attrs = dict((k, [_load_value(v) for v in values])
+                             for (k, values) in attrs.items())
+                self.syncrepl_entry(dn, attrs, _load_value(uuid))
+            self.cookie = _load_value(data.get('cookie'))
+        logger.info('Loaded replica of %s from %s: %d entries', self.base_dn, path,
+                    len(self.entries))
+        return True
+
+
+def _test_replica():
+    from benchmarks.fakeldap import load_schema_fixture
+    from .plumbing import AttributeTypeDict
+    from .ploum import ObjectClassDict
+    schemata = ldap.schema.SubSchema(load_schema_fixture())
+    datadict = ObjectClassDict(schemata, AttributeTypeDict(schemata))
+    replica = Replica('ou=people,dc=example,dc=com', all_types=datadict, cookie=b'rid=1')
+    replica.syncrepl_entry('ou=people,dc=example,dc=com',
+                           {'objectClass': [b'organizationalUnit'], 'ou': [b'people']}, b'u0')
+    for (uuid, uid) in ((b'u1', 'jdoe'), (b'u2', 'asmith'), (b'u3', 'bmartin')):
+        replica.syncrepl_entry('uid={},ou=people,dc=example,dc=com'.format(uid), {
+            'objectClass': [b'inetOrgPerson'], 'uid': [uid.encode()], 'cn': [uid.encode()],
+            'sn': [uid.encode()], 'mail': [uid.encode() + b'@example.com']}, uuid)
+    return (replica, datadict.get_class('inetOrgPerson'))
+
+
+def test_replica_apply():
+    (replica, person) = _test_replica()
+    # an entry renamed keeps its entryUUID
+    replica.syncrepl_entry('uid=bob, ou=People,dc=example,dc=com', {
+        'objectClass': [b'inetOrgPerson'], 'uid': [b'bob'], 'cn': [b'bob'], 'sn': [b'bob']},
+        b'u3')
+    assert replica.get('uid=bmartin,ou=people,dc=example,dc=com') is None
+    assert list(replica.get('UID=bob,ou=people,dc=example,dc=com').uid.value) == ['bob']
+    replica.syncrepl_delete([b'u2'])
+    assert len(replica) == 3
+    base = 'ou=people,dc=example,dc=com'
+    search = replica.search_all(person, base_dn=base, uid='jdoe')
+    assert [i.dn for i in search()] == ['uid=jdoe,ou=people,dc=example,dc=com']
+    assert len(replica.search_all(person, base_dn=base, scope=ldap.SCOPE_ONELEVEL)()) == 2
+    assert replica.search_all(person, base_dn='dc=example,dc=org')() == []
+    # end of a refresh without deletes: entries not reported present are gone
+    replica.syncrepl_present([b'u0', b'u1'])
+    replica.syncrepl_present(None, refreshDeletes=False)
+    assert sorted(replica.entries) == [b'u0', b'u1']
+
+
+def test_replica_persist():
+    import os
+    import tempfile
+    (replica, person) = _test_replica()
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, 'replica.json')
+    replica.save(path)
+    restored = Replica(replica.base_dn, all_types=replica.all_types)
+    assert restored.load(path)
+    assert restored.cookie == b'rid=1' and sorted(restored.entries) == sorted(replica.entries)
+    item = restored.get('uid=asmith,ou=people,dc=example,dc=com')
+    assert list(item.mail.value) == ['asmith@example.com'] and item.dn == \
+        replica.entries[b'u2'][0].dn
+    # a file of another subtree is ignored
+    assert not Replica('dc=example,dc=com', all_types=replica.all_types).load(path)
+    assert not restored.load(os.path.join(directory, 'missing.json'))
+    os.unlink(path)
+    os.rmdir(directory)
+
+
+__all__ = ['Replica', ]
@@ -0,0 +1,156 @@
+# -*- encoding: utf-8
+"""Ploum schema snapshots
+
+Persist the attribute type and objectClass definitions of a subschema
+subentry to a local file so that a process can start without downloading
+and parsing the whole schema.
+
+A snapshot is validated against the ``modifyTimestamp`` and ``entryCSN``
+of the subschema subentry with a single base-scope search, or trusted
+blindly when working offline. Servers that do not publish either of them
+on the subschema subentry are checked against a digest of the definitions
+instead: the schema is downloaded again, but neither parsed twice nor
+rewritten while it does not change.
+"""
+
+import hashlib
+import json
+import logging
+
+import ldap
+from ldap.ldapobject import LDAPError
+
+from ctrmisctk.utils import atomic_write
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_VERSION = 1
+SNAPSHOT_ATTRS = ('attributeTypes', 'objectClasses')
+VALIDATOR_ATTRS = ('modifyTimestamp', 'entryCSN')
+
+
+def _get(entry, attr):
+    """Case-insensitive lookup of a multi-valued attribute, decoded to str"""
+    low = attr.lower()
+    for (k, v) in entry.items():
+        if k.lower() == low:
+            return [a.decode('utf-8') if isinstance(a, bytes) else a for a in v]
+    return []
+
+
+def schema_digest(entry):
+    """Digest of the definitions of a subschema subentry
+
+    :param entry: attributes of the subschema subentry, or a snapshot dict
+    :return: hexadecimal SHA-256 of the sorted definitions"""
+    data = [sorted(_get(entry, attr)) for attr in SNAPSHOT_ATTRS]
+    return hashlib.sha256(json.dumps(data).encode('utf-8')).hexdigest()
+
+
+def save_snapshot(path, subschemacn, entry):
+    """Write a schema snapshot to path, atomically
+
+    :param path: file to write
+    :param subschemacn: DN of the subschema subentry
+    :param entry: attributes of the subschema subentry, as returned by a search
+    :return: None"""
+    data = dict(version=SNAPSHOT_VERSION, subschema_dn=subschemacn)
+    for attr in SNAPSHOT_ATTRS + VALIDATOR_ATTRS:
+        data[attr] = _get(entry, attr)
+    data['digest'] = schema_digest(data)
+    with atomic_write(path, '.ploum-schema-') as f:
+        json.dump(data, f)
+    logger.info('Saved schema snapshot of %s to %s', subschemacn, path)
+
+
+def read_snapshot(path):
+    """Read a schema snapshot
+
+    :param path: file to read
+    :return: snapshot dict, None if missing or unusable"""
+    try:
+        with open(path, encoding='utf-8') as f:
+            data = json.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        logger.warning('Ignoring unreadable schema snapshot %s: %s', path, e)
+        return None
+    if data.get('version') != SNAPSHOT_VERSION or not data.get('subschema_dn'):
+        logger.warning('Ignoring schema snapshot %s with unknown format', path)
+        return None
+    return data
+
+
+def snapshot_is_fresh(data, ldap_conn):
+    """Check a snapshot against the subschema subentry of a server
+
+    Costs a single base-scope search on the subschema subentry, for its
+    validators or, if the snapshot has none, for the whole definitions.
+
+    :param data: snapshot dict as returned by read_snapshot
+    :param ldap_conn: a LDAP connection
+    :return: True if the schema did not change since the snapshot"""
+    validated = any(data.get(a) for a in VALIDATOR_ATTRS)
+    if not validated and not data.get('digest'):
+        return False
+    try:
+        res = ldap_conn.search_s(
+            data['subschema_dn'], ldap.SCOPE_BASE, '(objectClass=*)',
+            list(VALIDATOR_ATTRS if validated else SNAPSHOT_ATTRS))
+    except LDAPError as e:
+        logger.warning('Cannot validate schema snapshot: %s', e)
+        return False
+    if not res:
+        return False
+    if not validated:
+        return schema_digest(res[0][1]) == data['digest']
+    return all(_get(res[0][1], a) == data.get(a, []) for a in VALIDATOR_ATTRS)
+
+
+def load_snapshot(path, ldap_conn=None):
+    """Load a schema snapshot as a subschema subentry
+
+    :param path: file to read
+    :param ldap_conn: connection used to validate the snapshot. If None,
+        the snapshot is trusted (offline mode).
+    :return: (subschema DN, subschema entry) or None if the snapshot is
+        missing or stale"""
+    data = read_snapshot(path)
+    if data is None:
+        return None
+    if ldap_conn is not None and not snapshot_is_fresh(data, ldap_conn):
+        logger.info('Schema snapshot %s is stale', path)
+        return None
+    logger.debug('Using schema snapshot %s', path)
+    return data['subschema_dn'], dict((a, data.get(a, [])) for a in SNAPSHOT_ATTRS)
+
+
+def test_snapshot_round_trip():
+    import os
+    import tempfile
+    from benchmarks.fakeldap import FakeLDAPObject
+    from .ploum import load_schemas
+    # the fixture has neither modifyTimestamp nor entryCSN
+    conn = FakeLDAPObject()
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'schema.json')
+        assert load_snapshot(path, conn) is None
+        load_schemas.__wrapped__(conn, snapshot=path)
+        written = os.stat(path).st_ino
+        (subschemacn, entry) = load_snapshot(path, conn)
+        assert subschemacn == 'cn=Subschema'
+        assert entry['objectClasses'] == _get(conn.schema, 'objectClasses')
+        # a fresh snapshot is used as is, and not written again
+        (datadict, _) = load_schemas.__wrapped__(conn, snapshot=path)
+        assert os.stat(path).st_ino == written
+        assert datadict.compose(('inetOrgPerson', )).__name__
+        (datadict, _) = load_schemas.__wrapped__(None, snapshot=path, offline=True)
+        assert datadict.compose(('inetOrgPerson', )).__name__
+        conn.schema['objectClasses'] = conn.schema['objectClasses'][:-1]
+        assert load_snapshot(path, conn) is None
+        assert load_snapshot(path) is not None
+
+
+__all__ = ['save_snapshot', 'read_snapshot', 'snapshot_is_fresh', 'load_snapshot',
+           'schema_digest', ]
@@ -0,0 +1,224 @@
+# -*- encoding: utf-8
+"""Ploum serializer
+
+Stream PloumObj collections to JSON Lines or msgpack, eg. for HTTP
+responses or cache storage, and rebuild them without a server.
+
+.. code:: python
+
+    search = EmailUser.search_iter(base_dn='dc=example,dc=com')
+    for chunk in serializer.iter_jsonl(search(conn)):
+        response.write(chunk)
+    ...
+    users = list(serializer.load_jsonl(f, EmailUser))
+
+Each item is a record {"dn": ..., "attributes": {...}}, the format of
+ploum.export and ploum.importer: single-valued attributes are values,
+multi-valued ones lists. In JSON, bytes values are written as
+{"base64": ...}; msgpack keeps them as they are.
+
+Records are built from a plan computed once per class, mapping the
+lowercase attribute names of the items to their schema names and telling
+single-valued ones apart, instead of looking at the attributes of each
+item. Bytes are only converted when the JSON encoder meets them.
+
+msgpack is an optional dependency, only needed for the msgpack functions.
+"""
+
+import base64
+import json
+import logging
+
+from .helper_class import LDAPHelper
+from .ldap_utils import get_proper_type
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+logger = logging.getLogger(__name__)
+
+
+def field_plan(cls):
+    """Serialization plan of a PloumObj class
+
+    Built once per class, on first use.
+
+    :param cls: PloumObj class
+    :return: dict lowercase name → (name, single_value)"""
+    plan = cls.__dict__.get('_serial_plan')
+    if plan is None:
+        plan = dict((low, (name, attr_class.properties['single_value']))
+                    for (low, (name, attr_class)) in cls.get_field_index()[0].items())
+        cls._serial_plan = plan
+    return plan
+
+
+def to_record(item):
+    """Record of an item
+
+    :param item: PloumObj, or LDAPHelper wrapping one
+    :return: dict"""
+    plan = field_plan(type(item))
+    attrs = {}
+    for (low, attr) in item._attrs.items():
+        if attr is None:
+            continue
+        value = attr._value
+        (name, single) = plan[low]
+        if single:
+            if value is not None:
+                attrs[name] = value
+        elif value:
+            attrs[name] = list(value)
+    return {'dn': item.dn, 'attributes': attrs}
+
+
+def _json_default(value):
+    if isinstance(value, bytes):
+        return {'base64': base64.b64encode(value).decode('ascii')}
+    raise TypeError('Cannot serialize {!r}'.format(value))
+
+
+_json_encoder = json.JSONEncoder(ensure_ascii=False, separators=(',', ':'),
+                                 default=_json_default)
+
+
+def iter_jsonl(items):
+    """Serialize items to JSON Lines, one line at a time
+
+    :param items: iterable of PloumObj
+    :return: generator of str, one line per item"""
+    encode = _json_encoder.encode
+    for item in items:
+        yield encode(to_record(item)) + '\n'
+
+
+def dump_jsonl(items, f):
+    """Write items to a text file as JSON Lines
+
+    :param items: iterable of PloumObj
+    :param f: text file object
+    :return: number of items written"""
+    count = 0
+    for line in iter_jsonl(items):
+        f.write(line)
+        count += 1
+    return count
+
+
+def _require_msgpack():
+    if msgpack is None:
+        raise RuntimeError('msgpack is not installed')
+
+
+def iter_msgpack(items):
+    """Serialize items to msgpack, one map per item
+
+    The chunks can be concatenated into a stream read by load_msgpack.
+
+    :param items: iterable of PloumObj
+    :return: generator of bytes, one chunk per item"""
+    _require_msgpack()
+    packer = msgpack.Packer(use_bin_type=True)
+    for item in items:
+        yield packer.pack(to_record(item))
+
+
+def dump_msgpack(items, f):
+    """Write items to a binary file as a msgpack stream
+
+    :param items: iterable of PloumObj
+    :param f: binary file object
+    :return: number of items written"""
+    count = 0
+    for chunk in iter_msgpack(items):
+        f.write(chunk)
+        count += 1
+    return count
+
+
+class _Loader(object):
+    """Rebuild items from records
+
+    :param cls: PloumObj or LDAPHelper class the items are loaded as; the
+        types of the items are composed from their objectClass. Defaults to
+        the classes of LDAPFactory."""
+
+    def __init__(self, cls=None):
+        if cls is not None:
+            self.all_types = cls.datadict
+        else:
+            from .ploum import LDAPFactory
+            if LDAPFactory.objclasses is None:
+                raise RuntimeError('Cannot load items: no schema loaded')
+            self.all_types = LDAPFactory.objclasses
+        self.wrap = cls if cls is not None and issubclass(cls, LDAPHelper) else None
+
+    def __call__(self, record):
+        attrs = record['attributes']
+        item = get_proper_type(attrs, self.all_types)(record['dn'], attrs)
+        return self.wrap(item) if self.wrap is not None else item
+
+
+def _load_json_value(value):
+    if isinstance(value, dict):
+        return base64.b64decode(value['base64'])
+    if isinstance(value, list):
+        return [_load_json_value(v) if isinstance(v, dict) else v for v in value]
+    return value
+
+
+def from_record(record, cls=None):
+    """Rebuild an item from its record, without a server
+
+    :param record: dict made by to_record, or decoded from JSON or msgpack
+    :param cls: PloumObj or LDAPHelper class the item is loaded as
+    :return: PloumObj or cls instance"""
+    return _Loader(cls)(record)
+
+
+def load_jsonl(f, cls=None):
+    """Read items from JSON Lines
+
+    :param f: text file object, or iterable of lines
+    :param cls: PloumObj or LDAPHelper class the items are loaded as
+    :return: generator of PloumObj or cls instances"""
+    load = _Loader(cls)
+    decode = json.JSONDecoder().decode
+    for line in f:
+        if not line.strip():
+            continue
+        record = decode(line)
+        attrs = record['attributes']
+        for (name, value) in attrs.items():
+            if isinstance(value, (dict, list)):
+                attrs[name] = _load_json_value(value)
+        yield load(record)
+
+
+def load_msgpack(f, cls=None):
+    """Read items from a msgpack stream
+
+    :param f: binary file object
+    :param cls: PloumObj or LDAPHelper class the items are loaded as
+    :return: generator of PloumObj or cls instances"""
+    _require_msgpack()
+    load = _Loader(cls)
+    for record in msgpack.Unpacker(f, raw=False):
+        yield load(record)
+
+
+def test_jsonl_round_trip():
+    from .ploum import _test_item
+    item = _test_item()
+    lines = list(iter_jsonl([item, item]))
+    assert len(lines) == 2 and all(line.endswith('\n') for line in lines)
+    loaded = list(load_jsonl(lines, type(item)))
+    assert [to_record(i) for i in loaded] == [to_record(item)] * 2
+    assert type(loaded[0]) is type(item) and loaded[0].get_modlist() == []
+
+
+__all__ = ['field_plan', 'to_record', 'from_record', 'iter_jsonl', 'dump_jsonl',
+           'load_jsonl', 'iter_msgpack', 'dump_msgpack', 'load_msgpack', ]
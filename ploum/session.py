@@ -0,0 +1,279 @@
+# -*- encoding: utf-8
+"""Ploum sessions
+
+A Session is a unit of work: it collects the items to save and delete and
+flushes them together, keeping several operations in flight on the
+connection instead of paying a round-trip per item.
+
+.. code:: python
+
+    session = Session(window=64)
+    for mailbox in mailboxes:
+        session.save(mailbox)
+    session.delete(old_domain)
+    for res in session.flush(conn):
+        if res.error:
+            print(res.dn, res.error)
+
+Saves are sent parents first, deletes children first. Items are only
+marked clean or deleted when their operation succeeded. Results come level
+by level in that order, and in the order the items were scheduled within
+a level.
+"""
+
+import asyncio
+import collections
+import logging
+
+import ldap.dn
+from ldap.ldapobject import LDAPError
+
+from . import aio
+from .plumbing import normalize_dn
+
+logger = logging.getLogger(__name__)
+
+SessionResult = collections.namedtuple(
+    'SessionResult', ('item', 'operation', 'dn', 'result', 'error'))
+SessionResult.__doc__ = """Outcome of an operation flushed by a Session
+
+:param item: the PloumObj
+:param operation: 'add', 'modify' or 'delete'
+:param dn: DN of the item
+:param result: result3() tuple of the operation, None on error
+:param error: LDAPError raised by the operation, None on success"""
+
+
+class ParentFailed(LDAPError):
+    """Operation skipped because the operation on a parent entry failed"""
+
+
+def dn_depth(dn):
+    """Number of RDNs of a DN
+
+    :param dn: distinguished name
+    :return: int"""
+    return len(ldap.dn.str2dn(dn)) if dn else 0
+
+
+def _is_under(dn, parents):
+    """Whether dn is below one of the parents DNs
+
+    :param dn: distinguished name
+    :param parents: set of normalized DNs"""
+    try:
+        rdns = ldap.dn.str2dn(normalize_dn(dn))
+    except ldap.DECODING_ERROR:
+        return False
+    return any(ldap.dn.dn2str(rdns[i:]) in parents for i in range(1, len(rdns)))
+
+
+class Session(object):
+    """Unit of work batching saves and deletes of PloumObj items
+
+    :param window: maximum number of operations in flight at once"""
+
+    def __init__(self, window=32):
+        self.window = window
+        self._saves = []
+        self._deletes = []
+
+    def save(self, item):
+        """Schedule save of an item
+
+        :param item: PloumObj to create or modify
+        :return: self"""
+        self._saves.append(item)
+        return self
+
+    def delete(self, item):
+        """Schedule delete of an item
+
+        :param item: PloumObj to delete
+        :return: self"""
+        self._deletes.append(item)
+        return self
+
+    def __len__(self):
+        return len(self._saves) + len(self._deletes)
+
+    def _levels(self):
+        """Group pending operations by DN depth, in the order they must run
+
+        :return: list of lists of (item, operation, args)"""
+        saves = collections.defaultdict(list)
+        for item in self._saves:
+            (to_create, ldif) = item._prepare_save()
+            if to_create:
+                saves[dn_depth(item.dn)].append((item, 'add', ldif))
+            else:
+                saves[dn_depth(item.dn)].append((item, 'modify', ldif))
+        deletes = collections.defaultdict(list)
+        for item in self._deletes:
+            deletes[dn_depth(item.dn)].append((item, 'delete', None))
+        return ([saves[d] for d in sorted(saves)] +
+                [deletes[d] for d in sorted(deletes, reverse=True)])
+
+    @staticmethod
+    def _send(ldapconn, item, operation, ldif):
+        if operation == 'add':
+            return ldapconn.add_ext(item.dn, ldif)
+        elif operation == 'modify':
+            return ldapconn.modify_ext(item.dn, ldif)
+        return ldapconn.delete_ext(item.dn)
+
+    @staticmethod
+    def _done(item, operation, res):
+        if operation == 'delete':
+            item.mark_deleted()
+        else:
+            item.mark_clean()
+        return SessionResult(item, operation, item.dn, res, None)
+
+    def _pending_levels(self):
+        levels = self._levels()
+        self._saves = []
+        self._deletes = []
+        return levels
+
+    def flush(self, ldapconn):
+        """Run all the scheduled operations
+
+        :param ldapconn: LDAP connection to use
+        :return: list of SessionResult, level by level, in the order items
+            were scheduled within a level"""
+        results = []
+        failed = set()
+        for level in self._pending_levels():
+            slots = [None] * len(level)
+            inflight = collections.deque()
+            for (idx, (item, operation, ldif)) in enumerate(level):
+                skipped = self._skip(item, operation, ldif, failed)
+                if skipped is not None:
+                    slots[idx] = skipped
+                    continue
+                while len(inflight) >= self.window:
+                    self._collect_slot(ldapconn, inflight.popleft(), failed, slots)
+                try:
+                    msgid = self._send(ldapconn, item, operation, ldif)
+                except LDAPError as e:
+                    slots[idx] = self._failed(item, operation, e, failed)
+                    continue
+                inflight.append((idx, (item, operation, msgid)))
+            while inflight:
+                self._collect_slot(ldapconn, inflight.popleft(), failed, slots)
+            results.extend(slots)
+        return results
+
+    def _collect_slot(self, ldapconn, slot_op, failed, slots):
+        (idx, op) = slot_op
+        slots[idx] = self._collect(ldapconn, op, failed)
+
+    def _skip(self, item, operation, ldif, failed):
+        """Result of an operation that does not need to be sent, if any"""
+        if operation == 'modify' and not ldif:
+            logger.debug('Nothing to save for %s', item.dn)
+            item.mark_clean(notify=False)
+            return SessionResult(item, operation, item.dn, None, None)
+        if failed and _is_under(item.dn, failed):
+            return self._failed(item, operation, ParentFailed(
+                'Operation on a parent of {} failed'.format(item.dn)), failed)
+        return None
+
+    @staticmethod
+    def _failed(item, operation, error, failed):
+        logger.error('Cannot %s %s: %s', operation, item.dn, error)
+        failed.add(normalize_dn(item.dn))
+        return SessionResult(item, operation, item.dn, None, error)
+
+    def _collect(self, ldapconn, op, failed):
+        (item, operation, msgid) = op
+        try:
+            res = ldapconn.result3(msgid)
+        except LDAPError as e:
+            return self._failed(item, operation, e, failed)
+        return self._done(item, operation, res)
+
+    async def flush_async(self, ldapconn):
+        """Run all the scheduled operations from a coroutine
+
+        :param ldapconn: LDAP connection to use
+        :return: list of SessionResult, level by level, in the order items
+            were scheduled within a level"""
+        results = []
+        failed = set()
+        sem = asyncio.Semaphore(self.window)
+
+        async def run(item, operation, msgid):
+            try:
+                res = await aio.wait_result(ldapconn, msgid)
+            except LDAPError as e:
+                return self._failed(item, operation, e, failed)
+            finally:
+                sem.release()
+            return self._done(item, operation, res)
+
+        for level in self._pending_levels():
+            tasks = []
+            for (item, operation, ldif) in level:
+                skipped = self._skip(item, operation, ldif, failed)
+                if skipped is not None:
+                    tasks.append(skipped)
+                    continue
+                await sem.acquire()
+                try:
+                    msgid = self._send(ldapconn, item, operation, ldif)
+                except LDAPError as e:
+                    sem.release()
+                    tasks.append(self._failed(item, operation, e, failed))
+                    continue
+                tasks.append(asyncio.ensure_future(run(item, operation, msgid)))
+            for t in tasks:
+                results.append(await t if asyncio.isfuture(t) else t)
+        return results
+
+
+class _TestConnection(object):
+    """Message-id API of a connection, failing the operations on some DNs"""
+
+    def __init__(self, fail=()):
+        self.fail = fail
+        self.sent = []
+
+    def _send(self, dn, *args):
+        self.sent.append(dn)
+        return len(self.sent)
+
+    add_ext = modify_ext = delete_ext = _send
+
+    def result3(self, msgid):
+        if self.sent[msgid - 1] in self.fail:
+            raise ldap.UNWILLING_TO_PERFORM({'desc': 'Server is unwilling to perform'})
+        return (ldap.RES_ADD, [], msgid, [])
+
+
+def test_session_flush():
+    from .ploum import _test_item
+    unchanged = _test_item()
+    items = []
+    for dn in ('ou=a,dc=example,dc=com', 'uid=x, OU=A,dc=example,dc=com',
+               'ou=b,dc=example,dc=com'):
+        item = type(unchanged)()
+        item.dn = dn
+        item.load_attribute('objectClass', [b'inetOrgPerson'])
+        items.append(item)
+    session = Session(window=1)
+    for item in (items[0], items[1], unchanged, items[2]):
+        session.save(item)
+    conn = _TestConnection(fail=('ou=a,dc=example,dc=com', ))
+    results = session.flush(conn)
+    assert [r.dn for r in results] == [items[0].dn, unchanged.dn, items[2].dn, items[1].dn]
+    assert isinstance(results[0].error, ldap.UNWILLING_TO_PERFORM)
+    assert results[1].error is None and results[1].result is None
+    assert results[2].error is None and results[2].result is not None
+    # the child of the failed entry, written differently, is not sent
+    assert isinstance(results[3].error, ParentFailed)
+    assert conn.sent == [items[0].dn, items[2].dn] and len(session) == 0
+
+
+__all__ = ['Session', 'SessionResult', 'ParentFailed', 'dn_depth', ]
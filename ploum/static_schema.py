@@ -0,0 +1,134 @@
+# -*- encoding: utf-8
+"""Ploum static schemas
+
+Runtime side of the modules generated by ploum.codegen: mappings of the
+attribute types and objectClasses of a generated module, standing for the
+ones load_schemas builds from the server. Nothing is introspected: the
+classes are registered by the generated module as it is imported.
+
+.. code:: python
+
+    from myapp import ldap_classes
+    LDAPFactory.use_static_classes(ldap_classes)
+    Mailbox = LDAPFactory.get_class(('inetOrgPerson', 'mailAccount'))
+"""
+
+import logging
+
+from .ploum import ObjectClassDict
+from .plumbing import AttributeTypeDict
+
+logger = logging.getLogger(__name__)
+
+
+class _Registry(object):
+    """Case-insensitive index of the names of registered schema elements"""
+
+    def _init_registry(self):
+        self._oids = {}
+        self._names = []
+
+    def _add(self, cls, oid, names):
+        self._built[oid] = cls
+        self._oids[oid.lower()] = oid
+        for name in names:
+            self._oids[name.lower()] = oid
+        self._names.extend(names)
+
+    def _getoid(self, name):
+        if isinstance(name, bytes):
+            name = name.decode('utf-8')
+        if not isinstance(name, str):
+            raise KeyError(name)
+        try:
+            return self._oids[name.lower()]
+        except KeyError:
+            raise KeyError(name) from None
+
+    def __iter__(self):
+        return iter(self._names)
+
+    def __len__(self):
+        return len(self._names)
+
+
+class StaticTypeDict(_Registry, AttributeTypeDict):
+    """Mapping of attribute type names to generated LDAPAttribute classes"""
+
+    def __init__(self):
+        super().__init__(None)
+        self._init_registry()
+
+    def build(self, obj):
+        raise KeyError(obj)
+
+    def register(self, cls):
+        """Register a generated attribute class
+
+        :param cls: LDAPAttribute subclass
+        :return: cls"""
+        self._add(cls, cls.properties['oid'], cls.properties['names'])
+        return cls
+
+
+class StaticClassDict(_Registry, ObjectClassDict):
+    """Mapping of objectClass names to generated PloumObj classes
+
+    Compositions generated ahead of time are used as they are, other ones
+    are composed from the generated classes of their objectClasses.
+
+    :param typedict: StaticTypeDict of the attribute classes"""
+
+    def __init__(self, typedict):
+        super().__init__(None, typedict)
+        self._init_registry()
+        self._kinds = {}
+        self._generated = {}
+
+    def build(self, obj):
+        raise KeyError(obj)
+
+    def register(self, cls, kind=0):
+        """Register the generated class of an objectClass
+
+        :param cls: PloumObj subclass
+        :param kind: kind of the objectClass: 0 structural, 1 abstract,
+            2 auxiliary
+        :return: cls"""
+        self._add(cls, cls.oid, list(cls.names))
+        self._kinds[cls.oid] = kind
+        return cls
+
+    def register_composed(self, cls, oids):
+        """Register a generated composition
+
+        :param cls: PloumObj subclass
+        :param oids: OIDs of the composed objectClasses and of their
+            superior classes
+        :return: cls"""
+        self._generated[frozenset(oids)] = cls
+        self._composed[frozenset(oids)] = cls
+        self._with_properties.add(cls)
+        return cls
+
+    def closure(self, name):
+        oid = self._getoid(name)
+        res = self._closures.get(oid)
+        if res is None:
+            res = frozenset([oid]).union(
+                *(self.closure(sup) for sup in self._built[oid].sup_classes))
+            self._closures[oid] = res
+        return res
+
+    def _sort_key(self, oid):
+        return (self.kind_order.get(self._kinds[oid], 0), -len(self._closures[oid]), oid)
+
+    def clear_cache(self):
+        """Forget the composed classes, keep the generated ones"""
+        with self._lock:
+            super().clear_cache()
+            self._composed.update(self._generated)
+            self._with_properties.update(self._generated.values())
+
+
+__all__ = ['StaticTypeDict', 'StaticClassDict', ]
@@ -0,0 +1,137 @@
+# -*- encoding: utf-8
+"""Ploum entry views
+
+Read-only views of search results, for bulk reads that do not need full
+PloumObj items: the (dn, attrs) tuples returned by python-ldap are kept
+as they are and values are only decoded when read.
+
+.. code:: python
+
+    for entry in EmailUser.search_all_ldap(base_dn=base, view=True)(conn):
+        print(entry.dn, entry.mail, entry['uidNumber'])
+        if needs_fix(entry):
+            item = entry.to_ploum()
+            ...
+
+Attribute names are resolved through the schema: any case and any alias of
+an attribute type can be used. Single-valued attributes read as attributes
+of the view give a value, other ones a list.
+"""
+
+import collections.abc
+import logging
+
+from .ldap_utils import get_proper_type
+
+logger = logging.getLogger(__name__)
+
+
+def decode_value(value):
+    """Decode a value as received from the server
+
+    :param value: bytes
+    :return: str, or bytes if the value is not UTF-8"""
+    try:
+        return value.decode('utf-8')
+    except UnicodeDecodeError:
+        return value
+
+
+class EntryView(collections.abc.Mapping):
+    """Read-only view of a search result entry
+
+    Maps attribute names to lists of decoded values.
+
+    :param dn: DN of the entry
+    :param raw: attributes of the entry, as returned by python-ldap
+    :param cls: PloumObj class the search was made with"""
+    __slots__ = ('dn', 'raw', 'cls')
+
+    def __init__(self, dn, raw, cls):
+        self.dn = dn
+        self.raw = raw
+        self.cls = cls
+
+    def _raw_values(self, name):
+        """Raw values of an attribute, None if the entry does not have it"""
+        values = self.raw.get(name)
+        if values is not None:
+            return values
+        try:
+            names = self.cls.attr_types[name].properties['names']
+        except KeyError:
+            names = ()
+        for alias in names:
+            values = self.raw.get(alias)
+            if values is not None:
+                return values
+        low = [n.lower() for n in names] or [name.lower()]
+        for (key, values) in self.raw.items():
+            if key.lower() in low:
+                return values
+        return None
+
+    def __getitem__(self, name):
+        values = self._raw_values(name)
+        if values is None:
+            raise KeyError(name)
+        return [decode_value(v) for v in values]
+
+    def __contains__(self, name):
+        return self._raw_values(name) is not None
+
+    def __iter__(self):
+        return iter(self.raw)
+
+    def __len__(self):
+        return len(self.raw)
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        try:
+            attr_class = self.cls.attr_types[name]
+        except KeyError:
+            raise AttributeError('{} has no attribute type {}'.format(self.dn, name)) from None
+        values = self._raw_values(name)
+        if attr_class.properties['single_value']:
+            return decode_value(values[0]) if values else None
+        return [decode_value(v) for v in values or ()]
+
+    def __repr__(self):
+        return 'EntryView({!r}, {!r})'.format(self.dn, sorted(self.raw))
+
+    def to_ploum(self):
+        """Build the PloumObj of this entry, eg. to modify it
+
+        Classes extending LDAPHelper wrap it: EmailUser(view.to_ploum())
+
+        :return: PloumObj"""
+        return get_proper_type(self.raw, self.cls.datadict)(self.dn, self.raw)
+
+
+def test_entry_view():
+    from .ploum import _test_item
+    item = _test_item()
+    raw = {'objectClass': [b'inetOrgPerson'], 'CN': [b'John Doe'], 'sn': [b'Doe'],
+           'displayName': [b'John'], 'mail': [b'jdoe@example.com', b'john@example.com']}
+    view = EntryView(item.dn, raw, type(item))
+    # any case and any alias of the attribute types
+    assert view['commonName'] == view['cn'] == ['John Doe'] and 'surname' in view
+    assert view.displayName == 'John' and view.mail == ['jdoe@example.com', 'john@example.com']
+    assert view.description == [] and 'description' not in view
+    assert len(view) == 5 and sorted(view) == sorted(raw)
+    try:
+        view.noSuchAttribute
+    except AttributeError:
+        pass
+    else:
+        assert False, 'unknown attribute types are not attributes of the view'
+    assert decode_value(b'\xff\xd8') == b'\xff\xd8'
+    copy = view.to_ploum()
+    assert copy.dn == item.dn and isinstance(copy, type(item))
+    for name in ('cn', 'sn', 'displayname', 'mail'):
+        assert copy.get_attribute(name).value == item.get_attribute(name).value
+
+
+__all__ = ['EntryView', 'decode_value', ]